@@ -0,0 +1,164 @@
+# Activity history for WelcomeBot.  See bot.py for the bot itself.
+#
+# The nick store only says whether the bot has met someone.  This says when:
+# for each person (by clean nick) the first and last time they were seen, the
+# channel they were last seen in, how many times they've joined and when the
+# bot last welcomed them.  It answers "--seen" and "--stats", and lets the bot
+# welcome back someone who has been gone for months (rewelcome_after).
+#
+# The history is a SQLite table keyed by nick, indexed on first and last
+# seen, so looking someone up or counting who was around in the last week
+# reads only the rows it needs.  Recording activity touches nothing but a
+# dict: changes collect there, for at most max_pending people, and are written
+# together in one transaction when it fills up, every activity_flush_interval
+# seconds (see bot.main()), and before any query.  Changes are written as
+# increments, so several bot processes (see shard.py) can share the file.
+#
+# How many people there are altogether is kept in a one-row table of its
+# own, bumped in the same transaction as rows are added, so "--stats" needn't
+# count them.
+
+import sqlite3, time
+
+import metrics
+
+MINUTE = 60
+HOUR = 60 * MINUTE
+DAY = 24 * HOUR
+WEEK = 7 * DAY
+
+
+#########################
+### Class Definitions ###
+#########################
+
+# What the bot knows of one person.  Waiting in ActivityStore.pending, it
+# holds changes not yet written: `joins` counts only the new JOINs.
+class Activity(object):
+    __slots__ = ('nick', 'first_seen', 'last_seen', 'channel', 'joins', 'welcomed')
+
+    def __init__(self, nick, first_seen, last_seen=None, channel=None, joins=0, welcomed=None):
+        self.nick = nick
+        self.first_seen = first_seen
+        self.last_seen = first_seen if last_seen is None else last_seen
+        self.channel = channel
+        self.joins = joins
+        self.welcomed = welcomed  # When last welcomed, or None
+
+
+class ActivityStore(object):
+
+    def __init__(self, path, max_pending=1000, timeout=30, clock=time.time):
+        self.path = path
+        self.max_pending = max_pending
+        self.timeout = timeout  # Seconds to wait for another process's write to finish
+        self.clock = clock  # Wall-clock time: the history outlives the bot
+        self.pending = {}  # Clean nick -> Activity, not yet written
+        self.db = None
+
+    # Opens (or creates) the database.  SQLite connections belong to the
+    # thread that opens them: open it on the bot's thread.
+    def open(self):
+        self.db = sqlite3.connect(self.path, timeout=self.timeout)
+        self.db.text_factory = str
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')  # A crash loses at most the last flush
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS activity ('
+                            'nick TEXT PRIMARY KEY, first_seen REAL NOT NULL, last_seen REAL NOT NULL, '
+                            'channel TEXT, joins INTEGER NOT NULL, welcomed REAL) WITHOUT ROWID')
+            self.db.execute('CREATE INDEX IF NOT EXISTS activity_last_seen ON activity (last_seen)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS activity_first_seen ON activity (first_seen)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS activity_count (people INTEGER NOT NULL)')
+            self.db.execute('INSERT INTO activity_count SELECT COUNT(*) FROM activity '
+                            'WHERE NOT EXISTS (SELECT 1 FROM activity_count)')  # Counted once, for an older file
+
+    # Notes that someone was seen just now: in `channel`, if given (a QUIT
+    # isn't in any one channel), joining it, or being welcomed to it.
+    def record(self, nick, channel=None, joined=False, welcomed=False):
+        now = self.clock()
+        entry = self.pending.get(nick)
+        if entry is None:
+            entry = self.pending[nick] = Activity(nick, now)
+        entry.last_seen = now
+        if channel is not None:
+            entry.channel = channel
+        if joined:
+            entry.joins += 1
+        if welcomed:
+            entry.welcomed = now
+        if len(self.pending) >= self.max_pending:
+            self.flush()
+
+    # When someone was last seen, or None if never.  Cheap enough for every
+    # JOIN: the pending changes, or else one lookup by primary key.
+    def last_seen(self, nick):
+        entry = self.pending.get(nick)
+        if entry is not None:
+            return entry.last_seen
+        if self.db is None:
+            return None
+        row = self.db.execute('SELECT last_seen FROM activity WHERE nick = ?', (nick,)).fetchone()
+        return row[0] if row is not None else None
+
+    # Everything known about someone, as an Activity, or None.
+    def get(self, nick):
+        self.flush()
+        row = self.db.execute('SELECT nick, first_seen, last_seen, channel, joins, welcomed '
+                              'FROM activity WHERE nick = ?', (nick,)).fetchone()
+        return Activity(*row) if row is not None else None
+
+    # How many people were seen since `when`, and how many were first seen
+    # since then.  Each is a range scan of an index.
+    def count_seen_since(self, when):
+        self.flush()
+        return self.db.execute('SELECT COUNT(*) FROM activity WHERE last_seen >= ?', (when,)).fetchone()[0]
+
+    def count_new_since(self, when):
+        self.flush()
+        return self.db.execute('SELECT COUNT(*) FROM activity WHERE first_seen >= ?', (when,)).fetchone()[0]
+
+    def __len__(self):
+        self.flush()
+        return self.db.execute('SELECT people FROM activity_count').fetchone()[0]
+
+    # Writes out the pending changes in one transaction: a row for anyone
+    # new (and them added to the count), then each change applied on top of
+    # whatever is there.
+    def flush(self):
+        if not self.pending or self.db is None:
+            return
+        start = time.time()
+        entries = self.pending.values()
+        with self.db:
+            added = self.db.executemany('INSERT OR IGNORE INTO activity VALUES (?, ?, ?, NULL, 0, NULL)',
+                                        [(entry.nick, entry.first_seen, entry.last_seen) for entry in entries]).rowcount
+            if added:
+                self.db.execute('UPDATE activity_count SET people = people + ?', (added,))
+            self.db.executemany('UPDATE activity SET last_seen = MAX(last_seen, ?), '
+                                'channel = COALESCE(?, channel), joins = joins + ?, '
+                                'welcomed = COALESCE(?, welcomed) WHERE nick = ?',
+                                [(entry.last_seen, entry.channel, entry.joins, entry.welcomed, entry.nick)
+                                 for entry in entries])
+        self.pending = {}
+        metrics.registry.observe('save_activity', time.time() - start)
+
+    def close(self):
+        if self.db is not None:
+            self.flush()
+            self.db.close()
+            self.db = None
+
+
+#################
+### Functions ###
+#################
+
+# "just now", "5 minutes ago", "3 days ago"...
+def ago(seconds):
+    for unit, name in [(365 * DAY, 'year'), (30 * DAY, 'month'), (WEEK, 'week'), (DAY, 'day'),
+                       (HOUR, 'hour'), (MINUTE, 'minute')]:
+        count = int(seconds // unit)
+        if count:
+            return '{} {}{} ago'.format(count, name, 's' if count > 1 else '')
+    return 'just now'
@@ -0,0 +1,51 @@
+# Measures what one message costs message_response as the number of pending
+# newcomers grows.  The cost should stay flat.
+#
+# Usage: python benchmarks/bench_newcomers.py
+
+import os, sys, time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import bot as botcode
+import ircparse
+import nickstore
+
+CHANNEL = '#bench'
+MESSAGES = 20000
+
+
+class null_sock(object):
+
+    def send(self, msg):
+        pass
+
+
+# Time per message for a mix of chat, joins, nick changes and parts.
+def per_message_cost(pending):
+    bot = botcode.Bot(nick_store=nickstore.NickStore(), wait_time=3600)
+    for i in range(pending):
+        bot.add_newcomer('pending{}'.format(i))
+
+    lines = []
+    for i in range(MESSAGES // 4):
+        lines.append(":talker!t@h PRIVMSG {} :hello all".format(CHANNEL))
+        lines.append(":guest{0}!g@h JOIN {1}".format(i, CHANNEL))
+        lines.append(":guest{0}!g@h NICK :visitor{0}".format(i))
+        lines.append(":visitor{0}!g@h PART {1}".format(i, CHANNEL))
+    messages = [ircparse.parse(line) for line in lines]
+
+    sock = null_sock()
+    start = time.time()
+    for msg in messages:
+        botcode.message_response(bot, msg, sock, CHANNEL, ['greeter'])
+    return (time.time() - start) / len(messages)
+
+
+def main():
+    print('{:>10}  {:>12}'.format('pending', 'us/message'))
+    for pending in (0, 10, 100, 1000, 5000, 10000):
+        print('{:>10}  {:>12.2f}'.format(pending, per_message_cost(pending) * 1e6))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,71 @@
+# Compares the nick stores on a large nick list: startup time, resident
+# memory once loaded, and lookup cost.  Each store is measured in a fresh
+# process.  Linux only (reads /proc for memory use).
+#
+# Usage: python benchmarks/bench_nickstore.py [number of nicks]   (default: 1000000)
+
+import os, random, shutil, subprocess, sys, tempfile, time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import nickstore
+
+LOOKUPS = 100000
+
+
+def rss_mb():
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024.0
+
+
+# Runs in the child process: loads one store and reports on it.
+def measure(backend, path):
+    before = rss_mb()
+    start = time.time()
+    if backend == 'compact':
+        store = nickstore.CompactNickStore(path)
+    else:
+        store = nickstore.JournalNickStore(path)
+    store.load()
+    loaded = time.time() - start
+    memory = rss_mb() - before
+
+    hits = ['nick{}'.format(random.randrange(len(store))) for i in range(LOOKUPS)]
+    misses = ['guest{}'.format(i) for i in range(LOOKUPS)]
+    timings = []
+    for nicks in (hits, misses):
+        start = time.time()
+        for nick in nicks:
+            nick in store
+        timings.append((time.time() - start) / LOOKUPS * 1e6)
+
+    print('{:<8} {:>9.2f} s {:>9.1f} MB {:>9.2f} us {:>9.2f} us'.format(backend, loaded, memory, *timings))
+
+
+def main():
+    if sys.argv[1:2] == ['--child']:
+        return measure(sys.argv[2], sys.argv[3])
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    tmpdir = tempfile.mkdtemp()
+    try:
+        nicks = ['nick{}'.format(i) for i in range(count)]
+        json_path = os.path.join(tmpdir, 'nicks.json')
+        nickstore.write_nick_file(json_path, nicks)
+        compact = nickstore.CompactNickStore(os.path.join(tmpdir, 'nicks.db'))
+        nickstore.import_json_nicks(json_path, compact)
+        compact.close()
+        del nicks
+
+        print('{} nicks; nicks.json {:.1f} MB, nicks.db {:.1f} MB'.format(
+            count, os.path.getsize(json_path) / 1048576.0, os.path.getsize(compact.path) / 1048576.0))
+        print('{:<8} {:>11} {:>12} {:>12} {:>12}'.format('store', 'startup', 'memory', 'hit', 'miss'))
+        for backend, path in (('journal', json_path), ('compact', compact.path)):
+            subprocess.check_call([sys.executable, __file__, '--child', backend, path])
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
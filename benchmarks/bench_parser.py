@@ -0,0 +1,51 @@
+# Parses and dispatches a traffic log, reporting the cost per line.
+#
+# Usage: python benchmarks/bench_parser.py [log file]   (default: traffic.log)
+
+import os, sys, time
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..'))
+
+import bot as botcode
+import ircparse
+import nickstore
+
+CHANNEL = '#falconframework'
+ROUNDS = 20
+
+
+class null_sock(object):
+
+    def send(self, msg):
+        pass
+
+
+def timed(lines, func):
+    start = time.time()
+    for i in range(ROUNDS):
+        for line in lines:
+            func(line)
+    return (time.time() - start) / (ROUNDS * len(lines))
+
+
+def main():
+    path = sys.argv[1] if len(sys.argv) > 1 else os.path.join(here, 'traffic.log')
+    with open(path) as log:
+        lines = [line for line in log.read().splitlines() if line]
+
+    bot = botcode.Bot(nick_store=nickstore.NickStore(), wait_time=3600)
+    sock = null_sock()
+
+    def respond(line):
+        msg = ircparse.parse(line)
+        if msg is not None:
+            botcode.message_response(bot, msg, sock, CHANNEL, ['kgriffs'])
+
+    print('{} lines from {}'.format(len(lines), path))
+    for name, func in (('parse', ircparse.parse), ('parse + respond', respond)):
+        cost = timed(lines, func)
+        print('{:<16} {:>8.2f} us/line {:>10.0f} lines/s'.format(name, cost * 1e6, 1 / cost))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
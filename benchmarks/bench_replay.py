@@ -0,0 +1,354 @@
+# Replays IRC traffic through the bot's whole receive path -- line framing,
+# parsing, Network.dispatch, the handlers and the welcome timers -- against a
+# fake socket, and reports throughput, per-command latency and memory.
+#
+# The traffic is either synthetic (the scenarios below) or a recorded log,
+# one raw server line per line, like traffic.log.  Each scenario runs in a
+# fresh process so that memory figures don't bleed into each other.  The
+# clock is simulated: every line advances it by LINE_GAP seconds, so the
+# welcome timers fire during the replay just as they would live.
+#
+# Each scenario is run several times and the best figures kept: the fastest
+# run, and each command's latencies from the run where its median was
+# lowest.  A busy machine only ever makes a run slower, so the best of a few
+# is steadier than any one of them; and the scenarios take turns, so that a
+# busy spell doesn't land on every run of the same one.
+#
+# Results can be saved as a baseline and later runs compared against it;
+# a drop in lines/s or a rise in median latency beyond --tolerance is
+# reported as a regression (and the exit status is 1).  Linux only (reads
+# /proc for memory use).
+#
+# Usage: python benchmarks/bench_replay.py [options] [scenario ...]
+#   --lines N          lines per synthetic scenario (default: 20000)
+#   --log PATH         also replay a recorded log
+#   --runs N           runs per scenario, keeping the best (default: 5)
+#   --save             write the results to baseline.json
+#   --compare          compare the results with baseline.json
+#   --tolerance PCT    allowed slowdown before --compare complains (default: 15)
+
+import json, os, random, subprocess, sys, time
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..'))
+
+import bot as botcode
+import eventloop
+import ircio
+import nickstore
+
+BASELINE = os.path.join(here, 'baseline.json')
+SERVER = 'irc.example.net'
+BOTNICK = 'elaenor'
+CHANNELS = ['#falconframework', '#falcon-dev']
+WAIT_TIME = 30  # Seconds before a newcomer is welcomed
+LINE_GAP = 0.01  # Simulated seconds between lines
+CHUNK = 4096  # Bytes per recv, as a busy server would deliver them
+
+
+###########################
+### Synthetic Traffic ###
+###########################
+
+def user(nick):
+    return ':{0}!~{0}@{0}.users.example.org'.format(nick)
+
+def chat(rng, words=('hello', 'falcon', 'thanks', 'why', 'does', 'my', 'hook', 'route',
+                     'request', 'uwsgi', 'error', 'traceback', 'pip', 'python', 'lol')):
+    return ' '.join(rng.choice(words) for i in range(rng.randint(3, 12)))
+
+# Hundreds of people joining at once (a link posted somewhere), with a few
+# of them talking and some leaving again.
+def join_storm(count, rng):
+    made = 0
+    while made < count:
+        guest = 'guest{}'.format(made)
+        channel = rng.choice(CHANNELS)
+        yield '{} JOIN {}'.format(user(guest), channel)
+        made += 1
+        roll = rng.random()
+        if roll < 0.1:
+            yield '{} PRIVMSG {} :{}'.format(user(guest), channel, chat(rng))
+            made += 1
+        elif roll < 0.2:
+            yield '{} PART {} :bye'.format(user(guest), channel)
+            made += 1
+
+# A chatty channel of regulars, with the odd greeting or question for the
+# bot, and the server's PINGs.
+def chatty(count, rng):
+    regulars = ['regular{}'.format(i) for i in range(50)]
+    for i in range(count):
+        roll = rng.random()
+        channel = rng.choice(CHANNELS)
+        if roll < 0.01:
+            yield 'PING :{}'.format(SERVER)
+        elif roll < 0.03:
+            yield '{} PRIVMSG {} :hello {}'.format(user(rng.choice(regulars)), channel, BOTNICK)
+        elif roll < 0.04:
+            yield '{} PRIVMSG {} :help {}'.format(user(rng.choice(regulars)), channel, BOTNICK)
+        else:
+            yield '{} PRIVMSG {} :{}'.format(user(rng.choice(regulars)), channel, chat(rng))
+
+# Servers splitting and rejoining: everyone behind the split QUITs with the
+# two server names as the reason, then JOINs again when the link returns.
+def netsplit(count, rng):
+    made = 0
+    split = 0
+    while made < count:
+        crowd = ['split{}_{}'.format(split, i) for i in range(min(500, max(1, (count - made) // 2)))]
+        for nick in crowd:
+            yield '{} JOIN {}'.format(user(nick), rng.choice(CHANNELS))
+        for nick in crowd:
+            yield '{} QUIT :hub.example.net leaf{}.example.net'.format(user(nick), split)
+        for nick in crowd:
+            yield '{} JOIN {}'.format(user(nick), rng.choice(CHANNELS))
+        made += 3 * len(crowd)
+        split += 1
+
+# Newcomers changing nick over and over before they are welcomed:
+# guest -> guest_ -> guest|away -> guest and so on.
+def nick_churn(count, rng):
+    present = []
+    made = 0
+    while made < count:
+        if len(present) < 200 or rng.random() < 0.2:
+            nick = 'churn{}'.format(made)
+            yield '{} JOIN {}'.format(user(nick), rng.choice(CHANNELS))
+            present.append(nick)
+        else:
+            i = rng.randrange(len(present))
+            old = present[i]
+            base = old.split('|')[0].rstrip('_')
+            new = rng.choice([base, base + '_', base + '__', base + '|away', base + '|afk'])
+            if new == old:
+                new = base + '_' * (old.count('_') + 1)
+            yield '{} NICK :{}'.format(user(old), new)
+            present[i] = new
+        made += 1
+
+SCENARIOS = {
+    'join_storm': join_storm,
+    'chatty': chatty,
+    'netsplit': netsplit,
+    'nick_churn': nick_churn,
+}
+
+
+########################
+### Replay Machinery ###
+########################
+
+def rss_kb(field='VmRSS:'):
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith(field):
+                return int(line.split()[1])
+
+def percentile(timings, fraction):
+    return timings[min(len(timings) - 1, int(len(timings) * fraction))]
+
+
+class sim_clock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+# Serves the replayed data from recv() and swallows whatever is sent.
+class replay_sock(object):
+
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+        self.bytes_sent = 0
+
+    def recv(self, bufsize):
+        chunk = self.data[self.pos:self.pos + min(bufsize, CHUNK)]
+        self.pos += len(chunk)
+        return chunk
+
+    def sendall(self, data):
+        self.bytes_sent += len(data)
+
+
+# Replays the lines through a freshly built Network and returns its measurements.
+def replay(lines):
+    clock = sim_clock()
+    loop = eventloop.EventLoop(clock=clock)
+    channels = dict((channel, {'wait_time': WAIT_TIME}) for channel in CHANNELS)
+    network = botcode.make_networks(loop, nickstore.NickStore(), [
+        {'server': SERVER, 'botnick': BOTNICK, 'channels': channels},
+    ])[0]
+    data = ''.join(line + '\r\n' for line in lines)
+    sock = replay_sock(data)
+    network.reader = ircio.LineReader(sock)
+    network.sendq = ircio.SendQueue(sock, rate=1e9, burst=1e9, clock=clock)  # No flood limit here
+
+    latencies = {}
+    dispatch = network.dispatch
+    def timed_dispatch(msg):
+        start = time.time()
+        dispatch(msg)
+        latencies.setdefault(msg.command, []).append(time.time() - start)
+        clock.now += LINE_GAP
+    network.dispatch = timed_dispatch
+
+    before = rss_kb()
+    start = time.time()
+    while sock.pos < len(data):
+        network.read_messages()
+        timer_start = time.time()
+        loop.run_once(0)  # Welcomes that came due
+        latencies.setdefault('(timers)', []).append(time.time() - timer_start)
+        network.sendq.flush()
+    elapsed = time.time() - start
+
+    newcomers = sum(len(bot.newcomers) for bot in network.bots.values())
+    loop.close()
+    return {
+        'lines': len(lines),
+        'seconds': round(elapsed, 3),
+        'lines_per_sec': round(len(lines) / elapsed),
+        'bytes_sent': sock.bytes_sent,
+        'pending_newcomers': newcomers,
+        'rss_growth_kb': rss_kb() - before,
+        'peak_rss_kb': rss_kb('VmHWM:'),
+        'latency_us': dict((command, summarize(timings)) for command, timings in latencies.items()),
+    }
+
+# The best of several runs' results (see the top of the file).
+def best_of(results):
+    best = dict(max(results, key=lambda result: result['lines_per_sec']))
+    best['latency_us'] = dict(best['latency_us'])
+    for result in results:
+        for command, stats in result['latency_us'].items():
+            if command not in best['latency_us'] or stats['p50'] < best['latency_us'][command]['p50']:
+                best['latency_us'][command] = stats
+    return best
+
+def summarize(timings):
+    timings.sort()
+    return {
+        'count': len(timings),
+        'p50': round(percentile(timings, 0.50) * 1e6, 1),
+        'p90': round(percentile(timings, 0.90) * 1e6, 1),
+        'p99': round(percentile(timings, 0.99) * 1e6, 1),
+        'max': round(timings[-1] * 1e6, 1),
+    }
+
+# Runs in the child process: builds the traffic, replays it and prints the
+# results as JSON on the last line.
+def measure(scenario, lines, log_path):
+    if scenario == 'log':
+        with open(log_path) as log:
+            traffic = [line for line in log.read().splitlines() if line]
+    else:
+        traffic = list(SCENARIOS[scenario](lines, random.Random(scenario)))
+
+    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')  # Only the results go to stdout
+    try:
+        result = replay(traffic)
+    finally:
+        sys.stdout = stdout
+    print(json.dumps(result))
+
+
+##################
+### Reporting ###
+##################
+
+def report(name, result):
+    print('{}: {} lines, {:.0f} lines/s, RSS +{:.1f} MB (peak {:.1f} MB), {} still pending'.format(
+        name, result['lines'], result['lines_per_sec'], result['rss_growth_kb'] / 1024.0,
+        result['peak_rss_kb'] / 1024.0, result['pending_newcomers']))
+    print('    {:<10} {:>8} {:>9} {:>9} {:>9} {:>9}'.format('command', 'count', 'p50 us', 'p90 us', 'p99 us', 'max us'))
+    for command, stats in sorted(result['latency_us'].items()):
+        print('    {:<10} {count:>8} {p50:>9.1f} {p90:>9.1f} {p99:>9.1f} {max:>9.1f}'.format(command, **stats))
+
+# Prints how each result moved against the baseline; returns the regressions.
+def compare(results, baseline, tolerance):
+    regressions = []
+    print('\nAgainst {} (tolerance {:.0f}%):'.format(os.path.basename(BASELINE), tolerance * 100))
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            print('    {:<12} no baseline'.format(name))
+            continue
+        old = baseline[name]
+        change = result['lines_per_sec'] / old['lines_per_sec'] - 1
+        print('    {:<12} {:>10.0f} -> {:>10.0f} lines/s ({:+.0%})'.format(
+            name, old['lines_per_sec'], result['lines_per_sec'], change))
+        if change < -tolerance:
+            regressions.append('{}: lines/s {:+.0%}'.format(name, change))
+        for command, stats in sorted(result['latency_us'].items()):
+            old_p50 = old['latency_us'].get(command, {}).get('p50')
+            if old_p50 and stats['count'] >= 100 and stats['p50'] > old_p50 * (1 + tolerance) + 1:  # +1us: timer resolution
+                regressions.append('{} {}: p50 {:.1f} -> {:.1f} us'.format(name, command, old_p50, stats['p50']))
+    return regressions
+
+
+def main():
+    args = sys.argv[1:]
+    if args[:1] == ['--child']:
+        return measure(args[1], int(args[2]), args[3] if len(args) > 3 else None)
+
+    lines, log_path, runs, save, check, tolerance, names = 20000, None, 5, False, False, 0.15, []
+    while args:
+        arg = args.pop(0)
+        if arg == '--lines':
+            lines = int(args.pop(0))
+        elif arg == '--log':
+            log_path = args.pop(0)
+        elif arg == '--runs':
+            runs = int(args.pop(0))
+        elif arg == '--save':
+            save = True
+        elif arg == '--compare':
+            check = True
+        elif arg == '--tolerance':
+            tolerance = float(args.pop(0)) / 100
+        elif arg in SCENARIOS:
+            names.append(arg)
+        else:
+            sys.exit('Unknown scenario or option: {}'.format(arg))
+    if not names:
+        names = sorted(SCENARIOS)
+
+    scenarios = [(name, [name, str(lines)]) for name in names]
+    if log_path:
+        scenarios.append(('log', ['log', '0', log_path]))
+
+    measured = dict((name, []) for name, child_args in scenarios)
+    for i in range(runs):
+        for name, child_args in scenarios:
+            output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--child'] + child_args)
+            measured[name].append(json.loads(output.splitlines()[-1]))
+    results = {}
+    for name, child_args in scenarios:
+        results[name] = best_of(measured[name])
+        report(name, results[name])
+
+    if save:
+        baseline = {}
+        if os.path.isfile(BASELINE):
+            with open(BASELINE) as baseline_file:
+                baseline = json.load(baseline_file)
+        baseline.update(results)
+        with open(BASELINE, 'w') as baseline_file:
+            json.dump(baseline, baseline_file, indent=2, sort_keys=True, separators=(',', ': '))
+            baseline_file.write('\n')
+        print('\nSaved to {}'.format(BASELINE))
+
+    if check:
+        with open(BASELINE) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), tolerance)
+        if regressions:
+            print('\nRegressions:\n    ' + '\n    '.join(regressions))
+            return 1
+        print('\nNo regressions.')
+
+
+if __name__ == "__main__":
+    sys.exit(main())
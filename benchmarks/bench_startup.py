@@ -0,0 +1,68 @@
+# Measures how soon a freshly started bot can answer the server, with the
+# nick list loaded up front (as before) versus in the background by
+# warm_up().  The "server" is one end of a socketpair: it sends a PING as
+# soon as the bot is attached, and the time to the bot's PONG is reported
+# along with the time until all known nicks are loaded.
+#
+# Usage: python benchmarks/bench_startup.py [number of nicks]   (default: 1000000)
+
+import os, shutil, socket, sys, tempfile, time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import bot as botcode
+import eventloop
+import nickstore
+
+
+def start(path, background):
+    started = time.time()
+    loop = eventloop.EventLoop()
+    known_nicks = nickstore.JournalNickStore(path)
+    if not background:
+        known_nicks.load()
+
+    networks = botcode.make_networks(loop, known_nicks, [
+        {'server': 'irc.example.org', 'botnick': 'elaenor', 'channels': {'#falcon': {}}},
+    ])
+    server, client = socket.socketpair()
+    networks[0].attach(client)
+    if background:
+        botcode.warm_up(loop, known_nicks, networks)
+    server.sendall('PING :irc.example.org\r\n')
+
+    ponged = loaded = None
+    server.setblocking(False)
+    while ponged is None or loaded is None:
+        loop.run_once(0.01)
+        if ponged is None:
+            try:
+                if server.recv(512).startswith('PONG'):
+                    ponged = time.time() - started
+            except socket.error:
+                pass
+        if loaded is None and known_nicks.loaded:
+            loaded = time.time() - started
+
+    print('{:<12} {:>10.3f} s {:>10.3f} s'.format('background' if background else 'up front', ponged, loaded))
+    known_nicks.close()
+    loop.close()
+    server.close()
+    client.close()
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'nicks.json')
+        nickstore.write_nick_file(path, ['nick{}'.format(i) for i in range(count)])
+        print('{} known nicks'.format(count))
+        print('{:<12} {:>12} {:>12}'.format('loading', 'first PONG', 'all loaded'))
+        for background in (False, True):
+            start(path, background)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,17 @@
 # Welcome to WelcomeBot.  Find source, documentation, etc here: https://github.com/shaunagm/WelcomeBot/  Licensed https://creativecommons.org/licenses/by-sa/2.0/
 
 # Import some necessary libraries.
-import socket, sys, time, csv, Queue, random, re, pdb, select, os.path, json
-from threading import Thread
+import socket, sys, time, random, re, os, os.path, heapq, itertools, json, threading, logging, errno
 
 # To configure bot, please make changes in bot_settings.py
 import bot_settings as settings
+import activity, botlog, caps, eventloop, ircio, ircparse, metrics, nickstore, triggers
+import faq as faq_module
+from botlog import log
+
+# Message text per PRIVMSG: IRC lines are at most 512 bytes, and the server
+# relays ours with our nick!user@host in front.
+MAX_MESSAGE = 400
 
 #########################
 ### Class Definitions ###
@@ -16,94 +22,622 @@ class Bot(object):
 
     def __init__(self, botnick=settings.botnick, welcome_message=settings.welcome_message,
         nick_source=settings.nick_source, wait_time=settings.wait_time,
-        hello_list=settings.hello_list, help_list=settings.help_list):
+        hello_list=settings.hello_list, help_list=settings.help_list,
+        nick_store=None, loop=None, channel=settings.channel,
+        channel_greeters=settings.channel_greeters, faq=None,
+        welcome_batch_window=settings.welcome_batch_window,
+        welcome_batch_threshold=settings.welcome_batch_threshold,
+        welcome_digest_message=settings.welcome_digest_message,
+        activity=None, rewelcome_after=settings.rewelcome_after):
         self.botnick = botnick
+        self.channel = channel
+        self.channel_greeters = channel_greeters
         self.welcome_message = welcome_message
+        self.welcome_batch_window = welcome_batch_window  # 0: welcome each newcomer on their own
+        self.welcome_batch_threshold = welcome_batch_threshold
+        self.welcome_digest_message = welcome_digest_message  # None: welcome_message, naming them all
+        self.digest_timer = None  # Closes the current batch; see process_newcomers()
         self.nick_source = nick_source
         self.wait_time = wait_time
-        self.known_nicks = set()
-        self.newcomers = []
-        self.hello_regex = re.compile(get_regex(hello_list, botnick), re.I)  # Regexed version of hello list
-        self.help_regex = re.compile(get_regex(help_list, botnick), re.I)  # Regexed version of help list
+        if nick_store is None:
+            nick_store = open_nick_store(nick_source)
+        self.known_nicks = nick_store  # Set-like; see nickstore.py
+        self.newcomers = NewcomerRegistry()
+        self.activity = activity  # When people were seen, shared by every channel; see activity.py
+        self.rewelcome_after = rewelcome_after  # None: once known, never welcomed again
+        self.loop = loop  # Schedules each newcomer's welcome; see schedule_welcome()
+        self.held_joins = {}  # Nick -> join time, for JOINs seen while known_nicks loads
+        self.netsplits = Netsplits(loop, [self])  # Shared by the Network's channels; see on_quit()
+        self.split_newcomers = {}  # Nick -> their NewComer, for newcomers lost in a netsplit
+        self.accounts = {}  # Nick -> account they're logged in to; shared by the Network's channels
+        self.triggers = triggers.TriggerMatcher(botnick, [  # "hello elaenor" and the like; see triggers.py
+            (hello_list, on_hello),
+            (help_list, on_help),
+        ])
+        self.faq = faq  # Shared by every channel; see faq.py and refresh_faq()
+        if faq is not None:
+            for entry in faq.entries:
+                self.triggers.add(entry.keywords, entry, compile=False)
+            self.triggers.compile()
+        self.cooldowns = faq_module.Cooldowns(settings.trigger_user_cooldown, settings.trigger_channel_cooldown, self.now)
+        self.greeters_key = self.greeters_phrase = None  # See cached_greeter_string()
+        self.welcome_key = self.welcome = None  # See welcome_reply()
 
     def add_known_nick(self, clean_nick):
-        """Add the current newcomer's nick to nicks.csv and known_nicks."""
-        self.known_nicks.add(clean_nick)
-        self.save_nicks()
-
-    def add_newcomer(self, nick):
-        self.newcomers.append(NewComer(nick))
-
-    def save_nicks(self):
-        with open(self.nick_source, 'w') as nick_file:
-            json.dump(
-                { 'nicks': list(self.known_nicks) },
-                nick_file,
-                ensure_ascii=False,
-                encoding='utf-8',
-                indent=4,
-            )
+        """Add the current newcomer's nick to the nick store and known_nicks."""
+        self.known_nicks.add(clean_nick)  # Appends to the journal; no full rewrite
+
+    # Remembers a newcomer who has had their chance to be welcomed: by clean
+    # nick, and by account if they're logged in to one.
+    def add_known(self, newcomer):
+        self.add_known_nick(newcomer.clean_nick)
+        account = self.accounts.get(newcomer.nick)
+        if account is not None:
+            self.add_known_nick(account.lower())
+
+    # Whether someone is known, by account if the server tells us theirs (see
+    # caps.py) and otherwise by clean nick.  Accounts live in the nick store
+    # alongside nicks: on most networks an account is named after the nick
+    # that registered it anyway.
+    def is_known(self, nick, clean_nick):
+        if clean_nick in self.known_nicks:
+            return True
+        account = self.accounts.get(nick)
+        return account is not None and account.lower() in self.known_nicks
+
+    # Whether to welcome someone who joins: if they're not known, or have
+    # been away for longer than rewelcome_after.
+    def is_new(self, nick, clean_nick):
+        if not self.is_known(nick, clean_nick):
+            return True
+        if self.activity is None or self.rewelcome_after is None:
+            return False
+        last_seen = self.activity.last_seen(clean_nick)
+        if last_seen is None or self.activity.clock() - last_seen < self.rewelcome_after:
+            return False
+        metrics.registry.incr('rewelcomes')
+        return True
+
+    # Whether a newcomer restored from pending_source was welcomed after it
+    # was last saved, before the bot went down: they're known by now, and
+    # (if the channel welcomes people back) were welcomed since they joined.
+    def was_welcomed(self, newcomer):
+        if not self.is_known(newcomer.nick, newcomer.clean_nick):
+            return False
+        if self.activity is None or self.rewelcome_after is None:
+            return True
+        seen = self.activity.get(newcomer.clean_nick)
+        return seen is None or seen.welcomed is None or seen.welcomed >= newcomer.born
+
+    def record_activity(self, clean_nick, channel, joined=False, welcomed=False):
+        if self.activity is not None:
+            self.activity.record(clean_nick, channel, joined, welcomed)
+
+    def add_newcomer(self, nick, born=None):
+        metrics.registry.incr('newcomers_added')
+        return self.newcomers.add(nick, self.now() if born is None else born)
+
+    # The time by the event loop's clock, which newcomers' timers run on.
+    def now(self):
+        return self.loop.time() if self.loop is not None else time.time()
 
     def load_nicks(self):
-        try:
-            with open(self.nick_source, 'r') as nick_file:
-                doc = json.load(nick_file, encoding='utf-8')
-                self.known_nicks.update(doc['nicks'])
+        self.known_nicks.load()
 
-        except IOError as ex:  # File not found; ignore
-            print('{} not found; no nicks loaded',format(self.nick_source))
+    # greeter_string(channel_greeters), worked out again only when they change.
+    def cached_greeter_string(self, channel_greeters):
+        key = tuple(channel_greeters)
+        if key != self.greeters_key:
+            self.greeters_key = key
+            self.greeters_phrase = greeter_string(channel_greeters)
+        return self.greeters_phrase
+
+    # The welcome line with everything but the newcomer filled in, rendered
+    # again only when the message, channel or greeters change.
+    def welcome_reply(self, channel, channel_greeters):
+        key = (self.welcome_message, channel, tuple(channel_greeters))
+        if key != self.welcome_key:
+            self.welcome_key = key
+            self.welcome = faq_module.Reply("PRIVMSG {channel} :" + self.welcome_message + "\n", 'newcomer',
+                                            channel=channel, greeter_string=self.cached_greeter_string(channel_greeters))
+        return self.welcome
 
 class NewComer(object):
+    __slots__ = ('nick', 'clean_nick', 'born', 'timer')
 
-    def __init__(self, nick):
+    def __init__(self, nick, born=None):
         self.nick = nick
         self.clean_nick = clean_nick(self.nick)
-        self.born = time.time()
+        self.born = time.time() if born is None else born
+        self.timer = None  # Fires when the wait is over, if there's an event loop
 
     def around_for(self):
         return time.time() - self.born
 
+# The newcomers waiting to be welcomed, indexed by clean nick and by nick, with
+# a heap ordered by arrival so expiry only ever looks at the newcomers that are
+# due.  Removing a newcomer leaves its heap entry behind; stale entries are
+# skipped when they reach the top.
+class NewcomerRegistry(object):
+
+    def __init__(self):
+        self.by_clean_nick = {}
+        self.by_nick = {}
+        self.heap = []  # (born, tie-breaker, newcomer)
+        self.counter = itertools.count()
+
+    def __contains__(self, clean_nick):
+        return clean_nick in self.by_clean_nick
+
+    def __iter__(self):
+        return iter(sorted(self.by_clean_nick.values(), key=lambda i: i.born))
+
+    def __len__(self):
+        return len(self.by_clean_nick)
+
+    def add(self, nick, born=None):
+        newcomer = NewComer(nick, born)
+        self.remove(newcomer.clean_nick)  # Never track one person twice
+        self.by_clean_nick[newcomer.clean_nick] = newcomer
+        self.by_nick[newcomer.nick] = newcomer
+        heapq.heappush(self.heap, (newcomer.born, next(self.counter), newcomer))
+        return newcomer
+
+    def get(self, nick):
+        return self.by_nick.get(nick)
+
+    # Removes the newcomer with this clean nick, if there is one, and cancels
+    # their welcome.
+    def remove(self, clean_nick):
+        newcomer = self.by_clean_nick.pop(clean_nick, None)
+        if newcomer is not None:
+            del self.by_nick[newcomer.nick]
+            if newcomer.timer is not None:
+                newcomer.timer.cancel()
+                newcomer.timer = None
+        return newcomer
+
+    # Follows a newcomer through a nick change.  Their welcome stays scheduled.
+    def rename(self, nick, new_nick):
+        newcomer = self.by_nick.get(nick)
+        if newcomer is None:
+            return None
+        del self.by_clean_nick[newcomer.clean_nick]
+        del self.by_nick[newcomer.nick]
+        self.remove(clean_nick(new_nick))
+        newcomer.nick = new_nick
+        newcomer.clean_nick = clean_nick(new_nick)
+        self.by_clean_nick[newcomer.clean_nick] = newcomer
+        self.by_nick[newcomer.nick] = newcomer
+        return newcomer
+
+    # Removes and returns the newcomers that arrived by `cutoff`, oldest first.
+    def pop_due(self, cutoff):
+        due = []
+        while self.heap and self.heap[0][0] <= cutoff:
+            born, count, newcomer = heapq.heappop(self.heap)
+            if self.by_clean_nick.get(newcomer.clean_nick) is newcomer:
+                self.remove(newcomer.clean_nick)
+                due.append(newcomer)
+        return due
+
+
+# Who was lost in recent netsplits.  One of these is shared by all the
+# channels on a network, so that each QUIT is recorded once however many
+# channels there are.  All the nicks lost in one split are forgotten
+# together, netsplit_memory seconds after it began: whoever hasn't come back
+# by then has left for real.
+class Netsplits(object):
+
+    def __init__(self, loop=None, bots=()):
+        self.loop = loop
+        self.bots = list(bots)  # Each keeps its own newcomers lost in a split
+        self.reasons = {}  # QUIT reason (the two servers) -> nicks lost in that split
+        self.nicks = {}  # Nick -> the split they were lost in
+
+    def __contains__(self, nick):
+        return nick in self.nicks
+
+    def __len__(self):
+        return len(self.nicks)
+
+    def add(self, nick, reason):
+        nicks = self.reasons.get(reason)
+        if nicks is None:
+            nicks = self.reasons[reason] = []
+            metrics.registry.incr('netsplits')
+            if self.loop is not None:
+                self.loop.call_later(settings.netsplit_memory, self.forget, reason)
+        nicks.append(nick)
+        self.nicks[nick] = reason
+
+    def forget(self, reason):
+        for nick in self.reasons.pop(reason, ()):
+            if self.nicks.get(nick) == reason:
+                del self.nicks[nick]
+                for bot in self.bots:
+                    bot.split_newcomers.pop(nick, None)
+
+
+# Messages the server has bracketed together with BATCH (see caps.py), held
+# until the batch ends so they can be handled as one.
+class Batch(object):
+    __slots__ = ('kind', 'params', 'messages')
+
+    def __init__(self, kind, params):
+        self.kind = kind  # e.g. 'netsplit' or 'netjoin'
+        self.params = params  # For netsplits and netjoins, the two servers
+        self.messages = []
+
+
+# One connection to an IRC server, serving any number of channels.  Each
+# channel gets its own Bot, holding that channel's settings and newcomers;
+# all of them share one nick store, however many channels and networks the
+# process serves.
+#
+# The connection looks after itself: if the server hangs up, or goes quiet
+# for ping_timeout seconds, it reconnects with exponential backoff and
+# rejoins.  Newcomers are kept (welcomes paused) while disconnected and
+# picked up again once the server lists who is still in the channel.
+class Network(object):
+
+    def __init__(self, loop, server, botnick, port=6667):
+        self.loop = loop
+        self.server = server
+        self.port = port
+        self.botnick = botnick
+        self.bots = {}  # Lower-cased channel name -> Bot
+        self.resolver = resolve  # Looks the server up, off the loop; None: connect by name
+        self.connector = irc_start  # Opens the socket; tests swap this out
+        self.ircsock = None
+        self.sendq = None
+        self.names = {}  # Lower-cased channel name -> nicks listed so far by NAMES
+        self.netsplits = Netsplits(loop)
+        self.negotiation = None  # This connection's CAP negotiation; see caps.py
+        self.accounts = {}  # Nick -> account, as far as the server has told us
+        self.batches = {}  # Reference -> Batch, for batches still open
+        self.unsent = []  # Messages the flood limit held back when the connection dropped
+        self.failures = 0  # Connection attempts since we were last registered
+        self.last_heard = None  # When the server last sent us anything
+        self.watchdog = None
+        self.connect_timer = None  # Gives up on a connection the server hasn't accepted
+
+        self.connect_timeout = settings.connect_timeout
+        self.reconnect_delay = settings.reconnect_delay
+        self.reconnect_max_delay = settings.reconnect_max_delay
+        self.ping_interval = settings.ping_interval
+        self.ping_timeout = settings.ping_timeout
+
+    def add_channel(self, bot):
+        self.bots[bot.channel.lower()] = bot
+        bot.netsplits = self.netsplits
+        self.netsplits.bots.append(bot)
+        bot.accounts = self.accounts
+
+    # Connecting never blocks the loop, which may be serving other networks:
+    # the server is looked up on a thread of its own, and the socket connects
+    # in the background until it becomes writable (see connected()).
+    def connect(self):
+        if self.resolver is None:
+            self.open_connection(self.server)
+            return
+
+        def lookup():
+            try:
+                address = self.resolver(self.server, self.port)
+            except socket.error as ex:
+                self.loop.call_soon_threadsafe(self.connect_failed, ex)
+            else:
+                self.loop.call_soon_threadsafe(self.open_connection, address)
+        resolver = threading.Thread(target=lookup, name='resolver')
+        resolver.daemon = True
+        resolver.start()
+
+    def open_connection(self, address):
+        try:
+            ircsock = self.connector(address, self.port)
+        except socket.error as ex:
+            self.connect_failed(ex)
+            return
+        self.loop.add_writer(ircsock, self.connected, ircsock)
+        self.connect_timer = self.loop.call_later(self.connect_timeout, self.connect_timed_out, ircsock)
+
+    def connected(self, ircsock):
+        self.loop.remove_writer(ircsock)
+        self.connect_timer.cancel()
+        error = ircsock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error:
+            ircsock.close()
+            self.connect_failed(socket.error(error, os.strerror(error)))
+            return
+        ircsock.setblocking(1)
+        self.attach(ircsock)
+        password = read_password() if settings.registered else None
+        self.negotiation = caps.Negotiation(self.send, settings.sasl_account or self.botnick, password)
+        self.negotiation.start()
+        register(self, self.botnick)  # Channels are joined once the server welcomes us (001)
+
+    def connect_timed_out(self, ircsock):
+        self.loop.remove_writer(ircsock)
+        ircsock.close()
+        self.connect_failed(socket.timeout('timed out'))
+
+    def connect_failed(self, ex):
+        log.warning('Could not connect to %s: %s', self.server, ex)
+        self.reconnect()
+
+    # Registration is over: identifies with NickServ if SASL didn't log us
+    # in, and joins the channels.
+    def registered(self):
+        self.failures = 0
+        password = read_password() if settings.registered else None
+        if password and not (self.negotiation and self.negotiation.authenticated):
+            identify(self, self.botnick, password)
+        join_channels(self, sorted(bot.channel for bot in self.bots.values()))
+        unsent, self.unsent = self.unsent, []
+        for line in unsent:  # Welcomes whose newcomers are already marked known
+            self.send(line)
+
+    # Starts answering whatever the server sends on this socket.
+    def attach(self, ircsock):
+        self.ircsock = ircsock
+        self.reader = ircio.LineReader(ircsock)
+        self.sendq = ircio.SendQueue(ircsock, settings.send_rate, settings.send_burst, clock=self.loop.time, loop=self.loop,
+                                     name=self.server)  # Everything we send goes through here
+        self.loop.add_reader(ircsock, self.read_messages)
+        self.last_heard = self.loop.time()
+        self.watchdog = self.loop.call_later(self.ping_interval, self.check_alive)
+
+    # Drops the connection and schedules the next attempt.  Messages still
+    # queued are kept for the next connection, as the newcomers they welcome
+    # have already been taken off the list; the registration and channel
+    # commands among them are sent afresh anyway.
+    def disconnect(self):
+        self.loop.remove_reader(self.ircsock)
+        self.unsent.extend(line for line in self.sendq.take_unsent()
+                           if line.startswith('PRIVMSG ') and not line.startswith('PRIVMSG NickServ '))
+        self.sendq.close()
+        self.watchdog.cancel()
+        self.ircsock.close()
+        self.ircsock = self.sendq = self.negotiation = None
+        self.names = {}
+        self.accounts.clear()  # Shared with the bots; logins are learnt afresh on rejoining
+        self.batches = {}
+        for bot in self.bots.values():
+            pause_newcomers(bot)
+        self.reconnect()
+
+    def reconnect(self):
+        delay = min(self.reconnect_max_delay, self.reconnect_delay * 2 ** self.failures)
+        delay *= random.uniform(0.5, 1.0)  # Jitter, so restarted servers aren't stampeded
+        self.failures += 1
+        log.info('Reconnecting to %s in %.0f seconds', self.server, delay)
+        self.loop.call_later(delay, self.connect)
+
+    # PINGs a server that has gone quiet, and gives up on one that stays quiet.
+    def check_alive(self):
+        quiet = self.loop.time() - self.last_heard
+        if quiet >= self.ping_timeout:
+            log.warning('No word from %s in %.0f seconds', self.server, quiet)
+            self.disconnect()
+            return
+        if quiet >= self.ping_interval:
+            self.send("PING :{}\n".format(self.server), urgent=True)  # Not stuck behind a backlog of welcomes
+            self.watchdog = self.loop.call_later(self.ping_timeout - quiet, self.check_alive)
+        else:
+            self.watchdog = self.loop.call_later(self.ping_interval - quiet, self.check_alive)
+
+    # What the Bots send through: the send queue, while there's a connection.
+    def send(self, line, urgent=False):
+        if self.sendq is not None:
+            self.sendq.send(line, urgent)
+
+    # Handles every line that has arrived.  A line that can't be handled is
+    # logged and skipped, so as not to lose the lines read along with it.
+    def read_messages(self):
+        try:
+            for ircmsg in msg_handler(self.reader): # gets messages from ircsock, one line at a time
+                self.last_heard = self.loop.time()
+                msg = ircparse.parse(ircmsg)  # parses it or returns None
+                if msg is not None: # If we were able to parse it
+                    metrics.registry.incr('lines_parsed', msg.command)
+                    try:
+                        self.dispatch(msg)
+                    except Exception:
+                        log.exception('Could not handle %r from %s', ircmsg, self.server)
+                else:
+                    metrics.registry.incr('lines_parsed', '(unparsable)')
+        except (ircio.ConnectionClosed, socket.error) as ex:
+            log.warning('Lost connection to %s: %r', self.server, ex)
+            self.disconnect()
+
+    # Hands a message to the Bot for its channel.  Messages that aren't about
+    # one channel (QUIT, NICK, ACCOUNT) go to every channel's Bot, and private
+    # messages go to the first channel's Bot, which answers the sender
+    # privately.  Messages in a batch wait for the end of it, and ones too
+    # short to make sense of are dropped.
+    def dispatch(self, msg):
+        command = msg.command
+        if len(msg.params) < min_params.get(command, 0) or (msg.nick is None and command in from_users):
+            log.debug('Ignoring malformed %r', msg)
+            return
+        if msg.tags:
+            ref = msg.tags.get('batch')
+            if ref in self.batches and command != 'BATCH':
+                self.batches[ref].messages.append(msg)
+                return
+            account = msg.tags.get('account')  # account-tag
+            if account is not None and msg.nick is not None:
+                self.accounts[msg.nick] = account
+
+        if command == 'PING':
+            pong(self, msg.text)
+        elif command in ('JOIN', 'PART', 'PRIVMSG'):
+            if command == 'JOIN' and len(msg.params) == 3:  # extended-join: channel, account, real name
+                self.note_account(msg.nick, msg.params[1])
+            bot = self.bots.get(msg.target.lower())
+            if bot is not None:
+                message_response(bot, msg, self, bot.channel, bot.channel_greeters)
+            elif command == 'PRIVMSG' and msg.target == self.botnick and self.bots:
+                bot = min(self.bots.values(), key=lambda b: b.channel)
+                message_response(bot, msg, self, msg.nick, bot.channel_greeters)
+            if command == 'PART':  # They may well be off out of sight; a JOIN or message will tell us again
+                self.accounts.pop(msg.nick, None)
+        elif command == 'BATCH':
+            self.on_batch(msg)
+        elif command == '001':  # Registered: the connection works
+            self.registered()
+        elif command == '353':  # NAMES reply: [me, type, channel, 'nick @nick +nick']
+            names = self.names.setdefault(msg.params[2].lower(), set())
+            names.update(name.lstrip('~&@%+').split('!')[0] for name in msg.text.split())
+        elif command == '366':  # End of NAMES: now we know who's here
+            channel = msg.params[1].lower()
+            if channel in self.bots:
+                resume_newcomers(self.bots[channel], self.names.pop(channel, ()), self)
+        elif command in caps.COMMANDS:
+            if self.negotiation is not None:
+                self.negotiation.handle(msg)
+        else:
+            if command == 'ACCOUNT':  # account-notify
+                self.note_account(msg.nick, msg.target)
+            for bot in self.bots.values():
+                message_response(bot, msg, self, bot.channel, bot.channel_greeters)
+            if command == 'QUIT':
+                self.accounts.pop(msg.nick, None)
+            elif command == 'NICK' and msg.nick in self.accounts:
+                self.accounts[msg.target] = self.accounts.pop(msg.nick)
+
+    def note_account(self, nick, account):
+        if account == '*':  # Not logged in, or just logged out
+            self.accounts.pop(nick, None)
+        else:
+            self.accounts[nick] = account
+
+    # BATCH +ref type params... opens a batch; BATCH -ref closes it, and its
+    # messages are handled together (see batch_handlers).  Batches of a type
+    # we don't know are handled message by message, as if never batched.
+    def on_batch(self, msg):
+        ref = msg.target or ''
+        if ref.startswith('+') and len(msg.params) > 1:
+            self.batches[ref[1:]] = Batch(msg.params[1], msg.params[2:])
+        elif ref.startswith('-'):
+            batch = self.batches.pop(ref[1:], None)
+            if batch is None:
+                return
+            metrics.registry.incr('batches', batch.kind)
+            handler = batch_handlers.get(batch.kind)
+            if handler is not None:
+                handler(self, batch)
+            else:
+                for message in batch.messages:
+                    self.dispatch(message)
+
 
 #########################
 ### Startup Functions ###
 #########################
 
-# Creates a socket that will be used to send and receive messages,
-# then connects the socket to an IRC server and joins the channel.
-def irc_start(server): # pragma: no cover  (this excludes this function from testing)
+# Creates a socket that will be used to send and receive messages, and
+# starts connecting it to an IRC server (an address: see resolve()) without
+# waiting.  It's connected once it becomes writable; see Network.connected().
+def irc_start(server, port=6667):
     ircsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    ircsock.connect((server, 6667))  # Here we connect to server using port 6667.
+    ircsock.setblocking(0)
+    error = ircsock.connect_ex((server, port))  # Here we connect to server using port 6667 by default.
+    if error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+        ircsock.close()
+        raise socket.error(error, os.strerror(error))
     return ircsock
 
-def join_irc(ircsock, botnick, channel):
+# Looks a server's name up.  Can take seconds, so Network.connect() calls it
+# on a thread of its own.
+def resolve(server, port=6667):
+    return socket.getaddrinfo(server, port, socket.AF_INET, socket.SOCK_STREAM)[0][4][0]
+
+# Opens the nick store chosen in bot_settings.py.  Given the event loop, the
+# compact store rewrites its file in the background.
+def open_nick_store(nick_source=settings.nick_source, loop=None):
+    if settings.nick_backend == 'compact':
+        return nickstore.CompactNickStore(settings.compact_nick_source, settings.nick_compact_every, loop)
+    if settings.nick_backend == 'sqlite':
+        return nickstore.SQLiteNickStore(settings.sqlite_nick_source, settings.nick_flush_every)
+    return nickstore.JournalNickStore(nick_source, settings.nick_compact_every)
+
+# Builds one Network per entry in settings.networks, with a Bot for each of
+# its channels.  Per-channel settings fall back to the global ones.
+def make_networks(loop, nick_store, networks=None, faq=None, activity=None):
+    result = []
+    for config in networks or settings.networks:
+        botnick = config.get('botnick', settings.botnick)
+        network = Network(loop, config['server'], botnick, config.get('port', 6667))
+        for channel, overrides in sorted(config['channels'].items()):
+            network.add_channel(Bot(
+                botnick=botnick,
+                channel=channel,
+                channel_greeters=overrides.get('channel_greeters', settings.channel_greeters),
+                welcome_message=overrides.get('welcome_message', settings.welcome_message),
+                wait_time=overrides.get('wait_time', settings.wait_time),
+                welcome_batch_window=overrides.get('welcome_batch_window', settings.welcome_batch_window),
+                welcome_batch_threshold=overrides.get('welcome_batch_threshold', settings.welcome_batch_threshold),
+                welcome_digest_message=overrides.get('welcome_digest_message', settings.welcome_digest_message),
+                rewelcome_after=overrides.get('rewelcome_after', settings.rewelcome_after),
+                nick_store=nick_store,
+                loop=loop,
+                faq=faq,
+                activity=activity,
+            ))
+        result.append(network)
+    return result
+
+# Registers with the server: USER, then NICK.
+def register(ircsock, botnick):
     ircsock.send("USER {0} {0} {0} :This is http://falcon.readthedocs.io/en/stable/"
                  "greeter bot"
              ".\n".format(botnick))  # bot authentication
     ircsock.send("NICK {}\n".format(botnick))  # Assign the nick to the bot.
-    if os.path.isfile("password.txt"):
-        with open("password.txt", 'r') as f:
-            password = f.read()
-            if registered == True:
-                ircsock.send("PRIVMSG {} {} {} {}".format("NickServ","IDENTIFY", botnick, password))
-    ircsock.send("JOIN {} \n".format(channel)) # Joins channel
-
-# Reads the messages from the server and adds them to the Queue and prints
-# them to the console. This function will be run in a thread, see below.
-def msg_handler(ircsock):  # pragma: no cover  (this excludes this function from testing)
-    new_msg = ircsock.recv(2048)  # receive data from the server
-    new_msg = new_msg.strip('\n\r')  # removing any unnecessary linebreaks
-    print(new_msg) #### Potentially make this a log instead?
-    return new_msg
-
-# Called by bot on startup.  Builds a regex that matches one of the options + (space) botnick.
-def get_regex(options, botnick):
-    pattern = "("
-    for s in options:
-        pattern += s
-        pattern += "|"
-    pattern = pattern[:-1]
-    pattern += ").({})".format(botnick)
-    return pattern
+
+# The bot's NickServ password, from password.txt, or None.
+def read_password(path="password.txt"):
+    if not os.path.isfile(path):
+        return None
+    with open(path, 'r') as f:
+        return f.read().strip() or None
+
+# Logs in with NickServ, for servers that don't offer SASL.
+def identify(ircsock, botnick, password):
+    ircsock.send("PRIVMSG NickServ :IDENTIFY {} {}\n".format(botnick, password))
+
+# Joins one channel, or a list of them (several per JOIN, as the line length allows).
+def join_channels(ircsock, channel):
+    if isinstance(channel, basestring):
+        channel = [channel]
+    while channel:
+        batch = [channel[0]]
+        for name in channel[1:]:
+            if len(",".join(batch + [name])) > 400:
+                break
+            batch.append(name)
+        channel = channel[len(batch):]
+        ircsock.send("JOIN {} \n".format(",".join(batch))) # Joins channel(s)
+
+# Registers, identifies and joins all in one go, without waiting to hear back
+# from the server.  Network.connect() does it properly, negotiating
+# capabilities first.
+def join_irc(ircsock, botnick, channel):
+    register(ircsock, botnick)
+    password = read_password() if settings.registered else None
+    if password:
+        identify(ircsock, botnick, password)
+    join_channels(ircsock, channel)
+
+# Reads from the server and yields each complete line received, logging
+# them at DEBUG level.
+def msg_handler(reader):
+    raw = log.isEnabledFor(logging.DEBUG)  # Checked once per read, not once per line
+    for new_msg in reader.read_lines():
+        if raw:
+            log.debug('<- %s', new_msg)
+        yield new_msg
 
 
 #########################
@@ -112,31 +646,150 @@ def get_regex(options, botnick):
 
 # Welcomes the "person" passed to it.
 def welcome_nick(bot, newcomer, ircsock, channel, channel_greeters):
-    welcome = bot.welcome_message.format(
-        newcomer=newcomer,
-        greeter_string=greeter_string(channel_greeters)
-    )
+    ircsock.send(bot.welcome_reply(channel, channel_greeters).render(newcomer))
+
+# Welcomes several newcomers at once, split over as many lines as it takes.
+# Each line is queued on its own, to count against the flood limit.
+def welcome_digest(bot, nicks, ircsock, channel, greeters):
+    names = greeter_string(nicks)
+    if bot.welcome_digest_message is None:
+        welcome = bot.welcome_message.format(newcomer=names, greeter_string=bot.cached_greeter_string(greeters))
+    else:
+        welcome = bot.welcome_digest_message.format(newcomers=names, greeter_string=bot.cached_greeter_string(greeters))
+    for line in split_message(welcome):
+        ircsock.send("PRIVMSG {0} :{1}\n".format(channel, line))
+
+# Arranges for process_newcomers to run when this newcomer has waited long
+# enough.  Without an event loop, main() has to call process_newcomers itself.
+def schedule_welcome(bot, newcomer, ircsock, channel, greeters):
+    if bot.loop is None:
+        return
+    if newcomer.timer is not None:
+        newcomer.timer.cancel()
+    newcomer.timer = bot.loop.call_at(newcomer.born + bot.wait_time,
+                                      process_newcomers, bot, ircsock, channel, greeters)
+
+# Cancels every pending welcome while the bot is disconnected.  The newcomers
+# themselves are kept, with their arrival times, for resume_newcomers().
+def pause_newcomers(bot):
+    for newcomer in bot.newcomers:
+        if newcomer.timer is not None:
+            newcomer.timer.cancel()
+            newcomer.timer = None
+    if bot.digest_timer is not None:
+        bot.digest_timer.cancel()
+        bot.digest_timer = None
+
+# Once the server has listed the nicks in a channel we (re)joined: forgets the
+# newcomers who left in the meantime and schedules welcomes for the rest.
+# Anyone whose wait ran out while we were away is welcomed straight away.
+def resume_newcomers(bot, names, ircsock):
+    names = set(names)
+    for newcomer in list(bot.newcomers):
+        if newcomer.nick in names:
+            schedule_welcome(bot, newcomer, ircsock, bot.channel, bot.channel_greeters)
+        else:
+            bot.newcomers.remove(newcomer.clean_nick)
 
-    command = "PRIVMSG {0} :{1}\n".format(channel, welcome)
-    ircsock.send(command)
+# Once known_nicks has loaded: forgets the newcomers restored from
+# pending_source who turn out to have been welcomed already, and schedules
+# again the welcomes that came due while the nicks were loading (see
+# process_newcomers).
+def recheck_newcomers(bot, ircsock):
+    for newcomer in list(bot.newcomers):
+        if bot.was_welcomed(newcomer):
+            bot.newcomers.remove(newcomer.clean_nick)
+        elif newcomer.timer is not None:
+            schedule_welcome(bot, newcomer, ircsock, bot.channel, bot.channel_greeters)
+
+# Once known_nicks has loaded: treats the JOINs held meanwhile as if they had
+# just arrived, except that each newcomer's wait still counts from their JOIN.
+def resolve_held_joins(bot, ircsock):
+    held, bot.held_joins = bot.held_joins, {}
+    for nick, joined in sorted(held.items(), key=lambda item: item[1]):
+        clean = clean_nick(nick)
+        if clean not in bot.newcomers and bot.is_new(nick, clean):
+            newcomer = bot.add_newcomer(nick, joined)
+            schedule_welcome(bot, newcomer, ircsock, bot.channel, bot.channel_greeters)
+        bot.record_activity(clean, bot.channel, joined=True)
 
 # Checks and manages the status of newcomers.
+#
+# With a welcome_batch_window, a newcomer coming due doesn't get welcomed
+# straight away: it opens a window of that many seconds, and whoever has come
+# due by the time it closes is welcomed together (see welcome_batch).  If
+# someone speaks in the meantime, they all expire unwelcomed as usual.
+#
+# Nobody is welcomed before known_nicks has loaded: newcomers restored from
+# pending_source may have been welcomed already (see recheck_newcomers).
 def process_newcomers(bot, ircsock, channel, greeters, welcome=1):
-    newcomers = [p for p in bot.newcomers if p.around_for() > bot.wait_time]
+    if welcome == 1 and not bot.known_nicks.loaded:
+        return
+    if welcome == 1 and bot.welcome_batch_window and bot.loop is not None:
+        if bot.digest_timer is None:
+            bot.digest_timer = bot.loop.call_later(bot.welcome_batch_window,
+                                                   welcome_batch, bot, ircsock, channel, greeters)
+        return
+
+    newcomers = bot.newcomers.pop_due(bot.now() - bot.wait_time)
     for person in newcomers:
         if welcome == 1:
             welcome_nick(bot, person.nick, ircsock, channel, greeters)
+            metrics.registry.incr('newcomers_welcomed')
+            bot.record_activity(person.clean_nick, channel, welcomed=True)
+        else:
+            metrics.registry.incr('newcomers_expired')
 
-        bot.add_known_nick(person.clean_nick)
-        bot.newcomers.remove(person)
+        bot.add_known(person)
 
-# Checks for messages.
-def parse_messages(ircmsg):
-    try:
-        actor = ircmsg.split(":")[1].split("!")[0] # and get the nick of the msg sender
-        return " ".join(ircmsg.split()), actor
-    except:
-        return None, None
+# Closes a batch window: welcomes everyone who came due during it, in one
+# digest if there are at least welcome_batch_threshold of them, or else one
+# by one.
+def welcome_batch(bot, ircsock, channel, greeters):
+    bot.digest_timer = None
+    newcomers = bot.newcomers.pop_due(bot.now() - bot.wait_time)
+    if len(newcomers) >= bot.welcome_batch_threshold:
+        welcome_digest(bot, [person.nick for person in newcomers], ircsock, channel, greeters)
+        metrics.registry.incr('welcome_digests')
+    else:
+        for person in newcomers:
+            welcome_nick(bot, person.nick, ircsock, channel, greeters)
+    for person in newcomers:
+        metrics.registry.incr('newcomers_welcomed')
+        bot.record_activity(person.clean_nick, channel, welcomed=True)
+        bot.add_known(person)
+
+# Splits text into pieces short enough for one PRIVMSG each, at spaces
+# where possible.
+def split_message(text, limit=MAX_MESSAGE):
+    lines = []
+    while len(text) > limit:
+        cut = text.rfind(' ', 0, limit + 1)
+        if cut <= 0:
+            cut = limit
+        lines.append(text[:cut])
+        text = text[cut:].lstrip(' ')
+    if text:
+        lines.append(text)
+    return lines
+
+# The fewest parameters each command needs to be handled, and the commands
+# that only make sense coming from someone (see Network.dispatch).
+min_params = {'JOIN': 1, 'PART': 1, 'PRIVMSG': 2, 'NICK': 1, 'ACCOUNT': 1, 'BATCH': 1, '353': 4, '366': 2}
+from_users = frozenset(['JOIN', 'PART', 'PRIVMSG', 'NICK', 'QUIT', 'ACCOUNT'])
+
+# Netsplit QUIT reasons: "hub.example.net leaf.example.net", or "*.net *.split"
+# on networks that hide their servers.
+netsplit_regex = re.compile(r'^[\w*-]+(\.[\w*-]+)+ [\w*-]+(\.[\w*-]+)+$')
+netsplit_reasons = {}  # QUIT reason -> whether it's a netsplit; a split's QUITs all share one
+
+def is_netsplit(reason):
+    split = netsplit_reasons.get(reason)
+    if split is None:
+        if len(netsplit_reasons) >= 1000:
+            netsplit_reasons.clear()
+        split = netsplit_reasons[reason] = netsplit_regex.match(reason) is not None
+    return split
 
 # Cleans a nickname of decorators/identifiers
 def clean_nick(nick):
@@ -146,53 +799,181 @@ def clean_nick(nick):
 
     return nick
 
-# Parses messages and respond to them appropriately.
-def message_response(bot, ircmsg, actor, ircsock, channel, greeters):
-    clean_actor = clean_nick(actor)
-    clean_newcomers = [i.clean_nick for i in bot.newcomers]
+# Responds appropriately to a message parsed by ircparse.parse().  Only the
+# handler for the message's own command runs.
+def message_response(bot, msg, ircsock, channel, greeters):
+    handler = message_handlers.get(msg.command)
+    if handler is not None:
+        start = time.time()
+        handler(bot, msg, ircsock, channel, greeters)
+        metrics.registry.observe('message_response', time.time() - start)
+
+# Someone spoke, either into a channel or to the bot directly.
+def on_privmsg(bot, msg, ircsock, channel, greeters):
+    actor = msg.nick
+    text = msg.text
 
     # if someone other than a newcomer speaks into the channel
-    if ircmsg.find("PRIVMSG " + channel) != -1 and clean_actor not in clean_newcomers:
-        process_newcomers(bot, ircsock, channel, greeters, welcome=0)   # Process/check newcomers without welcoming them
-
-    # if someone (other than the bot) joins the channel
-    if ircmsg.find("JOIN " + channel) != -1 and actor != bot.botnick:
-        if clean_actor not in bot.known_nicks and clean_actor not in clean_newcomers:
-            bot.add_newcomer(actor)
-
-    # if someone changes their nick while still in newcomers update that nick
-    if ircmsg.find("NICK :") != -1 and actor != bot.botnick:
-        for i in bot.newcomers: # if that person was in the newlist
-            if i.nick == actor:
-                i.nick = ircmsg.split(":")[2] # update to new nick (and clean up the nick)
-                i.clean_nick = clean_nick(i.nick)
-
-    # If someone parts or quits the #channel...
-    if ircmsg.find("PART " + channel) != -1 or ircmsg.find("QUIT") != -1:
-        for i in bot.newcomers:  # and that person is on the newlist
-            if clean_actor == i.clean_nick:
-                bot.newcomers.remove(i)   # remove them from the list
+    if msg.target.lower() == channel.lower():
+        clean_actor = clean_nick(actor)
+        bot.record_activity(clean_actor, channel)
+        if clean_actor not in bot.newcomers:
+            process_newcomers(bot, ircsock, channel, greeters, welcome=0)   # Process/check newcomers without welcoming them
 
     # If someone talks to (or refers to) the bot.
-    if bot.botnick.lower() and "PRIVMSG".lower() in ircmsg.lower():
-        if bot.hello_regex.search(ircmsg):
-            bot_hello(random.choice(settings.hello_list), actor, ircsock, channel)
-        elif bot.help_regex.search(ircmsg):
-            bot_help(ircsock, channel)
+    trigger = bot.triggers.match(text)
+    if trigger is not None:
+        keyword, response = trigger
+        if bot.cooldowns.ready(actor, response, channel):  # Not if it has only just answered
+            response(bot, keyword, actor, ircsock, channel)
 
     # If someone tries to change the wait time...
-    if ircmsg.find(bot.botnick + " --wait-time ") != -1:
-        bot.wait_time = wait_time_change(actor, ircmsg, ircsock, channel, greeters, bot)  # call this to check and change it
+    if text.find(bot.botnick + " --wait-time ") != -1:
+        bot.wait_time = wait_time_change(actor, text, ircsock, channel, greeters, bot)  # call this to check and change it
+        for newcomer in bot.newcomers:
+            schedule_welcome(bot, newcomer, ircsock, channel, greeters)  # Their wait just changed
+
+    # If someone asks after someone, or about the channel (as often as the
+    # triggers may answer)...
+    if bot.activity is not None:
+        if text.find(bot.botnick + " --seen ") != -1 and bot.cooldowns.ready(actor, bot_seen, channel):
+            bot_seen(bot, text, ircsock, channel)
+        if text.find(bot.botnick + " --stats") != -1 and bot.cooldowns.ready(actor, bot_stats, channel):
+            bot_stats(bot, ircsock, channel)
+
+# if someone (other than the bot) joins the channel
+def on_join(bot, msg, ircsock, channel, greeters):
+    actor = msg.nick
+    if msg.target.lower() == channel.lower() and actor != bot.botnick:
+        if actor in bot.netsplits:  # Back from a netsplit: not new
+            rejoin_after_split(bot, actor, ircsock, channel, greeters)
+            return
+        if not bot.known_nicks.loaded:  # Can't tell yet; see resolve_held_joins()
+            bot.held_joins[actor] = bot.now()
+            return
+        clean_actor = clean_nick(actor)
+        if clean_actor not in bot.newcomers and bot.is_new(actor, clean_actor):
+            newcomer = bot.add_newcomer(actor)
+            schedule_welcome(bot, newcomer, ircsock, channel, greeters)
+        bot.record_activity(clean_actor, channel, joined=True)  # After is_new(), which asks when they were last here
 
-    # If the server pings us then we've got to respond!
-    if ircmsg.find("PING :") != -1:
-        pong(ircsock, ircmsg)
+# if someone changes their nick while still in newcomers update that nick
+def on_nick(bot, msg, ircsock, channel, greeters):
+    if msg.nick != bot.botnick:
+        bot.newcomers.rename(msg.nick, msg.target)  # if that person was in the newlist
+        if msg.nick in bot.held_joins:
+            bot.held_joins[msg.target] = bot.held_joins.pop(msg.nick)
+
+# If someone parts the #channel...
+def on_part(bot, msg, ircsock, channel, greeters):
+    if msg.target.lower() == channel.lower():
+        clean_actor = clean_nick(msg.nick)
+        bot.newcomers.remove(clean_actor)   # and that person is on the newlist, remove them
+        bot.held_joins.pop(msg.nick, None)
+        bot.record_activity(clean_actor, channel)
+
+# ...or quits IRC altogether.
+# A QUIT whose reason is two server names is a netsplit, not a goodbye: the
+# user will most likely be back when the servers reconnect.  Until then
+# they're remembered (see Netsplits), so that their JOIN after the split is
+# recognised by nick alone, and a pending welcome picks up where it left off.
+def on_quit(bot, msg, ircsock, channel, greeters):
+    actor = msg.nick
+    clean_actor = clean_nick(actor)
+    newcomer = bot.newcomers.remove(clean_actor)
+    bot.held_joins.pop(actor, None)
+    bot.record_activity(clean_actor, None)  # Not in any one channel; every channel's Bot hears it
+    reason = msg.text
+    if is_netsplit(reason):
+        if actor not in bot.netsplits:  # The first of the network's channels to hear of it
+            bot.netsplits.add(actor, reason)
+        if newcomer is not None:
+            bot.split_newcomers[actor] = newcomer
+
+def rejoin_after_split(bot, nick, ircsock, channel, greeters):
+    metrics.registry.incr('netsplit_rejoins')
+    bot.record_activity(clean_nick(nick), channel)
+    newcomer = bot.split_newcomers.pop(nick, None)
+    if newcomer is not None and newcomer.clean_nick not in bot.newcomers:
+        schedule_welcome(bot, bot.newcomers.add(nick, newcomer.born), ircsock, channel, greeters)
+
+# Someone logged in (account-notify).  A newcomer whose account we know
+# turns out not to be new after all.
+def on_account(bot, msg, ircsock, channel, greeters):
+    account = msg.target
+    if account != '*' and account.lower() in bot.known_nicks:
+        bot.newcomers.remove(clean_nick(msg.nick))
+
+# If the server pings us then we've got to respond!
+def on_ping(bot, msg, ircsock, channel, greeters):
+    pong(ircsock, msg.text)
+
+message_handlers = {
+    'PRIVMSG': on_privmsg,
+    'JOIN': on_join,
+    'NICK': on_nick,
+    'PART': on_part,
+    'QUIT': on_quit,
+    'PING': on_ping,
+    'ACCOUNT': on_account,
+}
+
+# A netsplit batch: everyone lost in the split, all at once.  They're
+# recorded once for the network, then each channel drops its newcomers among
+# them in one pass.
+def on_netsplit_batch(network, batch):
+    reason = ' '.join(batch.params)
+    nicks = []
+    for msg in batch.messages:
+        if msg.command != 'QUIT':
+            network.dispatch(msg)
+            continue
+        nicks.append(msg.nick)
+        network.accounts.pop(msg.nick, None)
+        if msg.nick not in network.netsplits:
+            network.netsplits.add(msg.nick, reason)
+    for bot in network.bots.values():
+        start = time.time()
+        for nick in nicks:
+            clean = clean_nick(nick)
+            newcomer = bot.newcomers.remove(clean)
+            bot.held_joins.pop(nick, None)
+            bot.record_activity(clean, None)
+            if newcomer is not None:
+                bot.split_newcomers[nick] = newcomer
+        metrics.registry.observe('message_response', time.time() - start)
+
+# A netjoin batch: the split has healed and everyone is back.  The server
+# only sends a netjoin for users who were already on the network, so none of
+# them is a newcomer, whether or not we saw them leave.
+def on_netjoin_batch(network, batch):
+    for msg in batch.messages:
+        if msg.command != 'JOIN':
+            network.dispatch(msg)
+            continue
+        if len(msg.params) == 3:
+            network.note_account(msg.nick, msg.params[1])
+        bot = network.bots.get(msg.target.lower())
+        if bot is not None and msg.nick != bot.botnick:
+            rejoin_after_split(bot, msg.nick, network, bot.channel, bot.channel_greeters)
+
+batch_handlers = {
+    'netsplit': on_netsplit_batch,
+    'netjoin': on_netjoin_batch,
+}
 
 
 #############################################################
 ### Bot Response Functions (called by message_response()) ###
 #############################################################
 
+# Trigger responses: called with the keyword that matched.
+def on_hello(bot, keyword, actor, ircsock, channel):
+    bot_hello(random.choice(settings.hello_list), actor, ircsock, channel)
+
+def on_help(bot, keyword, actor, ircsock, channel):
+    bot_help(ircsock, channel)
+
 # Responds to a user that inputs "Hello Mybot".
 def bot_hello(greeting, actor, ircsock, channel):
     ircsock.send("PRIVMSG {0} :{1} {2}\n".format(channel, greeting, actor))
@@ -204,6 +985,32 @@ def bot_help(ircsock, channel):
                  "https://github.com/falconry/WelcomeBot"
                  ".\n".format(channel))
 
+# Answers "Mybot --seen somenick": when and where the bot last saw them.
+def bot_seen(bot, text, ircsock, channel):
+    found = re.search(r'--seen ([^\s,:;]+)', text)
+    if found is None:
+        return
+    nick = found.group(1)
+    seen = bot.activity.get(clean_nick(nick))
+    if seen is None:
+        ircsock.send("PRIVMSG {0} :I haven't seen {1}.\n".format(channel, nick))
+        return
+    now = bot.activity.clock()
+    where = " in {}".format(seen.channel) if seen.channel else ""
+    ircsock.send("PRIVMSG {0} :{1} was last seen{2} {3} (first seen {4}, joined {5} time{6}).\n".format(
+        channel, nick, where, activity.ago(now - seen.last_seen), activity.ago(now - seen.first_seen),
+        seen.joins, "" if seen.joins == 1 else "s"))
+
+# Answers "Mybot --stats": how many people the bot knows of, and how many
+# have been around lately.
+def bot_stats(bot, ircsock, channel):
+    now = bot.activity.clock()
+    ircsock.send("PRIVMSG {0} :I've seen {1} people: {2} in the last day and {3} in the last week, "
+                 "{4} of them for the first time.\n".format(
+                     channel, len(bot.activity), bot.activity.count_seen_since(now - activity.DAY),
+                     bot.activity.count_seen_since(now - activity.WEEK),
+                     bot.activity.count_new_since(now - activity.WEEK)))
+
 # Returns a grammatically correct string of the channel_greeters.
 def greeter_string(greeters):
     greeterstring = ""
@@ -221,8 +1028,10 @@ def greeter_string(greeters):
 def wait_time_change(actor, ircmsg, ircsock, channel, channel_greeters, bot):
     for admin in channel_greeters:
         if actor == admin:
-            finder = re.search(r'\d\d*', re.search(r'--wait-time \d\d*', ircmsg)
-                            .group())
+            found = re.search(r'--wait-time \d\d*', ircmsg)
+            if found is None:  # "--wait-time soon": nothing to change it to
+                return bot.wait_time
+            finder = re.search(r'\d\d*', found.group())
             ircsock.send("PRIVMSG {0} :{1} the wait time is changing to {2} "
                          "seconds.\n".format(channel, actor, finder.group()))
             new_wait_time = int(finder.group())
@@ -234,8 +1043,8 @@ def wait_time_change(actor, ircmsg, ircsock, channel, channel_greeters, bot):
     return unchanged_wait_time
 
 # Responds to server Pings.
-def pong(ircsock, ircmsg):
-    response = "PONG :" + ircmsg.split("PING :")[1] + "\n"
+def pong(ircsock, token):
+    response = "PONG :" + token + "\n"
     ircsock.send(response)
 
 
@@ -243,23 +1052,133 @@ def pong(ircsock, ircmsg):
 ### The main function. ###
 ##########################
 
-def main():
-    ircsock = irc_start(settings.server)
-    join_irc(ircsock, settings.botnick, settings.channel)
+# Writes every channel's pending newcomers (nick and arrival time) to a
+# file, so a restarted bot can still welcome them.
+def save_pending(path, networks):
+    pending = {}
+    for network in networks:
+        for bot in network.bots.values():
+            key = "{} {}".format(network.server, bot.channel)
+            pending[key] = [[i.nick, i.born] for i in bot.newcomers]
 
-    bot = Bot()
-    bot.load_nicks()
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as pending_file:
+        json.dump(pending, pending_file)
+    os.rename(tmp_path, path)
 
-    while 1:  # Loop forever
-        ready_to_read, b, c = select.select([ircsock],[],[], 1)  # b&c are ignored here
+# Reads back what save_pending() wrote.  Welcomes are scheduled once the
+# channel is joined (see resume_newcomers).
+def load_pending(path, networks):
+    if not os.path.isfile(path):
+        return
+    with open(path, 'r') as pending_file:
+        pending = json.load(pending_file)
+    for network in networks:
+        for bot in network.bots.values():
+            for nick, born in pending.get("{} {}".format(network.server, bot.channel), []):
+                bot.newcomers.add(nick, born)
 
-        process_newcomers(bot, ircsock, settings.channel, settings.channel_greeters)
+# Rereads the FAQ file if it has changed, and points every bot's triggers at
+# the new answers.
+def refresh_faq(faq, networks):
+    old_entries = faq.entries
+    if not faq.refresh():
+        return False
+    for network in networks:
+        for bot in network.bots.values():
+            for entry in old_entries:
+                bot.triggers.remove(entry.keywords, entry, compile=False)
+            for entry in faq.entries:
+                bot.triggers.add(entry.keywords, entry, compile=False)
+            bot.triggers.compile()
+    return True
 
-        if ready_to_read:
-            ircmsg = msg_handler(ircsock) # gets message from ircsock
-            ircmsg, actor = parse_messages(ircmsg)  # parses it or returns None
-            if ircmsg is not None: # If we were able to parse it
-                message_response(bot, ircmsg, actor, ircsock, settings.channel, settings.channel_greeters)  # Respond to the parsed message
+# Loads the nick store on a background thread, so that the bot can connect
+# and answer PINGs straight away.  JOINs that arrive in the meantime are held
+# (see on_join) and dealt with as soon as loading finishes.  If the nicks
+# can't be read, the bot stops: it would otherwise hold every JOIN forever,
+# and never save the nicks it met.
+def warm_up(loop, known_nicks, networks):
+    def finish(snapshot, started):
+        known_nicks.finish_load(snapshot)
+        log.info('Loaded %d known nicks in %.2f seconds', len(known_nicks), time.time() - started)
+        for network in networks:
+            for bot in network.bots.values():
+                recheck_newcomers(bot, network)
+                resolve_held_joins(bot, network)
+
+    def fail(exc_info):
+        log.critical('Could not load the known nicks; stopping', exc_info=exc_info)
+        loop.stop()
+
+    def read(started):
+        try:
+            snapshot = known_nicks.read_snapshot()
+        except Exception:
+            loop.call_soon_threadsafe(fail, sys.exc_info())
+        else:
+            loop.call_soon_threadsafe(finish, snapshot, started)
+
+    loader = threading.Thread(target=read, args=(time.time(),), name='nick loader')
+    loader.daemon = True
+    loader.start()
+    return loader
+
+# Runs the bot until killed -- or, given an event loop, until something
+# calls stop() on it (as the end-to-end tests do; see fakeircd.py).
+def main(loop=None):
+    botlog.setup(settings.log_level, settings.log_file)
+    if settings.metrics_port:
+        metrics.serve(settings.metrics_port)
+
+    if loop is None:
+        loop = eventloop.EventLoop()
+    known_nicks = open_nick_store(settings.nick_source, loop)  # Shared by every channel; loaded by warm_up()
+    history = activity.ActivityStore(settings.activity_source, settings.activity_max_pending)
+    history.open()
+    faq = faq_module.FAQ(settings.faq_source)
+    faq.refresh()
+
+    networks = make_networks(loop, known_nicks, faq=faq, activity=history)
+    load_pending(settings.pending_source, networks)
+    for network in networks:
+        network.connect()
+    warm_up(loop, known_nicks, networks)
+
+    def checkpoint():
+        save_pending(settings.pending_source, networks)
+        loop.call_later(settings.pending_save_interval, checkpoint)
+    loop.call_later(settings.pending_save_interval, checkpoint)
+
+    def flush_nicks():
+        if known_nicks.loaded:
+            known_nicks.flush()
+        loop.call_later(settings.nick_flush_interval, flush_nicks)
+    loop.call_later(settings.nick_flush_interval, flush_nicks)
+
+    def flush_activity():
+        history.flush()
+        loop.call_later(settings.activity_flush_interval, flush_activity)
+    loop.call_later(settings.activity_flush_interval, flush_activity)
+
+    def check_faq():
+        refresh_faq(faq, networks)
+        loop.call_later(settings.faq_reload_interval, check_faq)
+    loop.call_later(settings.faq_reload_interval, check_faq)
+
+    if settings.metrics_dump_path:
+        def dump_metrics():
+            metrics.dump(settings.metrics_dump_path)
+            loop.call_later(settings.metrics_dump_interval, dump_metrics)
+        loop.call_later(settings.metrics_dump_interval, dump_metrics)
+
+    try:
+        loop.run_forever()  # Networks reconnect by themselves; this runs until stopped
+    finally:
+        save_pending(settings.pending_source, networks)
+        if known_nicks.loaded:
+            known_nicks.save()  # Fold the journal into nicks.json on the way out
+        history.close()
 
 
 if __name__ == "__main__":
@@ -4,12 +4,47 @@
 channel = "#falconframework"
 botnick = "elaenor"
 server = "irc.freenode.net"
-registered = False
+registered = False  # If True, the bot logs in with the password in password.txt: by SASL, or else NickServ
+sasl_account = None  # The account to log in to; None: the bot's nick
+send_burst = 5  # Lines we may send back to back...
+send_rate = 0.5  # ...before slowing to this many lines per second
+connect_timeout = 30  # Seconds to wait for the server to accept a connection
+reconnect_delay = 5  # Seconds before the first reconnect; doubles on each failure...
+reconnect_max_delay = 300  # ...up to this
+ping_interval = 120  # PING the server after this many seconds without hearing from it...
+ping_timeout = 240  # ...and reconnect after this many
 
 # Bot behavior
 wait_time = 60
 channel_greeters = ["kgriffs", "jvrbanac"]
+welcome_batch_window = 0  # If > 0, newcomers coming due within this many seconds of each other...
+welcome_batch_threshold = 3  # ...are welcomed in one message, if there are at least this many
 nick_source = "/opt/WelcomeBot/nicks.json"
+nick_compact_every = 1000  # New nicks journaled before the nick file is rewritten
+nick_backend = "journal"  # Or "sqlite" (below), or "compact" for millions of nicks: a memory-mapped, sorted nick file...
+compact_nick_source = "/opt/WelcomeBot/nicks.db"  # ...kept here instead of nick_source
+sqlite_nick_source = "/opt/WelcomeBot/nicks.sqlite"  # For nick_backend = "sqlite", which several processes can share
+nick_flush_every = 100  # sqlite: new nicks are written in batches of this many...
+nick_flush_interval = 5  # ...or every this many seconds
+shard_workers = 1  # Processes to split the channels between; see shard.py
+pending_source = "/opt/WelcomeBot/pending.json"  # Newcomers still to be welcomed, across restarts
+pending_save_interval = 60
+activity_source = "/opt/WelcomeBot/activity.sqlite"  # When each person was first and last seen; see activity.py
+activity_max_pending = 1000  # People whose activity is held in memory before it's written out...
+activity_flush_interval = 10  # ...or every this many seconds
+rewelcome_after = 180 * 24 * 3600  # Welcome known people again after this many seconds away; None: never
+netsplit_memory = 3600  # Seconds to wait for people lost in a netsplit to rejoin
+faq_source = "/opt/WelcomeBot/faq.json"  # Canned answers; see faq.py.  Reloaded when it changes...
+faq_reload_interval = 10  # ...checked this often
+trigger_user_cooldown = 300  # Seconds before the bot answers the same person the same way again...
+trigger_channel_cooldown = 30  # ...or anyone in the same channel
+
+# Logging and metrics
+log_level = "info"  # "debug" also logs every line from the server; "off" logs nothing
+log_file = None  # Log to this file instead of stderr
+metrics_port = None  # Serve Prometheus metrics on http://127.0.0.1:<port>/metrics
+metrics_dump_path = None  # And/or write them to this file...
+metrics_dump_interval = 60  # ...every this many seconds
 
 # Bot text
 hello_list = ["hello", "hi", "hey", "yo", "sup"]
@@ -22,3 +57,21 @@ welcome_message = ("Welcome {newcomer}! The channel is pretty quiet "
                    "a while, try visiting our discussion group at "
                    "https://groups.google.com/d/forum/falconframework "
                    "or just try coming back later.")
+welcome_digest_message = None  # For batched welcomes, with {newcomers}; None: welcome_message naming them all
+
+# Channels to serve, and where.  One process can serve several networks and
+# any number of channels on each; a channel's settings may override
+# wait_time, channel_greeters, welcome_message, rewelcome_after and the
+# welcome_batch_* and welcome_digest_message settings above.  Known nicks are
+# shared by all of them.
+networks = [
+    {
+        'server': server,
+        'port': 6667,
+        'botnick': botnick,
+        'channels': {
+            channel: {},
+            # '#falcon-dev': {'wait_time': 120, 'channel_greeters': ['kgriffs']},
+        },
+    },
+]
@@ -0,0 +1,81 @@
+# Logging for WelcomeBot.  See bot.py for the bot itself.
+#
+# The bot logs through the standard logging module, under the 'welcomebot'
+# logger, at a level chosen in bot_settings.py: 'debug' logs every line from
+# the server, 'info' only connections and the like, and 'off' nothing.
+# Records are written out on a background thread, so a slow terminal or disk
+# never holds up the event loop; if the writer falls too far behind, records
+# are dropped (and counted) rather than making the bot wait.
+
+import logging, sys, threading, Queue
+
+log = logging.getLogger('welcomebot')
+log.addHandler(logging.NullHandler())  # Quiet until setup() is called
+
+LEVELS = {
+    'debug': logging.DEBUG,
+    'info': logging.INFO,
+    'warning': logging.WARNING,
+    'error': logging.ERROR,
+    'off': logging.CRITICAL + 1,
+}
+
+
+#########################
+### Class Definitions ###
+#########################
+
+# Queues records for another handler, which handles them on its own thread.
+class AsyncHandler(logging.Handler):
+
+    def __init__(self, target, max_queued=10000):
+        logging.Handler.__init__(self)
+        self.target = target
+        self.queue = Queue.Queue(max_queued)
+        self.dropped = 0
+        self.writer = threading.Thread(target=self._write, name='log writer')
+        self.writer.daemon = True
+        self.writer.start()
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+
+    def _write(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                return
+            self.target.handle(record)
+
+    # Writes out whatever is still queued, then stops the writer.
+    def close(self):
+        self.queue.put(None)
+        self.writer.join()
+        self.target.close()
+        logging.Handler.close(self)
+
+
+#################
+### Functions ###
+#################
+
+# Sends the bot's log to `path` (or stderr) at the given level, replacing
+# whatever was set up before.  Returns the AsyncHandler, if any.
+def setup(level='info', path=None):
+    for handler in log.handlers[:]:
+        log.removeHandler(handler)
+        handler.close()
+    log.propagate = False
+    log.setLevel(LEVELS[level])
+    if level == 'off':
+        log.addHandler(logging.NullHandler())
+        return None
+
+    target = logging.FileHandler(path) if path else logging.StreamHandler(sys.stderr)
+    target.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+    handler = AsyncHandler(target)
+    log.addHandler(handler)
+    return handler
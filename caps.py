@@ -0,0 +1,110 @@
+# IRCv3 capability negotiation for WelcomeBot.  See bot.py for the bot itself.
+#
+# Before registering, the bot asks the server which capabilities it offers
+# (CAP LS) and requests the ones it can use:
+#
+#   extended-join   JOINs carry the user's account name (or * if none)
+#   account-notify  ACCOUNT tells us when someone logs in or out
+#   account-tag     Every message carries its sender's account as a tag
+#   batch           Netsplits and netjoins arrive bracketed as one BATCH
+#   sasl            Logs the bot in (SASL PLAIN) before it even has a nick
+#
+# Servers that know nothing of CAP just ignore it and register us as before;
+# servers that do hold registration until CAP END, which is always sent once
+# negotiation (and SASL, if any) is over, whatever the outcome.
+
+import base64
+
+from botlog import log
+
+WANTED = ('account-notify', 'account-tag', 'batch', 'extended-join', 'sasl')
+SASL_CHUNK = 400  # AUTHENTICATE payloads are sent in pieces of this many bytes
+SASL_FAILED = ('902', '904', '905', '906', '908')  # Locked, failed, too long, aborted, wrong mechanism
+COMMANDS = frozenset(('CAP', 'AUTHENTICATE', '903') + SASL_FAILED)  # What Negotiation.handle() deals with
+
+
+#########################
+### Class Definitions ###
+#########################
+
+# One connection's negotiation.  `send` writes a line to the server; SASL is
+# attempted only given a password.
+class Negotiation(object):
+
+    def __init__(self, send, account=None, password=None, wanted=WANTED):
+        self.send = send
+        self.account = account
+        self.password = password
+        self.wanted = wanted
+        self.offered = {}  # Capability -> its value ('' if none), from CAP LS
+        self.enabled = set()  # Acknowledged by the server
+        self.authenticated = False  # SASL succeeded
+        self.done = False  # CAP END sent
+
+    def start(self):
+        self.send("CAP LS 302\n")
+
+    # Handles a CAP, AUTHENTICATE or SASL reply (one of COMMANDS).  Returns
+    # False for any other message, so the caller can deal with it.
+    def handle(self, msg):
+        command = msg.command
+        if command == 'CAP':
+            self.on_cap(msg.params[1].upper() if len(msg.params) > 1 else '', msg.params)
+        elif command == 'AUTHENTICATE':
+            if msg.text == '+':
+                self.send_credentials()
+        elif command == '903':  # SASL succeeded
+            self.authenticated = True
+            log.info('Logged in as %s', self.account)
+            self.end()
+        elif command in SASL_FAILED:
+            log.warning('SASL login as %s failed: %s', self.account, msg.text)
+            self.end()
+        else:
+            return False
+        return True
+
+    def on_cap(self, subcommand, params):
+        if subcommand == 'LS':
+            for cap in params[-1].split():
+                name, _, value = cap.partition('=')
+                self.offered[name] = value
+            if params[2:3] != ['*']:  # '*' means more LS lines follow
+                self.request()
+        elif subcommand == 'ACK':
+            self.enabled.update(cap.lstrip('~=') for cap in params[-1].split() if not cap.startswith('-'))
+            if 'sasl' in self.enabled and not self.done:
+                self.send("AUTHENTICATE PLAIN\n")
+            else:
+                self.end()
+        elif subcommand == 'NAK':
+            log.warning('Server refused capabilities: %s', params[-1])
+            self.end()
+        elif subcommand == 'DEL':  # cap-notify: the server withdrew these
+            self.enabled.difference_update(params[-1].split())
+
+    # Requests whichever of the wanted capabilities the server offers.
+    def request(self):
+        wanted = [cap for cap in self.wanted if cap in self.offered]
+        if 'sasl' in wanted and not (self.password and self.sasl_plain_offered()):
+            wanted.remove('sasl')
+        if wanted:
+            self.send("CAP REQ :{}\n".format(' '.join(wanted)))
+        else:
+            self.end()
+
+    def sasl_plain_offered(self):
+        mechanisms = self.offered.get('sasl')
+        return not mechanisms or 'PLAIN' in mechanisms.upper().split(',')  # No list: assume PLAIN
+
+    def send_credentials(self):
+        payload = base64.b64encode('\0'.join([self.account, self.account, self.password]))
+        for start in range(0, len(payload), SASL_CHUNK):
+            self.send("AUTHENTICATE {}\n".format(payload[start:start + SASL_CHUNK]))
+        if len(payload) % SASL_CHUNK == 0:  # Including empty: the server waits for a short piece
+            self.send("AUTHENTICATE +\n")
+
+    def end(self):
+        if not self.done:
+            self.done = True
+            self.send("CAP END\n")
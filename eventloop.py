@@ -0,0 +1,134 @@
+# A small select()-based event loop for WelcomeBot.  See bot.py for the bot itself.
+
+# The bot still runs on Python 2.7, so asyncio isn't available; this offers
+# the handful of asyncio.AbstractEventLoop methods the bot needs, under the
+# same names.  The loop sleeps until a socket is ready or the next timer is
+# due, so an idle bot doesn't wake up at all.  As in asyncio, an exception in
+# a callback is logged and the loop carries on: one bad message mustn't stop
+# every network the process serves.
+
+import heapq, itertools, os, select, time
+from collections import deque
+
+from botlog import log
+
+
+#########################
+### Class Definitions ###
+#########################
+
+# A callback scheduled with call_later/call_at.
+class Timer(object):
+    __slots__ = ('when', 'callback', 'args', 'cancelled')
+
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class EventLoop(object):
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.timers = []  # Heap of (when, tie-breaker, Timer)
+        self.counter = itertools.count()
+        self.readers = {}  # socket -> (callback, args)
+        self.writers = {}
+        self.running = False
+        self.from_threads = deque()  # Callbacks handed over by call_soon_threadsafe
+        self.waker = os.pipe()  # Written to wake select() up for them
+        self.add_reader(self.waker[0], self._woken)
+
+    def time(self):
+        return self.clock()
+
+    def call_at(self, when, callback, *args):
+        timer = Timer(when, callback, args)
+        heapq.heappush(self.timers, (when, next(self.counter), timer))
+        return timer
+
+    def call_later(self, delay, callback, *args):
+        return self.call_at(self.clock() + delay, callback, *args)
+
+    def call_soon(self, callback, *args):
+        return self.call_at(self.clock(), callback, *args)
+
+    # The one method that may be called from another thread: runs the callback
+    # on the loop's own thread, as soon as it gets to it.
+    def call_soon_threadsafe(self, callback, *args):
+        self.from_threads.append((callback, args))
+        os.write(self.waker[1], 'x')
+
+    def _woken(self):
+        os.read(self.waker[0], 4096)
+        while self.from_threads:
+            callback, args = self.from_threads.popleft()
+            self._run(callback, args)
+
+    def add_reader(self, sock, callback, *args):
+        self.readers[sock] = (callback, args)
+
+    def remove_reader(self, sock):
+        return self.readers.pop(sock, None) is not None
+
+    def add_writer(self, sock, callback, *args):
+        self.writers[sock] = (callback, args)
+
+    def remove_writer(self, sock):
+        return self.writers.pop(sock, None) is not None
+
+    # Seconds until the next live timer is due, or None if there are none.
+    def next_timer(self):
+        while self.timers and self.timers[0][2].cancelled:
+            heapq.heappop(self.timers)
+        if not self.timers:
+            return None
+        return max(0, self.timers[0][0] - self.clock())
+
+    # Waits for I/O or the next timer (or `timeout` seconds), then runs
+    # whatever became ready.
+    def run_once(self, timeout=None):
+        wait = self.next_timer()
+        if wait is not None and (timeout is None or wait < timeout):
+            timeout = wait
+
+        readable, writable, errored = select.select(list(self.readers), list(self.writers), [], timeout)
+
+        for sock in readable:
+            if sock in self.readers:  # An earlier callback may have removed it
+                callback, args = self.readers[sock]
+                self._run(callback, args)
+        for sock in writable:
+            if sock in self.writers:
+                callback, args = self.writers[sock]
+                self._run(callback, args)
+
+        now = self.clock()
+        while self.timers and self.timers[0][0] <= now:
+            when, count, timer = heapq.heappop(self.timers)
+            if not timer.cancelled:
+                self._run(timer.callback, timer.args)
+
+    def _run(self, callback, args):
+        try:
+            callback(*args)
+        except Exception:
+            log.exception('Unhandled exception in %r', callback)
+
+    def run_forever(self):
+        self.running = True
+        while self.running:
+            self.run_once()
+
+    def stop(self):
+        self.running = False
+
+    def close(self):
+        self.remove_reader(self.waker[0])
+        os.close(self.waker[0])
+        os.close(self.waker[1])
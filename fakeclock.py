@@ -0,0 +1,13 @@
+# A clock for testing WelcomeBot, which stands still until a test moves it.
+# See bot.py for the bot itself.
+#
+# Pass one wherever the code takes a clock (the event loop, the send queue,
+# the activity history, cooldowns) and set `now` to move time along.
+
+class fake_clock(object):
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
@@ -0,0 +1,324 @@
+# A stand-in IRC server for testing WelcomeBot end to end.  See bot.py for
+# the bot itself, and loadgen.py for putting it under load.
+#
+# It speaks just enough of the protocol for the bot: registration (NICK and
+# USER; CAP LS offers nothing), JOIN with a NAMES reply, PART, QUIT, NICK,
+# PRIVMSG to channels and to nicks, and PING/PONG.  Besides clients on real
+# sockets it can host virtual ones, which live only inside the server: a
+# thousand users cost a thousand small objects, not a thousand sockets.
+#
+# Like a real server it holds socket clients to the flood limits of RFC 1459
+# (section 8.10): each line costs two seconds, up to ten seconds ahead of the
+# clock, and lines beyond that wait their turn.  A client that gets
+# `max_recvq` lines behind is disconnected for Excess Flood.
+#
+# The server runs its own event loop, on a thread of its own (start/stop),
+# or in the foreground:
+#
+#   python fakeircd.py [port]
+
+import socket, sys, threading, time
+from collections import deque
+
+import eventloop, ircio, ircparse
+
+SERVER_NAME = 'irc.fake.test'
+
+
+#########################
+### Class Definitions ###
+#########################
+
+# One user: on a socket, or virtual (sock is None).
+class Client(object):
+
+    def __init__(self, server, sock=None):
+        self.server = server
+        self.sock = sock
+        self.reader = ircio.LineReader(sock) if sock is not None else None
+        self.nick = None
+        self.user = None
+        self.registered = False
+        self.channels = set()  # Lower-cased names
+        self.pending = deque()  # Lines read but held back by flood control
+        self.penalty = 0.0  # The RFC 1459 message timer
+        self.lines_heard = 0  # Lines the server sent this client
+
+    @property
+    def prefix(self):
+        return '{}!{}@fake.test'.format(self.nick, self.user or self.nick)
+
+    def send(self, line):
+        self.lines_heard += 1
+        if self.sock is not None:
+            try:
+                self.sock.sendall(line + '\r\n')
+            except socket.error:
+                pass  # Gone; the read side will notice
+
+    # Has a virtual client send a line, as if over a socket (but never held
+    # back by flood control).
+    def say(self, line):
+        self.server.handle(self, line)
+
+
+class FakeIRCd(object):
+
+    def __init__(self, port=0, host='127.0.0.1', flood_burst=10, flood_cost=2, max_recvq=100):
+        self.loop = eventloop.EventLoop()
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((host, port))
+        self.listener.listen(16)
+        self.port = self.listener.getsockname()[1]
+        self.loop.add_reader(self.listener, self.accept)
+
+        self.flood_burst = flood_burst  # Seconds of penalty a client may run ahead
+        self.flood_cost = flood_cost  # Seconds of penalty per line
+        self.max_recvq = max_recvq  # Held-back lines before Excess Flood
+        self.clients = set()
+        self.nicks = {}  # Lower-cased nick -> Client
+        self.channels = {}  # Lower-cased channel name -> set of Clients
+        self.privmsgs = []  # (sender's nick, target, text) for every PRIVMSG relayed
+        self.flood_kills = []  # Nicks disconnected for flooding
+        self.thread = None
+
+    ### Running ###
+
+    def start(self):
+        self.thread = threading.Thread(target=self.loop.run_forever, name='fakeircd')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        for client in list(self.clients):
+            if client.sock is not None:
+                self.drop(client)
+        self.loop.remove_reader(self.listener)
+        self.listener.close()
+        self.loop.close()
+
+    # Runs fn(*args) on the server's thread and returns what it returns.
+    # Everything that touches the server from outside should go through here.
+    def run(self, fn, *args):
+        if self.thread is None or threading.current_thread() is self.thread:
+            return fn(*args)
+        done = threading.Event()
+        result = []
+        def call():
+            try:
+                result.append(fn(*args))
+            finally:
+                done.set()
+        self.loop.call_soon_threadsafe(call)
+        done.wait()
+        return result[0] if result else None
+
+    ### Clients ###
+
+    def accept(self):
+        sock, address = self.listener.accept()
+        client = Client(self, sock)
+        self.clients.add(client)
+        self.loop.add_reader(sock, self.read, client)
+
+    # A registered virtual client.  Call on the server's thread (see run()).
+    def connect_virtual(self, nick, user=None):
+        client = Client(self)
+        self.clients.add(client)
+        client.say('NICK {}'.format(nick))
+        client.say('USER {} 0 * :Virtual user'.format(user or nick))
+        return client
+
+    def read(self, client):
+        try:
+            for line in client.reader.read_lines():
+                client.pending.append(line)
+        except (ircio.ConnectionClosed, socket.error):
+            self.quit(client, 'Connection closed')
+            return
+        if len(client.pending) > self.max_recvq:
+            self.flood_kills.append(client.nick)
+            client.send('ERROR :Closing Link: (Excess Flood)')
+            self.quit(client, 'Excess Flood')
+            return
+        self.pump(client)
+
+    # Handles a socket client's held-back lines as fast as flood control
+    # allows, and comes back for the rest when it allows more.
+    def pump(self, client):
+        now = self.loop.time()
+        while client.pending and client in self.clients:
+            client.penalty = max(client.penalty, now)
+            if client.penalty - now >= self.flood_burst:
+                self.loop.call_at(client.penalty - self.flood_burst, self.pump, client)
+                return
+            client.penalty += self.flood_cost
+            self.handle(client, client.pending.popleft())
+
+    def drop(self, client):
+        self.clients.discard(client)
+        if client.nick is not None and self.nicks.get(client.nick.lower()) is client:
+            del self.nicks[client.nick.lower()]
+        for channel in client.channels:
+            members = self.channels.get(channel)
+            if members is not None:
+                members.discard(client)
+                if not members:
+                    del self.channels[channel]
+        client.channels = set()
+        if client.sock is not None:
+            self.loop.remove_reader(client.sock)
+            client.sock.close()
+
+    # Everyone who shares a channel with the client.
+    def peers(self, client):
+        peers = set()
+        for channel in client.channels:
+            peers.update(self.channels.get(channel, ()))
+        peers.discard(client)
+        return peers
+
+    def members(self, channel):
+        return self.channels.get(channel.lower(), set())
+
+    def reply(self, client, numeric, text):
+        client.send(':{} {} {} {}'.format(SERVER_NAME, numeric, client.nick or '*', text))
+
+    ### Commands ###
+
+    def handle(self, client, line):
+        msg = ircparse.parse(line)
+        if msg is None:
+            return
+        handler = getattr(self, 'on_' + msg.command.lower(), None)
+        if handler is None:
+            self.reply(client, '421', '{} :Unknown command'.format(msg.command))
+        elif not client.registered and msg.command not in ('CAP', 'NICK', 'USER', 'PING', 'PONG', 'QUIT'):
+            self.reply(client, '451', ':You have not registered')
+        else:
+            handler(client, msg)
+
+    def on_cap(self, client, msg):
+        subcommand = msg.params[0].upper() if msg.params else ''
+        if subcommand == 'LS':
+            client.send(':{} CAP * LS :'.format(SERVER_NAME))
+        elif subcommand == 'REQ':
+            client.send(':{} CAP * NAK :{}'.format(SERVER_NAME, msg.text))
+
+    def on_nick(self, client, msg):
+        if not msg.params:
+            self.reply(client, '431', ':No nickname given')
+            return
+        nick = msg.params[0]
+        holder = self.nicks.get(nick.lower())
+        if holder is not None and holder is not client:
+            self.reply(client, '433', '{} :Nickname is already in use'.format(nick))
+            return
+        if client.registered:
+            line = ':{} NICK :{}'.format(client.prefix, nick)
+            for peer in self.peers(client) | set([client]):
+                peer.send(line)
+        if client.nick is not None:
+            self.nicks.pop(client.nick.lower(), None)
+        client.nick = nick
+        self.nicks[nick.lower()] = client
+        self.welcome(client)
+
+    def on_user(self, client, msg):
+        if msg.params:
+            client.user = msg.params[0]
+        self.welcome(client)
+
+    def welcome(self, client):
+        if client.registered or client.nick is None or client.user is None:
+            return
+        client.registered = True
+        self.reply(client, '001', ':Welcome to the fake IRC network, {}'.format(client.prefix))
+        self.reply(client, '422', ':MOTD File is missing')
+
+    def on_join(self, client, msg):
+        for channel in msg.target.split(',') if msg.params else ():
+            key = channel.lower()
+            if key in client.channels or not channel.startswith('#'):
+                continue
+            members = self.channels.setdefault(key, set())
+            members.add(client)
+            client.channels.add(key)
+            line = ':{} JOIN {}'.format(client.prefix, channel)
+            for member in members:
+                member.send(line)
+            names = sorted(member.nick for member in members)
+            for start in range(0, len(names), 50):
+                self.reply(client, '353', '= {} :{}'.format(channel, ' '.join(names[start:start + 50])))
+            self.reply(client, '366', '{} :End of /NAMES list.'.format(channel))
+
+    def on_part(self, client, msg):
+        for channel in msg.target.split(',') if msg.params else ():
+            key = channel.lower()
+            if key not in client.channels:
+                continue
+            line = ':{} PART {}'.format(client.prefix, channel)
+            for member in self.channels[key]:
+                member.send(line)
+            self.channels[key].discard(client)
+            if not self.channels[key]:
+                del self.channels[key]
+            client.channels.discard(key)
+
+    def on_quit(self, client, msg):
+        self.quit(client, 'Quit: ' + msg.text if msg.params else 'Quit')
+
+    def quit(self, client, reason):
+        if client not in self.clients:
+            return
+        if client.registered:
+            line = ':{} QUIT :{}'.format(client.prefix, reason)
+            for peer in self.peers(client):
+                peer.send(line)
+        self.drop(client)
+
+    def on_privmsg(self, client, msg):
+        if len(msg.params) < 2:
+            self.reply(client, '412', ':No text to send')
+            return
+        target, text = msg.params[0], msg.text
+        line = ':{} PRIVMSG {} :{}'.format(client.prefix, target, text)
+        if target.startswith('#'):
+            recipients = self.members(target) - set([client])
+        else:
+            recipient = self.nicks.get(target.lower())
+            if recipient is None:
+                self.reply(client, '401', '{} :No such nick/channel'.format(target))
+                return
+            recipients = [recipient]
+        self.privmsgs.append((client.nick, target, text))
+        for recipient in recipients:
+            recipient.send(line)
+
+    def on_ping(self, client, msg):
+        client.send(':{0} PONG {0} :{1}'.format(SERVER_NAME, msg.text))
+
+    def on_pong(self, client, msg):
+        pass
+
+
+#################
+### Functions ###
+#################
+
+def main(argv=sys.argv[1:]):
+    server = FakeIRCd(int(argv[0]) if argv else 6667)
+    print('Fake IRC server listening on 127.0.0.1:{}'.format(server.port))
+    try:
+        server.loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,163 @@
+# Canned answers for WelcomeBot.  See bot.py for the bot itself.
+#
+# The FAQ file maps a name to the keywords that trigger it and its answer:
+#
+#   {
+#       "install": {
+#           "keywords": ["install", "pip"],
+#           "answer": "{nick}: pip install falcon, then see {channel}'s topic."
+#       }
+#   }
+#
+# The answer may be a list of lines.  Besides {nick} (who asked) it can use
+# {channel}, {botnick} and {greeter_string}.  Asking works like the greeting:
+# "install elaenor".  The file is watched and reloaded when it changes.
+#
+# Answers are rendered once per channel and kept, with only the asker's nick
+# left to fill in; the same goes for the welcome message (see Reply).  And
+# Cooldowns keep one person, or one busy channel, from setting the bot off
+# over and over.
+
+import json, os, time
+
+from botlog import log
+
+NICK = '\0'  # Stands in for the nick in a rendered Reply; can't occur in IRC text
+MAX_CACHED = 1000  # Rendered replies kept per entry (one per channel or private chat)
+
+
+#########################
+### Class Definitions ###
+#########################
+
+# A message template with everything but one field (the nick) filled in.
+class Reply(object):
+    __slots__ = ('parts',)
+
+    def __init__(self, template, nick_field, **values):
+        values[nick_field] = NICK
+        self.parts = template.format(**values).split(NICK)
+
+    def render(self, nick):
+        return nick.join(self.parts)
+
+
+# One question the bot can answer.  Triggered like the bot's own responses
+# (see triggers.py), by being called.
+class Entry(object):
+    __slots__ = ('name', 'keywords', 'lines', 'replies')
+
+    def __init__(self, name, keywords, lines):
+        self.name = name
+        self.keywords = keywords
+        self.lines = lines
+        self.replies = {}  # (channel, botnick, greeter string) -> [Reply for each line]
+
+    # The PRIVMSG lines answering in `channel`, ready for the nick.  Each is
+    # sent on its own, so that each counts against the flood limit.
+    def reply(self, channel, botnick, greeters):
+        key = (channel, botnick, greeters)
+        reply = self.replies.get(key)
+        if reply is None:
+            if len(self.replies) >= MAX_CACHED:
+                self.replies.clear()
+            reply = self.replies[key] = [Reply('PRIVMSG {channel} :' + line + '\n', 'nick', channel=channel,
+                                               botnick=botnick, greeter_string=greeters)
+                                         for line in self.lines]
+        return reply
+
+    def __call__(self, bot, keyword, actor, ircsock, channel):
+        for line in self.reply(channel, bot.botnick, bot.cached_greeter_string(bot.channel_greeters)):
+            ircsock.send(line.render(actor))
+
+    def __repr__(self):
+        return 'Entry({!r})'.format(self.name)
+
+
+# The FAQ file and the entries read from it.
+class FAQ(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = []
+        self.mtime = None
+
+    # Reads the file again if it has changed (or appeared, or gone) since it
+    # was last read.  Returns True if the entries changed.  A file that
+    # doesn't parse is reported and otherwise ignored, so a half-saved edit
+    # leaves the old answers in place.
+    def refresh(self):
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            mtime = None
+        if mtime == self.mtime:
+            return False
+
+        try:
+            entries = read_faq(self.path) if mtime is not None else []
+        except (IOError, ValueError, KeyError, TypeError) as ex:
+            log.warning('Could not load %s: %s', self.path, ex)
+            return False
+        self.mtime = mtime
+        self.entries = entries
+        log.info('Loaded %d FAQ entries from %s', len(entries), self.path)
+        return True
+
+
+# Remembers when each trigger last fired, for each person and each channel.
+# A trigger stays quiet for `per_user` seconds after the same person set it
+# off, and for `per_channel` seconds after anyone did in the same channel.
+class Cooldowns(object):
+
+    def __init__(self, per_user=300, per_channel=30, clock=time.time):
+        self.per_user = per_user
+        self.per_channel = per_channel
+        self.clock = clock
+        self.users = {}  # (lower-cased nick, trigger) -> when it last fired
+        self.channels = {}  # (lower-cased channel, trigger) -> when it last fired
+
+    # Returns whether `trigger` may fire for `nick` in `channel` now, and if
+    # so counts it as having fired.
+    def ready(self, nick, trigger, channel):
+        now = self.clock()
+        user_key = (nick.lower(), trigger)
+        channel_key = (channel.lower(), trigger)
+        if now - self.users.get(user_key, now - self.per_user) < self.per_user:
+            return False
+        if now - self.channels.get(channel_key, now - self.per_channel) < self.per_channel:
+            return False
+        if len(self.users) > 10000:
+            self.prune(now)
+        self.users[user_key] = now
+        self.channels[channel_key] = now
+        return True
+
+    def prune(self, now):
+        for times, cooldown in ((self.users, self.per_user), (self.channels, self.per_channel)):
+            for key, fired in list(times.items()):
+                if now - fired >= cooldown:
+                    del times[key]
+
+
+#################
+### Functions ###
+#################
+
+# Reads a FAQ file into a list of Entries, in name order.
+def read_faq(path):
+    with open(path) as faq_file:
+        config = json.load(faq_file)
+    entries = []
+    for name, entry in sorted(config.items()):
+        answer = entry['answer']
+        lines = [answer] if isinstance(answer, basestring) else list(answer)
+        keywords = [keyword.encode('utf-8') for keyword in entry.get('keywords', [name])]
+        lines = [line.encode('utf-8') for line in lines]
+        for line in lines:  # Catch bad templates now, not when someone asks
+            try:
+                Reply(line, 'nick', channel='', botnick='', greeter_string='')
+            except (KeyError, IndexError, ValueError) as ex:
+                raise ValueError('answer to {!r} has a bad template: {!r}'.format(name, ex))
+        entries.append(Entry(name.encode('utf-8'), keywords, lines))
+    return entries
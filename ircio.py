@@ -0,0 +1,184 @@
+# Socket input/output helpers for WelcomeBot.  See bot.py for the bot itself.
+
+import time
+from collections import deque
+
+import metrics
+
+#########################
+### Class Definitions ###
+#########################
+
+# Raised when the server closes the connection.
+class ConnectionClosed(Exception):
+    pass
+
+
+# Frames the byte stream coming from the server into IRC lines.  One recv can
+# hold several lines, or only part of one; the partial tail is kept until the
+# rest of it arrives.
+class LineReader(object):
+
+    def __init__(self, sock, bufsize=65536, max_line=8192):
+        self.sock = sock
+        self.bufsize = bufsize
+        self.max_line = max_line  # 512 bytes plus room for IRCv3 message tags
+        self.buffer = ''
+
+    # Reads once from the socket and yields every complete line, without its CRLF.
+    def read_lines(self):
+        data = self.sock.recv(self.bufsize)
+        if not data:
+            raise ConnectionClosed()
+
+        lines = (self.buffer + data).split('\n')
+        self.buffer = lines.pop()  # '' if data ended on a line break
+        if len(self.buffer) > self.max_line:  # No line break in sight; drop the junk
+            self.buffer = ''
+
+        for line in lines:
+            line = line.rstrip('\r')
+            if line:
+                yield line
+
+
+# Outbound lines.  The bot functions call send() exactly as they would on the
+# socket; lines are queued and written by flush().  Given an event loop, the
+# queue flushes itself whenever lines are due and the socket is writable.
+# A token bucket keeps the bot under the server's flood limits: up to `burst`
+# lines go out at once, after which lines trickle out at `rate` per second.
+# PONGs skip the queue (and the limit) so a backlog of welcomes can never get
+# the bot pinged out.  The queue's depth (labelled with `name`) and how long
+# lines wait in it go to the metrics registry.
+class SendQueue(object):
+
+    def __init__(self, sock, rate=0.5, burst=5, clock=time.time, loop=None, name=None):
+        self.sock = sock
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.loop = loop
+        self.tokens = float(burst)
+        self.refilled = clock()
+        self.urgent = deque()  # (queued at, line)
+        self.normal = deque()
+        self.waiting = False  # Watching for writability
+        self.timer = None  # Waiting for the bucket to refill
+
+        # Metrics
+        self.max_depth = 0
+        self.lines_sent = 0
+        self.bytes_sent = 0
+        self.writes = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def __len__(self):
+        return len(self.urgent) + len(self.normal)
+
+    # Queues a line.  PONGs, and anything else sent as urgent (the bot's own
+    # keepalive PINGs), skip ahead of the flood limit.
+    def send(self, line, urgent=False):
+        if urgent or line.startswith('PONG'):
+            self.urgent.append((self.clock(), line))
+        else:
+            self.normal.append((self.clock(), line))
+        self.max_depth = max(self.max_depth, len(self))
+        metrics.registry.set('send_queue_depth', len(self), self.name)
+        self._schedule()
+
+    # Seconds until flush() would write something, or None if the queue is empty.
+    def next_flush(self):
+        if self.urgent:
+            return 0
+        if self.normal:
+            self._refill()
+            return max(0, (1 - self.tokens) / self.rate)
+        return None
+
+    # Writes every line the flood limit allows, as one sendall.
+    def flush(self):
+        self._refill()
+        batch = list(self.urgent)
+        self.urgent.clear()
+        while self.normal and self.tokens >= 1:
+            batch.append(self.normal.popleft())
+            self.tokens -= 1
+        if not batch:
+            return 0
+
+        data = ''.join(line for queued, line in batch)
+        self.sock.sendall(data)
+
+        now = self.clock()
+        for queued, line in batch:
+            self.latency_total += now - queued
+            self.latency_max = max(self.latency_max, now - queued)
+            metrics.registry.observe('send_latency', now - queued)
+        metrics.registry.set('send_queue_depth', len(self), self.name)
+        self.lines_sent += len(batch)
+        self.bytes_sent += len(data)
+        self.writes += 1
+        metrics.registry.incr('lines_sent', n=len(batch))
+        metrics.registry.incr('bytes_sent', n=len(data))
+        metrics.registry.incr('writes')
+        return len(batch)
+
+    def stats(self):
+        return {
+            'depth': len(self),
+            'max_depth': self.max_depth,
+            'lines_sent': self.lines_sent,
+            'bytes_sent': self.bytes_sent,
+            'writes': self.writes,
+            'latency_avg': self.latency_total / self.lines_sent if self.lines_sent else 0.0,
+            'latency_max': self.latency_max,
+        }
+
+    # Returns the lines still waiting for the flood limit, and forgets them.
+    def take_unsent(self):
+        unsent = [line for queued, line in self.normal]
+        self.normal.clear()
+        return unsent
+
+    # Stops flushing; the socket is going away.
+    def close(self):
+        metrics.registry.set('send_queue_depth', 0, self.name)
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.waiting:
+            self.loop.remove_writer(self.sock)
+            self.waiting = False
+
+    # Asks the loop to call flush() as soon as a line is due and the socket can take it.
+    def _schedule(self):
+        if self.loop is None or self.waiting:
+            return
+        wait = self.next_flush()
+        if wait is None:
+            return
+        if wait == 0:
+            if self.timer is not None:  # A PONG can't wait for the bucket
+                self.timer.cancel()
+                self.timer = None
+            self.waiting = True
+            self.loop.add_writer(self.sock, self._writable)
+        elif self.timer is None:
+            self.timer = self.loop.call_later(wait, self._refilled)
+
+    def _refilled(self):
+        self.timer = None
+        self._schedule()
+
+    def _writable(self):
+        self.loop.remove_writer(self.sock)
+        self.waiting = False
+        self.flush()
+        self._schedule()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.refilled) * self.rate)
+        self.refilled = now
@@ -0,0 +1,90 @@
+# IRC message parsing for WelcomeBot.  See bot.py for the bot itself.
+
+# Lines look like (RFC 1459, plus IRCv3 message tags):
+#   [@tag=value;tag2 ][:nick!user@host ]COMMAND [param ...][ :trailing param]
+
+import re
+
+
+#########################
+### Class Definitions ###
+#########################
+
+# One parsed line from the server.
+class Message(object):
+    __slots__ = ('tags', 'prefix', 'nick', 'command', 'params', 'trailing')
+
+    def __init__(self, tags, prefix, nick, command, params, trailing):
+        self.tags = tags  # {} when the line has none
+        self.prefix = prefix  # 'nick!user@host' or a server name; None if absent
+        self.nick = nick  # The nick part of the prefix
+        self.command = command  # Upper-cased, e.g. 'PRIVMSG' or '001'
+        self.params = params  # All parameters, the trailing one included
+        self.trailing = trailing  # The ':'-introduced last parameter, or None
+
+    # The first parameter: the channel or nick for JOIN/PART/PRIVMSG.
+    @property
+    def target(self):
+        return self.params[0] if self.params else None
+
+    # The last parameter: message text for PRIVMSG, reason for PART/QUIT.
+    @property
+    def text(self):
+        return self.params[-1] if self.params else ''
+
+    def __repr__(self):
+        return 'Message({!r}, {!r}, {!r})'.format(self.prefix, self.command, self.params)
+
+
+##########################
+### Parsing Functions ###
+##########################
+
+TAG_ESCAPES = {':': ';', 's': ' ', '\\': '\\', 'r': '\r', 'n': '\n'}
+tag_escape_regex = re.compile(r'\\(.?)')
+
+# Parses one line (without its CRLF), or returns None if there's no command.
+def parse(line):
+    tags = {}
+    if line.startswith('@'):
+        space = line.find(' ')
+        if space == -1:
+            return None
+        tags = parse_tags(line[1:space])
+        line = line[space + 1:].lstrip(' ')
+
+    prefix = nick = None
+    if line.startswith(':'):
+        space = line.find(' ')
+        if space == -1:
+            return None
+        prefix = line[1:space]
+        nick = prefix.split('!', 1)[0].split('@', 1)[0]
+        line = line[space + 1:]
+
+    trailing = None
+    colon = line.find(' :')
+    if colon != -1:
+        trailing = line[colon + 2:]
+        line = line[:colon]
+
+    params = line.split()
+    if not params:
+        return None
+    command = params.pop(0).upper()
+    if trailing is not None:
+        params.append(trailing)
+
+    return Message(tags, prefix, nick, command, params, trailing)
+
+# Parses 'a=1;b;c=x\sy' into {'a': '1', 'b': '', 'c': 'x y'}.
+def parse_tags(raw):
+    tags = {}
+    for tag in raw.split(';'):
+        if not tag:
+            continue
+        key, _, value = tag.partition('=')
+        if '\\' in value:
+            value = tag_escape_regex.sub(lambda m: TAG_ESCAPES.get(m.group(1), m.group(1)), value)
+        tags[key] = value
+    return tags
@@ -0,0 +1,213 @@
+# A load generator for WelcomeBot.  See bot.py for the bot itself.
+#
+# Starts a fake IRC server (fakeircd.py), connects the real bot to it through
+# bot.main(), and then has thousands of simulated users join the bot's
+# channel, chat, change nick and leave.  Afterwards it reports what the bot
+# did -- newcomers seen, welcomed and expired, lines sent and how fast -- and
+# whether the server had to cut it off for flooding.
+#
+#   python loadgen.py [--clients 2000] [--join-rate 100] [--chat-rate 20]
+#                     [--wait-time 5] [--batch-window 0] [--duration 30]
+#
+# A join storm shows the bot's flood limit at work: welcomes are counted as
+# they're queued, but go out no faster than send_rate allows.  Compare the
+# welcomes counted with the channel messages actually sent, with and without
+# a --batch-window (see welcome_batch_window in bot_settings.py).
+#
+# Everything runs in this one process: the server and its users on one
+# thread, the bot on another.  The users are fakeircd's virtual clients, so
+# there is no limit on how many.
+
+import argparse, os, random, shutil, sys, tempfile, threading, time
+
+import bot as botcode
+import bot_settings as settings
+import eventloop, fakeircd, metrics
+
+BOTNICK = 'elaenor'
+CHANNEL = '#loadtest'
+
+
+#########################
+### Class Definitions ###
+#########################
+
+# Drives the server's virtual clients: `clients` users join over time at
+# `join_rate` per second, while those already in the channel say something
+# `chat_rate` times a second between them (and now and then change nick or
+# leave).  Runs on the server's thread; see start().
+class LoadGenerator(object):
+
+    def __init__(self, server, channel=CHANNEL, clients=1000, join_rate=50, chat_rate=10,
+                 leave_rate=1, tick=0.1, rng=None):
+        self.server = server
+        self.channel = channel
+        self.clients = clients
+        self.join_rate = join_rate
+        self.chat_rate = chat_rate
+        self.leave_rate = leave_rate
+        self.tick = tick
+        self.rng = rng or random.Random(0)
+        self.present = []  # Virtual clients in the channel
+        self.joined = 0
+        self.said = 0
+        self.stopped = False
+        self.debt = {}  # Action -> fraction of an action carried over to the next tick
+
+    def start(self):
+        self.server.run(self.server.loop.call_soon, self.step)
+
+    def stop(self):
+        self.stopped = True
+
+    # How many times to do something `rate` times a second, this tick.
+    def due(self, action, rate):
+        owed = self.debt.get(action, 0.0) + rate * self.tick
+        count = int(owed)
+        self.debt[action] = owed - count
+        return count
+
+    def step(self):
+        if self.stopped:
+            return
+        for i in range(min(self.due('join', self.join_rate), self.clients - self.joined)):
+            client = self.server.connect_virtual(user_nick(self.joined))
+            client.say('JOIN {}'.format(self.channel))
+            self.present.append(client)
+            self.joined += 1
+        if self.present:
+            for i in range(self.due('chat', self.chat_rate)):
+                self.rng.choice(self.present).say('PRIVMSG {} :{}'.format(self.channel, self.chatter()))
+                self.said += 1
+            for i in range(self.due('leave', self.leave_rate)):
+                client = self.present[self.rng.randrange(len(self.present))]
+                if self.rng.random() < 0.5:
+                    client.say('NICK {}_away'.format(client.nick))
+                else:
+                    self.present.remove(client)
+                    client.say('QUIT :bye')
+        self.server.loop.call_later(self.tick, self.step)
+
+    def chatter(self):
+        return ' '.join(self.rng.choice(['so', 'falcon', 'hooks', 'route', 'thanks', 'why', 'does', 'it'])
+                        for i in range(self.rng.randint(2, 10)))
+
+
+#################
+### Functions ###
+#################
+
+# A distinct nick for each number: 'user' and letters, since the bot's
+# clean_nick() would strip digits and make them all 'user'.
+def user_nick(number):
+    letters = ''
+    while True:
+        number, digit = divmod(number, 26)
+        letters = 'abcdefghijklmnopqrstuvwxyz'[digit] + letters
+        if not number:
+            return 'user' + letters
+
+# Points bot_settings at the server (and at a scratch directory for the
+# bot's files).  Returns the old values, for restore_settings().
+def configure_bot(port, workdir, wait_time=settings.wait_time, batch_window=0, channel=CHANNEL):
+    changes = {
+        'networks': [{'server': '127.0.0.1', 'port': port, 'botnick': BOTNICK,
+                      'channels': {channel: {'wait_time': wait_time, 'welcome_batch_window': batch_window}}}],
+        'nick_source': os.path.join(workdir, 'nicks.json'),
+        'compact_nick_source': os.path.join(workdir, 'nicks.db'),
+        'pending_source': os.path.join(workdir, 'pending.json'),
+        'activity_source': os.path.join(workdir, 'activity.sqlite'),
+        'faq_source': os.path.join(workdir, 'faq.json'),
+        'registered': False,
+        'log_level': 'warning',
+        'log_file': None,
+        'metrics_port': None,
+        'metrics_dump_path': None,
+    }
+    old = dict((name, getattr(settings, name)) for name in changes)
+    for name, value in changes.items():
+        setattr(settings, name, value)
+    return old
+
+def restore_settings(old):
+    for name, value in old.items():
+        setattr(settings, name, value)
+
+# Runs bot.main() on a thread of its own.  Returns the thread and the loop;
+# stop_bot() stops them.
+def start_bot():
+    loop = eventloop.EventLoop()
+    thread = threading.Thread(target=botcode.main, kwargs={'loop': loop}, name='bot')
+    thread.daemon = True
+    thread.start()
+    return thread, loop
+
+def stop_bot(thread, loop):
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.close()
+
+# Waits up to `timeout` seconds for condition() to come true.
+def wait_for(condition, timeout=10, interval=0.01):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(interval)
+    return condition()
+
+# What the bot has sent into the channel, from the server's records.
+def bot_messages(server, channel=CHANNEL):
+    return server.run(lambda: [text for nick, target, text in server.privmsgs
+                               if nick == BOTNICK and target == channel])
+
+def run(clients, join_rate, chat_rate, wait_time, batch_window, duration):
+    workdir = tempfile.mkdtemp()
+    server = fakeircd.FakeIRCd()
+    server.start()
+    old_settings = configure_bot(server.port, workdir, wait_time, batch_window)
+    thread, loop = start_bot()
+    try:
+        if not wait_for(lambda: server.run(lambda: BOTNICK in [c.nick for c in server.members(CHANNEL)])):
+            raise SystemExit('The bot never joined {}'.format(CHANNEL))
+        load = LoadGenerator(server, clients=clients, join_rate=join_rate, chat_rate=chat_rate)
+        start = time.time()
+        load.start()
+        time.sleep(duration)
+        server.run(load.stop)
+        time.sleep(wait_time + batch_window + 1)  # Let the last newcomers come due
+        elapsed = time.time() - start
+    finally:
+        stop_bot(thread, loop)
+        restore_settings(old_settings)
+        server.stop()
+        shutil.rmtree(workdir)
+
+    sent = bot_messages(server)
+    count = metrics.registry.count
+    timer = metrics.registry.timers.get('message_response', [0, 0.0, 0.0])
+    print('{} users joined and said {} things in {:.0f} seconds'.format(load.joined, load.said, elapsed))
+    print('Newcomers: {} added, {} welcomed ({} digests), {} expired'.format(
+        count('newcomers_added'), count('newcomers_welcomed'), count('welcome_digests'), count('newcomers_expired')))
+    print('Bot sent {} channel messages, {} lines in all ({:.1f} per second)'.format(
+        len(sent), count('lines_sent'), count('lines_sent') / elapsed))
+    if timer[0]:
+        print('Message handling: {} messages, {:.1f} us on average, {:.0f} us at most'.format(
+            timer[0], timer[1] / timer[0] * 1e6, timer[2] * 1e6))
+    print('Flood kills: {}'.format(', '.join(server.flood_kills) or 'none'))
+    return 1 if BOTNICK in server.flood_kills else 0
+
+def main(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description='Load-test WelcomeBot against a fake IRC server.')
+    parser.add_argument('--clients', type=int, default=2000, help='users to join over the run')
+    parser.add_argument('--join-rate', type=float, default=100, help='joins per second')
+    parser.add_argument('--chat-rate', type=float, default=20, help='channel messages per second')
+    parser.add_argument('--wait-time', type=float, default=5, help="the bot's wait_time, in seconds")
+    parser.add_argument('--batch-window', type=float, default=0, help="the bot's welcome_batch_window")
+    parser.add_argument('--duration', type=float, default=30, help='seconds of load')
+    args = parser.parse_args(argv)
+    return run(args.clients, args.join_rate, args.chat_rate, args.wait_time, args.batch_window, args.duration)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,159 @@
+# Counters and timings for WelcomeBot.  See bot.py for the bot itself.
+#
+# The bot counts as it goes (lines received per command, newcomers added,
+# welcomed and expired, lines and bytes sent) and times its busiest
+# functions.  Everything lands in one Registry, which renders itself in the
+# Prometheus text format: served over HTTP by serve(), or written to a file
+# every so often by dump().  Counting is a dict update, cheap enough for
+# every line the bot handles.
+
+import BaseHTTPServer, os, threading
+
+PREFIX = 'welcomebot'
+
+# What each metric means, and the name of its label (if it has one).
+DESCRIPTIONS = {
+    'lines_parsed': ('IRC lines received, by command', 'command'),
+    'newcomers_added': ('Newcomers seen joining', None),
+    'newcomers_welcomed': ('Newcomers welcomed by the bot', None),
+    'newcomers_expired': ('Newcomers whose wait ran out after someone else had spoken', None),
+    'welcome_digests': ('Batched welcomes, each greeting several newcomers', None),
+    'rewelcomes': ('Known people welcomed again after a long absence', None),
+    'netsplits': ('Netsplits seen (per network)', None),
+    'netsplit_rejoins': ('JOINs recognised as returns from a netsplit', None),
+    'batches': ('Batches of messages received, by type', 'type'),
+    'lines_sent': ('IRC lines written to the server', None),
+    'bytes_sent': ('Bytes written to the server', None),
+    'writes': ('Socket writes (each can carry several lines)', None),
+    'message_response': ('Time spent handling one message', None),
+    'send_queue_depth': ('Lines waiting to be sent, by server', 'server'),
+    'send_latency': ('Time a line waits in the send queue', None),
+    'save_nicks': ('Time spent writing a nick snapshot', None),
+    'save_activity': ('Time spent writing out activity history', None),
+}
+
+
+#########################
+### Class Definitions ###
+#########################
+
+class Registry(object):
+
+    def __init__(self, prefix=PREFIX):
+        self.prefix = prefix
+        self.counters = {}  # (name, label value) -> count
+        self.timers = {}  # name -> [count, total seconds, longest]
+        self.gauges = {}  # (name, label value) -> current value
+
+    def incr(self, name, label=None, n=1):
+        key = (name, label)
+        self.counters[key] = self.counters.get(key, 0) + n
+
+    def observe(self, name, seconds):
+        timer = self.timers.get(name)
+        if timer is None:
+            timer = self.timers[name] = [0, 0.0, 0.0]
+        timer[0] += 1
+        timer[1] += seconds
+        if seconds > timer[2]:
+            timer[2] = seconds
+
+    def set(self, name, value, label=None):
+        self.gauges[(name, label)] = value
+
+    def count(self, name, label=None):
+        return self.counters.get((name, label), 0)
+
+    def gauge(self, name, label=None):
+        return self.gauges.get((name, label), 0)
+
+    # Returns the Prometheus text exposition of everything counted so far.
+    # Safe to call from another thread: it works from copies.
+    def render(self):
+        lines = []
+        by_name = {}
+        for (name, label), value in self.counters.items():
+            by_name.setdefault(name, []).append((label, value))
+        for name in sorted(by_name):
+            help_text, label_name = DESCRIPTIONS.get(name, (name, 'label'))
+            metric = '{}_{}_total'.format(self.prefix, name)
+            lines.append('# HELP {} {}'.format(metric, help_text))
+            lines.append('# TYPE {} counter'.format(metric))
+            for label, value in sorted(by_name[name]):
+                if label is None:
+                    lines.append('{} {}'.format(metric, value))
+                else:
+                    lines.append('{}{{{}="{}"}} {}'.format(metric, label_name, escape(label), value))
+
+        by_name = {}
+        for (name, label), value in self.gauges.items():
+            by_name.setdefault(name, []).append((label, value))
+        for name in sorted(by_name):
+            help_text, label_name = DESCRIPTIONS.get(name, (name, 'label'))
+            metric = '{}_{}'.format(self.prefix, name)
+            lines.append('# HELP {} {}'.format(metric, help_text))
+            lines.append('# TYPE {} gauge'.format(metric))
+            for label, value in sorted(by_name[name]):
+                if label is None:
+                    lines.append('{} {}'.format(metric, value))
+                else:
+                    lines.append('{}{{{}="{}"}} {}'.format(metric, label_name, escape(label), value))
+
+        for name, (count, total, longest) in sorted(self.timers.items()):
+            metric = '{}_{}_seconds'.format(self.prefix, name)
+            lines.append('# HELP {} {}'.format(metric, DESCRIPTIONS.get(name, (name,))[0]))
+            lines.append('# TYPE {} summary'.format(metric))
+            lines.append('{}_count {}'.format(metric, count))
+            lines.append('{}_sum {:.6f}'.format(metric, total))
+            lines.append('# TYPE {}_max gauge'.format(metric))
+            lines.append('{}_max {:.6f}'.format(metric, longest))
+        return '\n'.join(lines) + '\n'
+
+
+# Answers GET /metrics with the registry's exposition.
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.registry.render()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Scrapes every few seconds would drown out the bot's own log
+
+
+# The registry the bot uses.
+registry = Registry()
+
+
+#################
+### Functions ###
+#################
+
+def escape(label):
+    return str(label).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+# Serves the registry on http://host:port/metrics from a background thread.
+# Binds to localhost unless told otherwise.  Returns the server; call
+# shutdown() on it to stop.
+def serve(port, host='127.0.0.1', registry=registry):
+    server = BaseHTTPServer.HTTPServer((host, port), MetricsHandler)
+    server.registry = registry
+    thread = threading.Thread(target=server.serve_forever, name='metrics server')
+    thread.daemon = True
+    thread.start()
+    return server
+
+# Writes the registry's exposition to a file, atomically, for the node
+# exporter's textfile collector or anyone who wants to look.
+def dump(path, registry=registry):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as dump_file:
+        dump_file.write(registry.render())
+    os.rename(tmp_path, path)
@@ -0,0 +1,565 @@
+# Known-nick storage for WelcomeBot.  See bot.py for the bot itself.
+
+# The bot only ever adds nicks, so rather than rewriting the whole nick file
+# every time someone is welcomed we append each new nick to a journal next to
+# the nick file, and fold the journal back into the nick file ("compaction")
+# once it has grown long enough.  The nick file keeps the original
+# {"nicks": [...]} format, so an existing nicks.json can be used as-is.
+
+import array, hashlib, json, mmap, os, shutil, sqlite3, struct, sys, threading, time
+
+import metrics
+from botlog import log
+
+
+#########################
+### Class Definitions ###
+#########################
+
+# An in-memory set of known (cleaned) nicks.  This is the interface the bot
+# uses; subclasses add persistence by overriding read_snapshot/finish_load,
+# save and _record.  Nicks are kept as UTF-8 byte strings, as they come off
+# the socket: JSON hands back unicode, which mustn't end up alongside them.
+#
+# Loading comes in two halves so that it can happen in the background:
+# read_snapshot() does the slow part and may run on another thread, as it
+# doesn't touch the store; finish_load() then merges its result in on the
+# bot's own thread.  Until that has happened, `loaded` is False.
+class NickStore(object):
+
+    def __init__(self):
+        self.nicks = set()
+        self.loaded = True  # Nothing to load
+
+    def __contains__(self, nick):
+        return encode_nick(nick) in self.nicks
+
+    def __iter__(self):
+        return iter(self.nicks)
+
+    def __len__(self):
+        return len(self.nicks)
+
+    def add(self, nick):
+        """Add a nick, returning False if it was already known."""
+        nick = encode_nick(nick)
+        if nick in self.nicks:
+            return False
+        self.nicks.add(nick)
+        self._record(nick)
+        return True
+
+    def update(self, nicks):
+        """Add many nicks at once, writing them out in a single snapshot."""
+        self.nicks.update(encode_nick(nick) for nick in nicks)
+        self.save()
+
+    def load(self):
+        self.finish_load(self.read_snapshot())
+
+    def read_snapshot(self):
+        return None
+
+    def finish_load(self, snapshot):
+        self.loaded = True
+
+    def save(self):
+        pass
+
+    # Writes out whatever add() has buffered.  Only stores that buffer need
+    # this; the bot calls it every nick_flush_interval seconds.
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    def _record(self, nick):
+        pass
+
+
+# Nick store backed by a snapshot file plus an append-only journal.
+class JournalNickStore(NickStore):
+
+    def __init__(self, path, compact_every=1000):
+        super(JournalNickStore, self).__init__()
+        self.path = path
+        self.journal_path = path + '.journal'
+        self.compact_every = compact_every  # journal entries before compacting
+        self.journal_size = 0
+        self._journal = None
+        self.loaded = False
+
+    # Reads the snapshot, streaming it rather than parsing it in one go.
+    def read_snapshot(self):
+        if not os.path.isfile(self.path):
+            log.warning('%s not found; no nicks loaded', self.path)
+            return set()
+        return set(encode_nick(nick) for nick in iter_nick_file(self.path))
+
+    # Takes in the snapshot, then replays whatever was journaled after it.
+    def finish_load(self, snapshot):
+        snapshot.update(self.nicks)  # Anything added while the snapshot was read
+        self.nicks = snapshot
+
+        journaled = [encode_nick(nick) for nick in read_journal(self.journal_path)]
+        self.nicks.update(journaled)
+        self.journal_size = len(journaled)
+        self.loaded = True
+
+    # Compacts the journal into a fresh snapshot.
+    def save(self):
+        start = time.time()
+        write_nick_file(self.path, self.nicks)
+        metrics.registry.observe('save_nicks', time.time() - start)
+        self.close()
+        open(self.journal_path, 'w').close()  # Snapshot is safe; empty the journal
+        self.journal_size = 0
+
+    def close(self):
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+    def _record(self, nick):
+        if self._journal is None:
+            self._journal = open(self.journal_path, 'a')
+        self._journal.write(json.dumps(nick) + '\n')
+        self._journal.flush()
+        self.journal_size += 1
+
+        if self.journal_size >= self.compact_every and self.loaded:  # Never compact a half-loaded store
+            self.save()
+
+
+# Nick store for very large nick lists.  The nicks live in a sorted file that
+# is memory-mapped rather than read, so startup costs next to nothing and the
+# nicks take no Python memory; lookups binary-search the file.  A Bloom filter
+# stored in the same file answers most lookups for unknown nicks (i.e. real
+# newcomers) without a search.  New nicks are journaled and kept in a small
+# set until the next compaction merges them into a fresh file.
+#
+# Compaction rewrites the whole file, so it waits until the journal holds
+# GROWTH of the file's nicks (or compact_every, if that's more), and, given
+# an event loop, runs on a thread of its own.  The journal is set aside for
+# the merge (the .merging file) and nicks added meanwhile start a new one;
+# the new file is swapped in on the loop's thread once it's written.
+#
+# File layout: header (magic, nick count, Bloom bits, Bloom hashes), the Bloom
+# filter, count + 1 offsets into the data, then the sorted UTF-8 nicks.
+class CompactNickStore(NickStore):
+
+    MAGIC = 'WBNICKS1'
+    HEADER = struct.Struct('<8sIII')
+    BITS_PER_NICK = 10  # About 1% false positives with 7 hashes
+    HASHES = 7
+    GROWTH = 0.02
+
+    def __init__(self, path, compact_every=10000, loop=None):
+        super(CompactNickStore, self).__init__()  # self.nicks holds nicks added since the last compaction
+        self.path = path
+        self.journal_path = path + '.journal'
+        self.merging_path = path + '.merging'
+        self.compact_every = compact_every
+        self.loop = loop  # None: compact on the spot
+        self.merging = set()  # Nicks being merged into a new file
+        self.merger = None  # The thread merging them
+        self.merge_error = None
+        self.journal_size = 0
+        self._journal = None
+        self._file = None
+        self._map = None
+        self.count = 0
+        self.loaded = False
+
+    def __contains__(self, nick):
+        nick = encode_nick(nick)
+        return nick in self.nicks or nick in self.merging or self._mapped_contains(nick)
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self._nick_at(i)
+        for nick in self.merging | self.nicks:
+            yield nick
+
+    def __len__(self):
+        return self.count + len(self.merging) + len(self.nicks)
+
+    def add(self, nick):
+        nick = encode_nick(nick)
+        if nick in self:
+            return False
+        self.nicks.add(nick)
+        self._record(nick)
+        return True
+
+    def update(self, nicks):
+        encoded = (encode_nick(nick) for nick in nicks)
+        self.nicks.update(nick for nick in encoded if nick not in self.merging and not self._mapped_contains(nick))
+        self.save()
+
+    # Mapping the file is instant, so there's nothing to read ahead of time.
+    # The journals are replayed: one left from a merge that never finished,
+    # then the current one.
+    def finish_load(self, snapshot):
+        self._open_map()
+        for path in (self.merging_path, self.journal_path):
+            for nick in read_journal(path):
+                nick = encode_nick(nick)
+                if not self._mapped_contains(nick):
+                    self.nicks.add(nick)
+        self.journal_size = len(self.nicks)
+        self.loaded = True
+
+    # Merges everything added into the nick file, there and then.
+    def save(self):
+        self.wait()
+        if self.nicks:
+            self.compact(background=False)
+
+    # Starts merging the added nicks into a new nick file: on a thread, if
+    # there's a loop to hand the result back to, or else right away.
+    def compact(self, background=True):
+        self.merging, self.nicks = self.nicks, set()
+        self._close_journal()
+        if not os.path.isfile(self.journal_path):
+            pass
+        elif os.path.isfile(self.merging_path):  # A merge that failed: its nicks are in this one too
+            with open(self.merging_path, 'a') as merging:
+                for nick in read_journal(self.journal_path):
+                    merging.write(json.dumps(nick) + '\n')
+            os.remove(self.journal_path)
+        else:
+            os.rename(self.journal_path, self.merging_path)
+        self.journal_size = 0
+
+        added = sorted(self.merging)
+        if not background or self.loop is None:
+            self._merge(added)
+            self._merged(None)
+            return
+        self.merger = threading.Thread(target=self._merge_in_background, args=(added,), name='nick merger')
+        self.merger.daemon = True
+        self.merger.start()
+
+    # Waits for a merge under way to finish.
+    def wait(self):
+        if self.merger is not None:
+            self.merger.join()
+            self._merged(self.merger)
+
+    def close(self):
+        self.wait()
+        self._close_journal()
+        self._close_map()
+
+    def _merge(self, added):
+        start = time.time()
+        write_compact_file(self.path, merge_sorted(self._mapped_nicks(), added),
+                           self.count + len(added), self.BITS_PER_NICK, self.HASHES)
+        metrics.registry.observe('save_nicks', time.time() - start)
+
+    def _merge_in_background(self, added):
+        try:
+            self._merge(added)
+            self.merge_error = None
+        except Exception as ex:
+            self.merge_error = ex
+        self.loop.call_soon_threadsafe(self._merged, threading.current_thread())
+
+    # Swaps the new file in -- or, if the merge failed, keeps the nicks in
+    # memory (and in the .merging journal) for the next attempt.
+    def _merged(self, merger):
+        if merger is not self.merger:  # Already dealt with by wait()
+            return
+        self.merger = None
+        if merger is not None and self.merge_error is not None:
+            log.error('Could not compact %s: %s', self.path, self.merge_error)
+            self.nicks.update(self.merging)
+        else:
+            self._close_map()
+            self._open_map()
+            if os.path.isfile(self.merging_path):
+                os.remove(self.merging_path)
+        self.merging = set()
+
+    def compact_threshold(self):
+        return max(self.compact_every, int(self.count * self.GROWTH))
+
+    def _close_journal(self):
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+    def _record(self, nick):
+        if self._journal is None:
+            self._journal = open(self.journal_path, 'a')
+        self._journal.write(json.dumps(nick) + '\n')
+        self._journal.flush()
+        self.journal_size += 1
+
+        if self.loaded and self.merger is None and self.journal_size >= self.compact_threshold():
+            self.compact()  # Never while half-loaded, nor while merging
+
+    def _open_map(self):
+        if not os.path.isfile(self.path):
+            return
+        self._file = open(self.path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count, self.bloom_bits, self.hashes = self.HEADER.unpack_from(self._map, 0)
+        if magic != self.MAGIC:
+            self._close_map()
+            raise ValueError('{} is not a compact nick file'.format(self.path))
+        self.bloom_start = self.HEADER.size
+        self.offsets_start = self.bloom_start + self.bloom_bits // 8
+        self.data_start = self.offsets_start + 4 * (self.count + 1)
+
+    def _close_map(self):
+        if self._map is not None:
+            self._map.close()
+            self._file.close()
+        self._map = self._file = None
+        self.count = 0
+
+    def _nick_at(self, i):
+        start, end = struct.unpack_from('<II', self._map, self.offsets_start + 4 * i)
+        return self._map[self.data_start + start:self.data_start + end]
+
+    def _mapped_nicks(self):
+        for i in range(self.count):
+            yield self._nick_at(i)
+
+    def _mapped_contains(self, encoded):
+        if not self.count:
+            return False
+        for bit in bloom_bits(encoded, self.bloom_bits, self.hashes):
+            if not ord(self._map[self.bloom_start + bit // 8]) & (1 << (bit % 8)):
+                return False
+
+        low, high = 0, self.count
+        while low < high:
+            mid = (low + high) // 2
+            found = self._nick_at(mid)
+            if found < encoded:
+                low = mid + 1
+            elif found > encoded:
+                high = mid
+            else:
+                return True
+        return False
+
+
+# Nick store that several bot processes can share (see shard.py).  The nicks
+# live in a SQLite database in WAL mode, so that every process can read while
+# one writes.  A lookup asks the database, since another process may have
+# added the nick since; nicks found there are cached, as they never go away.
+# New nicks are buffered and written flush_every at a time, in one
+# transaction, rather than each waiting on a disk sync.  INSERT OR IGNORE
+# lets two processes add the same nick without either losing anything.
+class SQLiteNickStore(NickStore):
+
+    def __init__(self, path, flush_every=100, timeout=30):
+        super(SQLiteNickStore, self).__init__()  # self.nicks caches nicks known to be in the database
+        self.path = path
+        self.flush_every = flush_every
+        self.timeout = timeout  # Seconds to wait for another process's write to finish
+        self.pending = set()  # Added but not yet written
+        self.db = None
+        self.loaded = False
+
+    def __contains__(self, nick):
+        nick = encode_nick(nick)
+        if nick in self.nicks or nick in self.pending:
+            return True
+        if self.db is None:
+            return False
+        if self.db.execute('SELECT 1 FROM nicks WHERE nick = ?', (nick,)).fetchone() is None:
+            return False
+        self.nicks.add(nick)
+        return True
+
+    def __iter__(self):
+        self.flush()
+        for row in self.db.execute('SELECT nick FROM nicks'):
+            yield row[0]
+
+    def __len__(self):
+        self.flush()
+        return self.db.execute('SELECT COUNT(*) FROM nicks').fetchone()[0]
+
+    def add(self, nick):
+        nick = encode_nick(nick)
+        if nick in self:
+            return False
+        self.pending.add(nick)
+        if len(self.pending) >= self.flush_every:
+            self.flush()
+        return True
+
+    def update(self, nicks):
+        self.pending.update(encode_nick(nick) for nick in nicks)
+        self.flush()
+
+    # There's nothing to read ahead of time.  SQLite connections belong to the
+    # thread that opens them, so the database is opened here, on the bot's
+    # own thread, rather than in read_snapshot().
+    def finish_load(self, snapshot):
+        self.db = sqlite3.connect(self.path, timeout=self.timeout)
+        self.db.text_factory = str
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')  # Safe in WAL mode; a crash loses at most the last flush
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS nicks (nick TEXT PRIMARY KEY) WITHOUT ROWID')
+        self.loaded = True
+
+    def flush(self):
+        if not self.pending or self.db is None:  # Until loaded, nicks wait in pending
+            return
+        with self.db:
+            self.db.executemany('INSERT OR IGNORE INTO nicks VALUES (?)', [(nick,) for nick in self.pending])
+        self.nicks.update(self.pending)
+        self.pending = set()
+
+    def save(self):
+        self.flush()
+
+    def close(self):
+        if self.db is not None:
+            self.flush()
+            self.db.close()
+            self.db = None
+
+
+######################
+### File Functions ###
+######################
+
+# Returns the nicks in a nick file ({"nicks": [...]}, the original nicks.json format).
+def read_nick_file(path):
+    with open(path, 'r') as nick_file:
+        return json.load(nick_file, encoding='utf-8')['nicks']
+
+# Yields the nicks in a nick file as it is read, a chunk at a time, instead of
+# parsing the whole document at once.  Expects the {"nicks": [...]} layout.
+def iter_nick_file(path, chunk_size=65536):
+    with open(path, 'r') as nick_file:
+        buffer = ''
+        while '[' not in buffer:
+            chunk = nick_file.read(chunk_size)
+            if not chunk:
+                return
+            buffer += chunk
+        pos = buffer.index('[') + 1
+
+        while True:
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+                pos += 1
+            if pos < len(buffer) and buffer[pos] == ']':
+                return
+            try:
+                if pos == len(buffer):
+                    raise ValueError('Need more input')
+                nick, pos = json.decoder.scanstring(buffer, pos + 1)
+            except ValueError:  # The next nick runs past the end of the buffer
+                chunk = nick_file.read(chunk_size)
+                if not chunk:
+                    raise ValueError('{} ends in the middle of the nick list'.format(path))
+                buffer, pos = buffer[pos:] + chunk, 0
+                continue
+            yield nick
+
+# Writes a nick file atomically: a crash leaves either the old file or the new one.
+def write_nick_file(path, nicks):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as nick_file:
+        json.dump({'nicks': sorted(nicks)}, nick_file)
+        nick_file.flush()
+        os.fsync(nick_file.fileno())
+    os.rename(tmp_path, path)
+
+# Yields the nicks in a journal, one JSON string per line.  A torn last line
+# (the bot died mid-write) is skipped.
+def read_journal(path):
+    if not os.path.isfile(path):
+        return
+    with open(path, 'r') as journal:
+        for line in journal:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue
+
+def encode_nick(nick):
+    return nick.encode('utf-8') if isinstance(nick, unicode) else nick
+
+# The Bloom filter bits for an encoded nick, by double hashing one MD5.
+def bloom_bits(encoded, size, hashes):
+    first, second = struct.unpack_from('<QQ', hashlib.md5(encoded).digest())
+    return [(first + i * second) % size for i in range(hashes)]
+
+# Yields the union of two sorted sequences of encoded nicks, without duplicates.
+def merge_sorted(old, new):
+    old, new = iter(old), iter(new)
+    a, b = next(old, None), next(new, None)
+    while a is not None or b is not None:
+        if b is None or (a is not None and a < b):
+            yield a
+            a = next(old, None)
+        elif a is None or b < a:
+            yield b
+            b = next(new, None)
+        else:
+            yield a
+            a, b = next(old, None), next(new, None)
+
+# Writes a compact nick file from sorted encoded nicks, atomically.  `count`
+# is an upper bound on the number of nicks, used to size the Bloom filter.
+# The nicks are streamed through a scratch file, so the whole list is never
+# held in memory.
+def write_compact_file(path, nicks, count, bits_per_nick, hashes):
+    size = max(64, count * bits_per_nick // 8 * 8)
+    bloom = bytearray(size // 8)
+    offsets = array.array('I', [0])
+
+    data_path = path + '.data'
+    with open(data_path, 'wb') as data:
+        for nick in nicks:
+            data.write(nick)
+            offsets.append(offsets[-1] + len(nick))
+            for bit in bloom_bits(nick, size, hashes):
+                bloom[bit // 8] |= 1 << (bit % 8)
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as nick_file:
+        nick_file.write(CompactNickStore.HEADER.pack(CompactNickStore.MAGIC, len(offsets) - 1, size, hashes))
+        nick_file.write(bloom)
+        if sys.byteorder != 'little':
+            offsets.byteswap()
+        offsets.tofile(nick_file)
+        with open(data_path, 'rb') as data:
+            shutil.copyfileobj(data, nick_file)
+        nick_file.flush()
+        os.fsync(nick_file.fileno())
+    os.remove(data_path)
+    os.rename(tmp_path, path)
+
+# Merges an existing nicks.json into a store.
+def import_json_nicks(path, store):
+    nicks = read_nick_file(path)
+    store.update(nicks)
+    return len(nicks)
+
+
+if __name__ == "__main__":  # pragma: no cover
+    # Usage: python nickstore.py old_nicks.json /opt/WelcomeBot/nicks.json
+    #        python nickstore.py old_nicks.json /opt/WelcomeBot/nicks.db compact
+    #        python nickstore.py old_nicks.json /opt/WelcomeBot/nicks.sqlite sqlite
+    if sys.argv[3:] == ['compact']:
+        store = CompactNickStore(sys.argv[2])
+    elif sys.argv[3:] == ['sqlite']:
+        store = SQLiteNickStore(sys.argv[2])
+    else:
+        store = JournalNickStore(sys.argv[2])
+    store.load()
+    print('Imported {} nicks'.format(import_json_nicks(sys.argv[1], store)))
+    store.close()
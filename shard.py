@@ -0,0 +1,158 @@
+# Runs WelcomeBot as several worker processes, for more channels than one
+# process can keep up with.  See bot.py for the bot itself.
+#
+# The supervisor splits the channels listed in bot_settings.networks between
+# shard_workers processes, starts a worker for each share, and restarts any
+# worker that dies.  Every worker is an ordinary bot (bot.main()) serving
+# only its own channels.  The workers share the known nicks through the
+# SQLite nick store (nick_backend = "sqlite"), which any number of processes
+# can read and write at once; whatever else a worker keeps on disk -- its
+# pending newcomers, its metrics -- gets a file (or port) of its own.
+#
+# Each worker makes its own connection to each of its networks, so each needs
+# a nick of its own: worker 0 uses the configured botnick, and worker N that
+# nick with N after it ("elaenor", "elaenor1", ...).
+#
+#   python shard.py [workers]
+
+import multiprocessing, signal, sys, time
+
+import bot as botcode
+import bot_settings as settings
+import botlog
+from botlog import log
+
+
+#########################
+### Class Definitions ###
+#########################
+
+class Supervisor(object):
+
+    def __init__(self, workers=settings.shard_workers, networks=None,
+                 restart_delay=settings.reconnect_delay, restart_max_delay=settings.reconnect_max_delay):
+        self.shares = assign_channels(networks or settings.networks, workers)
+        self.restart_delay = restart_delay
+        self.restart_max_delay = restart_max_delay
+        self.processes = [None] * len(self.shares)
+        self.failures = [0] * len(self.shares)  # Restarts since each worker last ran for a while
+        self.restart_at = [0] * len(self.shares)
+        self.running = False
+
+    def start_worker(self, index):
+        process = multiprocessing.Process(target=run_worker, args=(index, self.shares[index]),
+                                          name='welcomebot-{}'.format(index))
+        process.daemon = True
+        process.start()
+        self.processes[index] = (process, time.time())
+        log.info('Started worker %d (pid %d) for %s', index, process.pid, describe(self.shares[index]))
+
+    # Starts any worker that isn't running and is due a (re)start.  A worker
+    # that keeps dying is restarted less and less often.
+    def check(self):
+        now = time.time()
+        for index, entry in enumerate(self.processes):
+            if entry is not None:
+                process, started = entry
+                if process.is_alive():
+                    if now - started > self.restart_max_delay:
+                        self.failures[index] = 0
+                    continue
+                log.warning('Worker %d exited with code %s', index, process.exitcode)
+                delay = min(self.restart_max_delay, self.restart_delay * 2 ** self.failures[index])
+                self.failures[index] += 1
+                self.processes[index] = None
+                self.restart_at[index] = now + delay
+            if now >= self.restart_at[index]:
+                self.start_worker(index)
+
+    def run(self, interval=1):
+        self.running = True
+        try:
+            while self.running:
+                self.check()
+                time.sleep(interval)
+        finally:
+            self.stop_workers()
+
+    def stop(self):
+        self.running = False
+
+    # Asks every worker to finish up (they save their state on SIGTERM) and
+    # waits for them.
+    def stop_workers(self, timeout=10):
+        for entry in self.processes:
+            if entry is not None and entry[0].is_alive():
+                entry[0].terminate()
+        for entry in self.processes:
+            if entry is not None:
+                entry[0].join(timeout)
+        self.processes = [None] * len(self.shares)
+
+
+#################
+### Functions ###
+#################
+
+# Splits the channels in `networks` (as in bot_settings.networks) between
+# `workers` workers, as evenly as possible.  Returns one networks list per
+# worker, each with the worker's own botnick.
+def assign_channels(networks, workers):
+    channels = []
+    for number, config in enumerate(networks):
+        for channel in sorted(config['channels']):
+            channels.append((number, channel))
+    workers = max(1, min(workers, len(channels)))
+
+    shares = []
+    for index in range(workers):
+        share = []
+        for number, config in enumerate(networks):
+            mine = dict((channel, config['channels'][channel])
+                        for i, (n, channel) in enumerate(channels) if i % workers == index and n == number)
+            if mine:
+                worker_config = dict(config, channels=mine)
+                worker_config['botnick'] = shard_nick(config.get('botnick', settings.botnick), index)
+                share.append(worker_config)
+        shares.append(share)
+    return shares
+
+def shard_nick(botnick, index):
+    return botnick if index == 0 else '{}{}'.format(botnick, index)
+
+def describe(share):
+    return ', '.join('{} on {}'.format(','.join(sorted(config['channels'])), config['server']) for config in share)
+
+# Points bot_settings at one worker's share of the channels and files.
+def configure_worker(index, networks):
+    settings.networks = networks
+    settings.nick_backend = 'sqlite'  # The only store the workers can share
+    settings.pending_source = '{}.{}'.format(settings.pending_source, index)
+    if settings.metrics_port:
+        settings.metrics_port += index
+    if settings.metrics_dump_path:
+        settings.metrics_dump_path = '{}.{}'.format(settings.metrics_dump_path, index)
+
+# The body of a worker process.  SIGTERM ends it the way Ctrl-C would, so
+# that main() saves its pending newcomers and flushes its nicks on the way out.
+def run_worker(index, networks):
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    configure_worker(index, networks)
+    try:
+        botcode.main()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+
+def main(argv=sys.argv[1:]):
+    workers = int(argv[0]) if argv else settings.shard_workers
+    botlog.setup(settings.log_level, settings.log_file)
+    supervisor = Supervisor(workers)
+    signal.signal(signal.SIGTERM, lambda signum, frame: supervisor.stop())
+    try:
+        supervisor.run()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    sys.exit(main())
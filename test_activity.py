@@ -0,0 +1,125 @@
+# Tests for the activity history (activity.py)
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import activity
+from fakeclock import fake_clock
+
+
+class TestActivityStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'activity.sqlite')
+        self.clock = fake_clock(time.time())
+        self.store = self.open()
+
+    def open(self, max_pending=3):
+        store = activity.ActivityStore(self.path, max_pending, clock=self.clock)
+        store.open()
+        return store
+
+    def test_record(self):
+        start = self.clock.now
+        self.store.record('shauna', '#falcon', joined=True)
+        self.clock.now += 60
+        self.store.record('shauna', '#falcon', welcomed=True)
+        self.clock.now += 60
+        self.store.record('shauna')  # A QUIT: no channel
+        seen = self.store.get('shauna')
+        self.assertEqual((seen.first_seen, seen.last_seen, seen.channel, seen.joins, seen.welcomed),
+                         (start, start + 120, '#falcon', 1, start + 60))
+        self.assertEqual(self.store.get('roger'), None)
+
+    def test_write_behind(self):
+        other = self.open()  # Another process, as far as the database is concerned
+        self.store.record('shauna', '#falcon', joined=True)
+        self.store.record('roger', '#falcon', joined=True)
+        self.store.record('shauna', '#hawk', joined=True)
+        self.assertEqual(other.last_seen('shauna'), None)  # Still pending
+        self.store.record('erin', '#falcon')  # The third person: written out
+        self.assertEqual(self.store.pending, {})
+        self.assertEqual(other.get('shauna').joins, 2)
+        self.assertEqual(other.get('shauna').channel, '#hawk')
+        other.close()
+
+    def test_shared_increments(self):
+        other = self.open()
+        for store in [self.store, other, self.store]:
+            store.record('shauna', '#falcon', joined=True)
+            store.flush()
+        first = self.store.get('shauna').first_seen
+        self.clock.now += 10
+        other.record('shauna', '#falcon', joined=True)
+        other.close()
+        seen = self.store.get('shauna')
+        self.assertEqual((seen.joins, seen.first_seen, seen.last_seen), (4, first, self.clock.now))
+
+    def test_last_seen(self):
+        self.store.record('shauna', '#falcon')
+        self.store.flush()
+        self.clock.now += 100
+        self.assertEqual(self.store.last_seen('shauna'), self.clock.now - 100)
+        self.store.record('shauna', '#falcon')
+        self.assertEqual(self.store.last_seen('shauna'), self.clock.now)  # Pending beats written
+        self.assertEqual(self.store.last_seen('roger'), None)
+
+    def test_counts(self):
+        now = self.clock.now
+        for nick, days_ago in [('old', 30), ('recent', 3), ('today', 0)]:
+            self.clock.now = now - days_ago * activity.DAY
+            self.store.record(nick, '#falcon')
+        self.clock.now = now
+        self.store.record('old', '#falcon')  # Back after a month
+        self.assertEqual(len(self.store), 3)
+        self.assertEqual(self.store.count_seen_since(now - activity.DAY), 2)
+        self.assertEqual(self.store.count_seen_since(now - activity.WEEK), 3)
+        self.assertEqual(self.store.count_new_since(now - activity.WEEK), 2)
+
+    def test_count_kept_up(self):
+        other = self.open()
+        for store, nicks in [(self.store, ['shauna', 'roger']), (other, ['roger', 'erin']), (self.store, ['dave'])]:
+            for nick in nicks:
+                store.record(nick, '#falcon')
+            store.flush()
+        self.assertEqual((len(self.store), len(other)), (4, 4))
+        other.close()
+
+    def test_count_older_file(self):
+        self.store.record('shauna', '#falcon')
+        self.store.record('roger', '#falcon')
+        self.store.flush()
+        with self.store.db:
+            self.store.db.execute('DROP TABLE activity_count')  # As written before it was kept
+        self.store.close()
+        self.store = self.open()
+        self.assertEqual(len(self.store), 2)
+
+    def test_queries_use_indexes(self):
+        for query in ['SELECT COUNT(*) FROM activity WHERE last_seen >= 0',
+                      'SELECT COUNT(*) FROM activity WHERE first_seen >= 0',
+                      "SELECT last_seen FROM activity WHERE nick = 'shauna'"]:
+            plan = ' '.join(str(row[-1]) for row in self.store.db.execute('EXPLAIN QUERY PLAN ' + query))
+            self.assertIn('SEARCH', plan, query)
+
+    def test_close_flushes(self):
+        self.store.record('shauna', '#falcon')
+        self.store.close()
+        self.store = self.open()
+        self.assertEqual(self.store.get('shauna').channel, '#falcon')
+
+    def test_ago(self):
+        self.assertEqual([activity.ago(seconds) for seconds in [5, 60, 7200, 3 * activity.DAY, 8 * activity.DAY, 400 * activity.DAY]],
+                         ['just now', '1 minute ago', '2 hours ago', '3 days ago', '1 week ago', '1 year ago'])
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.tmpdir)
+
+
+# Runs all the unit-tests
+if __name__ == '__main__':
+    unittest.main()
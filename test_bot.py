@@ -2,11 +2,26 @@
 
 # TODO(kgriffs): These are wildly out of date; redo tests with pytest and tox
 
-import csv
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
 import unittest
+import activity
 import bot as botcode
+import eventloop
+import fakeircd
+import faq
+import ircio
+import ircparse
+import loadgen
+import metrics
+import nickstore
 import time
 import pdb
+from fakeclock import fake_clock
 
 # To configure bot, please make changes in bot_settings.py
 import bot_settings as settings
@@ -17,12 +32,20 @@ import bot_settings as settings
 
 class fake_ircsock(object):
 
-    def __init__(self):
+    def __init__(self, chunks=()):
         self.sent_messages = []
+        self.chunks = list(chunks)  # Server output handed out by recv, one chunk per call
 
-    def send(self, msg):
+    def recv(self, bufsize):
+        if self.chunks:
+            return self.chunks.pop(0)
+        return ''
+
+    def send(self, msg, urgent=False):
         self.sent_messages.append(msg)
 
+    sendall = send  # As written by a SendQueue
+
     def sent_message(self):
         return self.sent_messages[-1]
 
@@ -36,18 +59,30 @@ def fake_irc_start():
     ircsock = fake_ircsock()
     return ircsock
 
+# A scratch nick file holding Alice and Bob, so that neither it nor its
+# journal ends up in the working tree.  Remove with remove_test_nicks().
+def make_test_nicks():
+    path = os.path.join(tempfile.mkdtemp(), 'test_nicks.json')
+    nickstore.write_nick_file(path, ['alice', 'bob'])
+    return path
+
+def remove_test_nicks(path):
+    shutil.rmtree(os.path.dirname(path))
+
 
 class TestBotClass(unittest.TestCase):
 
     def setUp(self):
-        self.bot = botcode.Bot()
+        self.bot = botcode.Bot(nick_store=nickstore.NickStore())
+        self.nick_source = make_test_nicks()
 
-    def test_csv_source(self):
-        self.assertEqual(self.bot.nick_source, 'nicks.csv')
+    def test_nick_source(self):
+        self.assertEqual(self.bot.nick_source, settings.nick_source)
 
     def test_known_nicks_setup(self):
-        bot = botcode.Bot(nick_source='test_nicks.csv')
-        self.assertEqual(bot.known_nicks, [['Alice'], ['Bob']])
+        bot = botcode.Bot(nick_source=self.nick_source)
+        bot.load_nicks()
+        self.assertEqual(sorted(bot.known_nicks), ['alice', 'bob'])
 
     def test_wait_time(self):
         self.assertEqual(self.bot.wait_time, settings.wait_time)
@@ -57,161 +92,1178 @@ class TestBotClass(unittest.TestCase):
         self.assertEqual(bot.wait_time, 30)
 
     def test_newcomers_setup(self):
-        self.assertEqual(self.bot.newcomers, [])
+        self.assertEqual(len(self.bot.newcomers), 0)
 
     def test_add_nick_to_list(self):
-        self.bot.known_nicks = [['Fluffy'], ['Spot']]
-        self.bot.add_known_nick('Roger')
-        self.assertEqual(self.bot.known_nicks,[['Fluffy'], ['Spot'], ['Roger']])
+        self.bot.known_nicks.update(['fluffy', 'spot'])
+        self.bot.add_known_nick('roger')
+        self.assertEqual(sorted(self.bot.known_nicks), ['fluffy', 'roger', 'spot'])
 
     def test_add_nick_underscore_removal(self):
-        self.bot.known_nicks = [['Fluffy'], ['Spot']]
-        self.bot.add_known_nick('Roger__')
-        self.assertEqual(self.bot.known_nicks,[['Fluffy'], ['Spot'], ['Roger']])
-
-    def test_add_nick_to_csv(self):
-        bot = botcode.Bot(nick_source='test_nicks.csv')
-        bot.add_known_nick('Roger__')
-        with open('test_nicks.csv', 'rb') as csv_file:
-            known_nicks = []
-            csv_file_data = csv.reader(csv_file, delimiter=',', quotechar='|')
-            for row in csv_file_data:
-                known_nicks.append(row)
-            self.assertEqual(known_nicks, [['Alice'], ['Bob'], ['Roger']])
+        self.bot.add_known(botcode.NewComer('Roger__'))
+        self.assertEqual(list(self.bot.known_nicks), ['roger'])
+
+    def test_add_nick_to_file(self):
+        bot = botcode.Bot(nick_source=self.nick_source)
+        bot.load_nicks()
+        bot.add_known(botcode.NewComer('Roger__'))
+        store = nickstore.JournalNickStore(self.nick_source)
+        store.load()
+        self.assertEqual(sorted(store), ['alice', 'bob', 'roger'])
 
     def tearDown(self):
-        with open('test_nicks.csv', 'w') as csv_file:
-            csv_file.write('Alice\nBob\n')
+        remove_test_nicks(self.nick_source)
 
 class TestNewComerClass(unittest.TestCase):
 
     def setUp(self):
-        self.bot = botcode.Bot('test_nicks.csv')
-        self.NewComer = botcode.NewComer('Nancy', self.bot)
+        self.NewComer = botcode.NewComer('Nancy')
 
     def test_newcomer_init_nick(self):
         self.assertEqual(self.NewComer.nick, 'Nancy')
 
     def test_newcomer_init_born(self):
-        newComer = botcode.NewComer('Baby', botcode.Bot())
+        newComer = botcode.NewComer('Baby')
         time.sleep(0.01)
         self.assertAlmostEqual(newComer.born, time.time() - .01, places=2)
 
     def test_newcomer_around_for(self):
-        newComer = botcode.NewComer('Shauna', botcode.Bot())
+        newComer = botcode.NewComer('Shauna')
         time.sleep(0.01)
         self.assertAlmostEqual(newComer.around_for(), .01, places=2)
 
+class TestNewcomerRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.newcomers = botcode.NewcomerRegistry()
+        self.harry = self.newcomers.add('Harry', born=100.0)
+        self.ron = self.newcomers.add('Ron__', born=110.0)
+
+    def test_membership(self):
+        self.assertIn('harry', self.newcomers)
+        self.assertIn('ron', self.newcomers)
+        self.assertNotIn('Harry', self.newcomers)  # Keyed by clean nick
+        self.assertEqual(self.newcomers.get('Ron__'), self.ron)
+        self.assertEqual(len(self.newcomers), 2)
+
+    def test_no_duplicates(self):
+        self.newcomers.add('harry_')
+        self.assertEqual([i.nick for i in self.newcomers], ['Ron__', 'harry_'])
+
+    def test_rename(self):
+        self.newcomers.rename('Ron__', 'Ronald')
+        self.assertNotIn('ron', self.newcomers)
+        self.assertIn('ronald', self.newcomers)
+        self.assertEqual(self.newcomers.get('Ronald'), self.ron)
+        self.assertEqual(self.newcomers.get('Ron__'), None)
+        self.assertEqual(self.newcomers.rename('Nobody', 'Somebody'), None)
+
+    def test_remove(self):
+        self.assertEqual(self.newcomers.remove('harry'), self.harry)
+        self.assertEqual(self.newcomers.remove('harry'), None)
+        self.assertEqual(self.newcomers.get('Harry'), None)
+        self.assertEqual(self.newcomers.pop_due(self.ron.born + 1), [self.ron])
+
+    def test_pop_due(self):
+        self.assertEqual(self.newcomers.pop_due(self.harry.born - 1), [])
+        self.assertEqual(self.newcomers.pop_due(self.harry.born), [self.harry])
+        self.assertEqual([i.nick for i in self.newcomers], ['Ron__'])
+        self.assertEqual(self.newcomers.pop_due(self.ron.born + 1), [self.ron])
+        self.assertEqual(len(self.newcomers), 0)
+
+    def test_slots(self):
+        self.assertRaises(AttributeError, setattr, self.harry, 'mood', 'brave')
+
 class TestJoinIRC(unittest.TestCase):
 
     def setUp(self):
         self.ircsock = fake_irc_start()
-        self.bot = botcode.Bot()
+        self.bot = botcode.Bot(nick_store=nickstore.NickStore())
 
     def test_sent_messages(self):
         botcode.join_irc(self.ircsock, settings.botnick, settings.channel)
-        expected = ["USER {} {} {} :This is http://openhatch.org/'s greeter bot.\n".format(self.bot.botnick, self.bot.botnick, self.bot.botnick), 'NICK {}\n'.format(self.bot.botnick), 'JOIN {} \n'.format(settings.channel)]
+        expected = ["USER {0} {0} {0} :This is http://falcon.readthedocs.io/en/stable/greeter bot.\n".format(self.bot.botnick), 'NICK {}\n'.format(self.bot.botnick), 'JOIN {} \n'.format(settings.channel)]
         self.assertEqual(self.ircsock.sent_messages,expected)
 
 class TestProcessNewcomers(unittest.TestCase):
 
     def setUp(self):
-        self.bot = botcode.Bot(nick_source='test_nicks.csv', wait_time=.1)
-        botcode.NewComer('Harry', self.bot)
-        botcode.NewComer('Hermione', self.bot)
+        self.nick_source = make_test_nicks()
+        self.bot = botcode.Bot(nick_source=self.nick_source, wait_time=.1)
+        self.bot.load_nicks()
+        self.bot.add_newcomer('Harry')
+        self.bot.add_newcomer('Hermione')
         time.sleep(.15)
-        botcode.NewComer('Ron', self.bot)
+        self.bot.add_newcomer('Ron')
         self.ircsock = fake_irc_start()
 
     def test_check_new_newcomers(self):
-        botcode.process_newcomers(self.bot, [i for i in self.bot.newcomers if i.around_for() > self.bot.wait_time], ircsock=self.ircsock, channel=settings.channel, greeters=settings.channel_greeters, welcome=0)
+        botcode.process_newcomers(self.bot, ircsock=self.ircsock, channel=settings.channel, greeters=settings.channel_greeters, welcome=0)
         self.assertEqual(len(self.bot.newcomers), 1)
 
     def test_check_new_known_nicks(self):
-        botcode.process_newcomers(self.bot, [i for i in self.bot.newcomers if i.around_for() > self.bot.wait_time], ircsock=self.ircsock, channel=settings.channel, greeters=settings.channel_greeters, welcome=0)
-        self.assertEqual(self.bot.known_nicks,[['Alice'],['Bob'],['Harry'],['Hermione']])
+        botcode.process_newcomers(self.bot, ircsock=self.ircsock, channel=settings.channel, greeters=settings.channel_greeters, welcome=0)
+        self.assertEqual(sorted(self.bot.known_nicks), ['alice', 'bob', 'harry', 'hermione'])
 
     def test_welcome_nick(self):
-        botcode.process_newcomers(bot=self.bot, newcomerlist=[i for i in self.bot.newcomers if i.around_for() > self.bot.wait_time], ircsock=self.ircsock, channel=settings.channel, greeters=settings.channel_greeters, welcome=1)
-        self.assertEqual(self.ircsock.sent_message(), "PRIVMSG {0} :Welcome Hermione!  The channel is pretty quiet right now, so I thought I'd say hello, and ping some people (like {1}) that you're here.  If no one responds for a while, try emailing us at hello@openhatch.org or just try coming back later.  FYI, you're now on my list of known nicknames, so I won't bother you again.\n".format(settings.channel,botcode.greeter_string(settings.channel_greeters)))
+        botcode.process_newcomers(bot=self.bot, ircsock=self.ircsock, channel=settings.channel, greeters=settings.channel_greeters, welcome=1)
+        self.assertEqual(self.ircsock.sent_message(), "PRIVMSG {0} :{1}\n".format(settings.channel, settings.welcome_message.format(
+            newcomer='Hermione', greeter_string=botcode.greeter_string(settings.channel_greeters))))
 
     def tearDown(self):
-        with open('test_nicks.csv', 'w') as csv_file:
-            csv_file.write('Alice\nBob\n')
-
-class TestParseMessages(unittest.TestCase):
-
-    def test_good_string(self):
-        ircmsg, actor = botcode.parse_messages(":vader!darth@darkside.org PRIVMSG #deathstar : I find your lack of faith disturbing")
-        self.assertEqual([ircmsg, actor], [':vader!darth@darkside.org PRIVMSG #deathstar : I find your lack of faith disturbing', 'vader'])
-
-    def test_bad_string(self):
-        ircmsg, actor = botcode.parse_messages("we should probably replace this with a bad string more likely to occur")
-        self.assertEqual([ircmsg, actor], [None, None])
+        remove_test_nicks(self.nick_source)
 
 class TestMessageResponse(unittest.TestCase):
 
     def setUp(self):
-        self.bot = botcode.Bot('test_nicks.csv')
-        botcode.NewComer('Chappe', self.bot)
+        self.bot = botcode.Bot(nick_store=nickstore.NickStore())
+        self.bot.known_nicks.add('alice')
+        self.bot.add_newcomer('Chappe')
         self.ircsock = fake_irc_start()
 
+    def respond(self, line):
+        botcode.message_response(self.bot, ircparse.parse(line), self.ircsock, settings.channel, settings.channel_greeters)
+
     def test_newcomer_speaking(self):
-        botcode.message_response(self.bot,"~q@r.m.us PRIVMSG {} :hah".format(settings.channel),"Chappe", ircsock=self.ircsock, channel=settings.channel, greeters=settings.channel_greeters)  # Standard message by newcomer
+        self.bot.newcomers.get('Chappe').born -= settings.wait_time + 1
+        self.respond(":Chappe!q@r.m.us PRIVMSG {} :hah".format(settings.channel))  # Standard message by newcomer
         nicklist = [i.nick for i in self.bot.newcomers]   # Makes a list of newcomers nicks for easy asserting
         self.assertEqual(nicklist, ['Chappe'])
 
     def test_oldtimer_speaking(self):
-        botcode.message_response(self.bot,"~q@r.m.us PRIVMSG {} :hah".format(settings.channel),"Alice", ircsock=self.ircsock, channel=settings.channel, greeters=settings.channel_greeters)  # Standard message by oldtimer
+        self.bot.newcomers.remove('chappe')
+        self.bot.newcomers.add('Chappe', born=time.time() - settings.wait_time - 1)
+        self.respond(":Alice!q@r.m.us PRIVMSG {} :hah".format(settings.channel))  # Standard message by oldtimer
         nicklist = [i.nick for i in self.bot.newcomers]   # Makes a list of newcomers nicks for easy asserting
         self.assertEqual(nicklist, [])
+        self.assertIn('chappe', self.bot.known_nicks)
+        self.assertFalse(self.ircsock.has_sent_message())  # Known without a welcome
 
     def test_join(self):
-        botcode.message_response(self.bot,"JOIN {} right now!".format(settings.channel),"Shauna", ircsock=self.ircsock, channel=settings.channel, greeters=settings.channel_greeters)   # Replace with actual ping message
-        self.assertEqual(self.bot.newcomers[1].nick,'Shauna')
+        self.respond(":Shauna!s@example.org JOIN {}".format(settings.channel))
+        self.assertEqual([i.nick for i in self.bot.newcomers], ['Chappe', 'Shauna'])
+
+    def test_join_known_or_other_channel(self):
+        self.respond(":Alice_!a@example.org JOIN {}".format(settings.channel))
+        self.respond(":Shauna!s@example.org JOIN #elsewhere")
+        self.respond(":{0}!b@example.org JOIN {1}".format(self.bot.botnick, settings.channel))
+        self.assertEqual([i.nick for i in self.bot.newcomers], ['Chappe'])
+
+    def test_nick(self):
+        self.respond(":Chappe!q@r.m.us NICK :Chappe_away")
+        self.assertEqual([i.nick for i in self.bot.newcomers], ['Chappe_away'])
+        self.respond(":Chappe_away!q@r.m.us NICK :Claude")
+        self.assertIn('claude', self.bot.newcomers)
+        self.assertNotIn('chappe', self.bot.newcomers)
 
     def test_part(self):
-        botcode.message_response(self.bot,"JOIN {} right now!".format(settings.channel),"Shauna", ircsock=self.ircsock, channel=settings.channel, greeters=settings.channel_greeters)   # Replace with actual ping message
+        self.respond(":Shauna!s@example.org JOIN {}".format(settings.channel))
         self.assertEqual(len(self.bot.newcomers), 2)
-        botcode.message_response(self.bot,"PART {}".format(settings.channel),"Shauna", ircsock=self.ircsock, channel=settings.channel, greeters=settings.channel_greeters)   # Replace with actual ping message
+        self.respond(":Shauna!s@example.org PART {} :bye".format(settings.channel))
         self.assertEqual(len(self.bot.newcomers), 1)
 
+    def test_quit(self):
+        self.respond(":Chappe!q@r.m.us QUIT :Client Quit")
+        self.assertEqual(len(self.bot.newcomers), 0)
+
     def test_hello(self):
-        botcode.message_response(self.bot,"PRIVMSG sup {}".format(self.bot.botnick),"Shauna", ircsock=self.ircsock, channel=settings.channel, greeters=settings.channel_greeters)
+        self.respond(":Shauna!s@example.org PRIVMSG {0} :sup {1}".format(settings.channel, self.bot.botnick))
         self.assertTrue(self.ircsock.has_sent_message())
         self.assertIn(self.ircsock.sent_message(), ["PRIVMSG {} :hello Shauna\n".format(settings.channel), "PRIVMSG {} :hi Shauna\n".format(settings.channel), "PRIVMSG {} :hey Shauna\n".format(settings.channel), "PRIVMSG {} :yo Shauna\n".format(settings.channel), "PRIVMSG {} :sup Shauna\n".format(settings.channel)])
 
+    def test_hello_only_in_text(self):
+        self.respond(":hi!s@{0} PRIVMSG {1} :nothing to see".format(self.bot.botnick, settings.channel))
+        self.assertFalse(self.ircsock.has_sent_message())
+
     def test_help(self):
-        botcode.message_response(self.bot,"PRIVMSG info {}".format(self.bot.botnick),"Shauna", ircsock=self.ircsock, channel=settings.channel, greeters=settings.channel_greeters)
+        self.respond(":Shauna!s@example.org PRIVMSG {0} :info {1}".format(settings.channel, self.bot.botnick))
         self.assertTrue(self.ircsock.has_sent_message())
-        self.assertEqual(self.ircsock.sent_message(), "PRIVMSG {} :I'm a bot!  I'm from here <https://github.com/shaunagm/oh-irc-bot>.  You can change my behavior by submitting a pull request or by talking to shauna.\n".format(settings.channel))
+        self.assertEqual(self.ircsock.sent_message(), "PRIVMSG {} :I'm a bot!  I'm a fork of shauna's welcomebot, you can checkout my internals and contribute here: https://github.com/falconry/WelcomeBot.\n".format(settings.channel))
 
     def test_wait_time_from_admin(self):
-        botcode.message_response(self.bot,"{} --wait-time 40".format(self.bot.botnick),"shauna",ircsock=self.ircsock, channel=settings.channel, greeters=settings.channel_greeters)     # Channel-greeters may also be changed.  :(
-        self.assertEqual(self.ircsock.sent_message(), "PRIVMSG {} :shauna the wait time is changing to 40 seconds.\n".format(settings.channel))
+        admin = settings.channel_greeters[0]
+        self.respond(":{0}!a@example.org PRIVMSG {1} :{2} --wait-time 40".format(admin, settings.channel, self.bot.botnick))
+        self.assertEqual(self.ircsock.sent_message(), "PRIVMSG {0} :{1} the wait time is changing to 40 seconds.\n".format(settings.channel, admin))
         self.assertEqual(self.bot.wait_time, 40)
 
+    def test_wait_time_not_a_number(self):
+        admin = settings.channel_greeters[0]
+        self.respond(":{0}!a@example.org PRIVMSG {1} :{2} --wait-time soon".format(admin, settings.channel, self.bot.botnick))
+        self.assertFalse(self.ircsock.has_sent_message())
+        self.assertEqual(self.bot.wait_time, settings.wait_time)
+
     def test_wait_time_from_non_admin(self):
-        botcode.message_response(self.bot,"{} --wait-time 40".format(self.bot.botnick),"Impostor",ircsock=self.ircsock, channel=settings.channel, greeters=settings.channel_greeters)     # Channel-greeters may also be changed.  :(
+        self.respond(":Impostor!i@example.org PRIVMSG {0} :{1} --wait-time 40".format(settings.channel, self.bot.botnick))
         self.assertEqual(self.ircsock.sent_message(), "PRIVMSG {0} :Impostor you are not authorized to make that change. Please contact one of the channel greeters, like {1}, for assistance.\n".format(settings.channel,botcode.greeter_string(settings.channel_greeters)))
         self.assertEqual(self.bot.wait_time, settings.wait_time)
 
     def test_pong(self):
-        botcode.message_response(self.bot,"PING :","Shauna",ircsock=self.ircsock, channel=settings.channel, greeters=settings.channel_greeters)   # Replace this with actual ping message
-        self.assertEqual(self.ircsock.sent_message(),"PONG :\n")
+        self.respond("PING :irc.example.org")
+        self.assertEqual(self.ircsock.sent_message(),"PONG :irc.example.org\n")
 
     def test_bad_pong(self):
-        botcode.message_response(self.bot,"PING!!! :","Shauna",ircsock=self.ircsock, channel=settings.channel, greeters=settings.channel_greeters)   # Replace this with actual ping message
+        self.respond("PING!!! :")
         self.assertFalse(self.ircsock.has_sent_message())
 
+class TestMsgHandler(unittest.TestCase):
+
+    def setUp(self):
+        self.bot = botcode.Bot(nick_store=nickstore.NickStore())
+        self.ircsock = fake_ircsock([
+            ":Shauna!s@example.org JOIN {0}\r\nPING :irc.exa".format(settings.channel),
+            "mple.org\r\n",
+        ])
+        self.reader = ircio.LineReader(self.ircsock)
+
+    def respond(self):
+        for ircmsg in botcode.msg_handler(self.reader):
+            botcode.message_response(self.bot, ircparse.parse(ircmsg), self.ircsock, settings.channel, settings.channel_greeters)
+
+    def test_each_line_handled(self):
+        self.respond()
+        self.assertEqual([i.nick for i in self.bot.newcomers], ['Shauna'])
+        self.assertFalse(self.ircsock.has_sent_message())  # PING is still incomplete
+        self.respond()
+        self.assertEqual(self.ircsock.sent_messages, ["PONG :irc.example.org\n"])
+
+    def test_connection_closed(self):
+        self.respond()
+        self.respond()
+        self.assertRaises(ircio.ConnectionClosed, self.respond)
+
+class TestServe(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = eventloop.EventLoop()
+        self.bot = botcode.Bot(nick_store=nickstore.NickStore(), wait_time=0.05, loop=self.loop, channel_greeters=['kgriffs'])
+        self.ircsock, self.server = socket.socketpair()
+        self.network = botcode.Network(self.loop, 'irc.example.org', self.bot.botnick)
+        self.network.add_channel(self.bot)
+        self.network.attach(self.ircsock)
+
+    # Sends lines from the "server", then runs the loop for a while.
+    def exchange(self, lines=(), seconds=0.0):
+        if lines:
+            self.server.sendall(''.join(line + '\r\n' for line in lines))
+        deadline = time.time() + max(seconds, 0.02)  # Long enough to read, then write
+        while time.time() < deadline:
+            self.loop.run_once(deadline - time.time())
+        self.server.setblocking(0)
+        try:
+            return self.server.recv(65536)
+        except socket.error:
+            return ''
+
+    def test_welcome_on_timer(self):
+        self.exchange([":Shauna!s@example.org JOIN {}".format(settings.channel)])
+        newcomer = self.bot.newcomers.get('Shauna')
+        self.assertEqual(newcomer.timer.when, newcomer.born + 0.05)
+        received = self.exchange(seconds=0.1)
+        self.assertTrue(received.startswith("PRIVMSG {} :Welcome Shauna!".format(settings.channel)))
+        self.assertIn('shauna', self.bot.known_nicks)
+        self.assertEqual(len(self.bot.newcomers), 0)
+
+    def test_part_cancels_welcome(self):
+        self.exchange([":Shauna!s@example.org JOIN {}".format(settings.channel)])
+        timer = self.bot.newcomers.get('Shauna').timer
+        self.exchange([":Shauna!s@example.org PART {}".format(settings.channel)])
+        self.assertTrue(timer.cancelled)
+        self.assertEqual(self.exchange(seconds=0.1), '')
+        self.assertNotIn('shauna', self.bot.known_nicks)
+
+    def test_nick_keeps_welcome(self):
+        self.exchange([":Shauna!s@example.org JOIN {}".format(settings.channel),
+                       ":Shauna!s@example.org NICK :Shauna_afk"])
+        received = self.exchange(seconds=0.1)
+        self.assertTrue(received.startswith("PRIVMSG {} :Welcome Shauna_afk!".format(settings.channel)))
+
+    def test_wait_time_change_reschedules(self):
+        self.exchange([":Shauna!s@example.org JOIN {}".format(settings.channel),
+                       ":kgriffs!k@example.org PRIVMSG {0} :{1} --wait-time 60".format(settings.channel, self.bot.botnick)])
+        self.assertEqual(self.bot.newcomers.get('Shauna').timer.when, self.bot.newcomers.get('Shauna').born + 60)
+        self.assertNotIn('Welcome', self.exchange(seconds=0.1))
+
+    def test_pong(self):
+        self.assertEqual(self.exchange(["PING :irc.example.org"]), "PONG :irc.example.org\n")
+
+    def test_metrics(self):
+        registry = metrics.registry
+        before = dict((key, registry.count(*key)) for key in
+                      [('lines_parsed', 'JOIN'), ('lines_parsed', 'PING'), ('newcomers_added', None),
+                       ('newcomers_welcomed', None), ('lines_sent', None)])
+        self.exchange([":Shauna!s@example.org JOIN {}".format(settings.channel), "PING :irc.example.org"], seconds=0.1)
+        after = dict((key, registry.count(*key) - count) for key, count in before.items())
+        self.assertEqual(after, {('lines_parsed', 'JOIN'): 1, ('lines_parsed', 'PING'): 1, ('newcomers_added', None): 1,
+                                 ('newcomers_welcomed', None): 1, ('lines_sent', None): 2})
+
     def tearDown(self):
-        with open('test_nicks.csv', 'w') as csv_file:
-            csv_file.write('Alice\nBob\n')
+        self.ircsock.close()
+        self.server.close()
+
+class TestNetwork(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = eventloop.EventLoop()
+        self.known_nicks = nickstore.NickStore()
+        self.known_nicks.add('alice')
+        self.network, self.other_network = botcode.make_networks(self.loop, self.known_nicks, [
+            {'server': 'irc.example.org', 'botnick': 'elaenor', 'channels': {
+                '#falcon': {},
+                '#falcon-dev': {'wait_time': 120, 'channel_greeters': ['kgriffs'], 'welcome_message': 'Hi {newcomer}, ask {greeter_string}!'},
+            }},
+            {'server': 'irc.example.net', 'port': 6697, 'channels': {'#falcon': {}}},
+        ])
+        self.falcon = self.network.bots['#falcon']
+        self.dev = self.network.bots['#falcon-dev']
+        self.ircsock = fake_irc_start()
+        self.network.sendq = self.ircsock
+
+    def respond(self, line):
+        self.network.dispatch(ircparse.parse(line))
+
+    def test_channel_settings(self):
+        self.assertEqual(self.falcon.wait_time, settings.wait_time)
+        self.assertEqual(self.falcon.channel_greeters, settings.channel_greeters)
+        self.assertEqual(self.dev.wait_time, 120)
+        self.assertEqual(self.dev.channel_greeters, ['kgriffs'])
+        self.assertEqual(self.other_network.port, 6697)
+        self.assertEqual(self.other_network.botnick, settings.botnick)
+
+    def test_shared_nick_store(self):
+        self.assertTrue(self.falcon.known_nicks is self.dev.known_nicks)
+        self.assertTrue(self.falcon.known_nicks is self.other_network.bots['#falcon'].known_nicks)
+
+    def test_join_goes_to_its_channel(self):
+        self.respond(":Shauna!s@example.org JOIN #Falcon-Dev")
+        self.respond(":Alice!a@example.org JOIN #falcon")
+        self.assertEqual([i.nick for i in self.dev.newcomers], ['Shauna'])
+        self.assertEqual(len(self.falcon.newcomers), 0)
+
+    def test_quit_and_nick_reach_every_channel(self):
+        self.respond(":Shauna!s@example.org JOIN #falcon")
+        self.respond(":Shauna!s@example.org JOIN #falcon-dev")
+        self.respond(":Shauna!s@example.org NICK :Shauna2")
+        self.assertEqual([i.nick for i in self.falcon.newcomers], ['Shauna2'])
+        self.assertEqual([i.nick for i in self.dev.newcomers], ['Shauna2'])
+        self.respond(":Shauna2!s@example.org QUIT :bye")
+        self.assertEqual(len(self.falcon.newcomers) + len(self.dev.newcomers), 0)
+
+    def test_channel_welcome(self):
+        self.dev.newcomers.add('Shauna', born=time.time() - 121)
+        botcode.process_newcomers(self.dev, self.ircsock, self.dev.channel, self.dev.channel_greeters)
+        self.assertEqual(self.ircsock.sent_messages, ["PRIVMSG #falcon-dev :Hi Shauna, ask kgriffs!\n"])
+
+    def test_private_message_answered_privately(self):
+        self.respond(":Shauna!s@example.org PRIVMSG elaenor :info elaenor")
+        self.assertTrue(self.ircsock.sent_message().startswith("PRIVMSG Shauna :I'm a bot!"))
+
+    def test_ping_answered_once(self):
+        self.respond("PING :irc.example.org")
+        self.assertEqual(self.ircsock.sent_messages, ["PONG :irc.example.org\n"])
+
+    def test_join_irc_many_channels(self):
+        channels = ['#channel{:03}'.format(i) for i in range(100)]
+        botcode.join_irc(self.ircsock, 'elaenor', channels)
+        joins = [m for m in self.ircsock.sent_messages if m.startswith('JOIN ')]
+        self.assertTrue(len(joins) > 1)
+        self.assertTrue(all(len(m) < 512 for m in joins))
+        self.assertEqual(sum([m.split()[1].split(',') for m in joins], []), channels)
+
+class TestFAQ(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'faq.json')
+        self.write({'install': {'keywords': ['install', 'pip', 'help'], 'answer': '{nick}: pip install falcon'}})
+        self.faq = faq.FAQ(self.path)
+        self.faq.refresh()
+        self.networks = botcode.make_networks(eventloop.EventLoop(), nickstore.NickStore(), [
+            {'server': 'irc.example.org', 'botnick': 'elaenor', 'channels': {'#falcon': {}, '#falcon-dev': {}}},
+        ], faq=self.faq)
+        self.network = self.networks[0]
+        self.ircsock = fake_irc_start()
+        self.network.sendq = self.ircsock
+
+    def write(self, config, mtime=None):
+        with open(self.path, 'w') as faq_file:
+            json.dump(config, faq_file)
+        if mtime is not None:
+            os.utime(self.path, (mtime, mtime))
+
+    def respond(self, line):
+        self.network.dispatch(ircparse.parse(line))
+
+    def test_answer(self):
+        self.respond(":Shauna!s@example.org PRIVMSG #falcon :pip elaenor")
+        self.assertEqual(self.ircsock.sent_messages, ["PRIVMSG #falcon :Shauna: pip install falcon\n"])
+
+    def test_one_line_per_send(self):
+        self.write({'docs': {'answer': ['{nick}: see the docs', 'or ask in {channel}']}}, mtime=1)
+        botcode.refresh_faq(self.faq, self.networks)
+        self.respond(":Shauna!s@example.org PRIVMSG #falcon :docs elaenor")
+        self.assertEqual(self.ircsock.sent_messages, ["PRIVMSG #falcon :Shauna: see the docs\n",  # Each line queued on its own
+                                                      "PRIVMSG #falcon :or ask in #falcon\n"])
+
+    def test_builtin_triggers_win(self):
+        self.respond(":Shauna!s@example.org PRIVMSG #falcon :help elaenor")
+        self.assertTrue(self.ircsock.sent_message().startswith("PRIVMSG #falcon :I'm a bot!"))
+
+    def test_cooldown(self):
+        self.respond(":Shauna!s@example.org PRIVMSG #falcon :install elaenor")
+        self.respond(":Shauna!s@example.org PRIVMSG #falcon :pip elaenor")  # Same entry, same person
+        self.respond(":Roger!r@example.org PRIVMSG #falcon :pip elaenor")  # Same entry, same channel
+        self.respond(":Roger!r@example.org PRIVMSG #falcon-dev :pip elaenor")
+        self.assertEqual(self.ircsock.sent_messages, ["PRIVMSG #falcon :Shauna: pip install falcon\n",
+                                                      "PRIVMSG #falcon-dev :Roger: pip install falcon\n"])
+
+    def test_reload(self):
+        self.write({'wsgi': {'answer': '{nick}: try gunicorn'}}, mtime=1)
+        self.assertTrue(botcode.refresh_faq(self.faq, self.networks))
+        self.respond(":Shauna!s@example.org PRIVMSG #falcon :pip elaenor")
+        self.respond(":Shauna!s@example.org PRIVMSG #falcon :wsgi elaenor")
+        self.respond(":Roger!r@example.org PRIVMSG #falcon-dev :help elaenor")
+        self.assertEqual(self.ircsock.sent_messages[0], "PRIVMSG #falcon :Shauna: try gunicorn\n")
+        self.assertTrue(self.ircsock.sent_messages[1].startswith("PRIVMSG #falcon-dev :I'm a bot!"))  # Still there
+
+    def test_welcome_follows_greeters(self):
+        bot = self.network.bots['#falcon']
+        botcode.welcome_nick(bot, 'Shauna', self.ircsock, bot.channel, ['kgriffs'])
+        botcode.welcome_nick(bot, 'Roger', self.ircsock, bot.channel, ['kgriffs', 'jvrbanac'])
+        self.assertIn('Welcome Shauna! ', self.ircsock.sent_messages[0])
+        self.assertIn('(like kgriffs)', self.ircsock.sent_messages[0])
+        self.assertIn('(like kgriffs and jvrbanac)', self.ircsock.sent_messages[1])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+class TestWarmUp(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'nicks.json')
+        nickstore.write_nick_file(self.path, ['alice', 'bob'])
+        self.loop = eventloop.EventLoop()
+        self.known_nicks = nickstore.JournalNickStore(self.path)
+        self.networks = botcode.make_networks(self.loop, self.known_nicks, [
+            {'server': 'irc.example.org', 'botnick': 'elaenor', 'channels': {'#falcon': {}}},
+        ])
+        self.network = self.networks[0]
+        self.bot = self.network.bots['#falcon']
+        self.ircsock = fake_irc_start()
+        self.network.sendq = self.ircsock
+
+    def respond(self, line):
+        self.network.dispatch(ircparse.parse(line))
+
+    def warm_up(self):
+        botcode.warm_up(self.loop, self.known_nicks, self.networks).join()
+        self.loop.run_once(1)
+
+    def test_joins_held_until_loaded(self):
+        self.respond("PING :irc.example.org")  # Answered while the nicks load
+        self.assertEqual(self.ircsock.sent_messages, ["PONG :irc.example.org\n"])
+        joined = self.bot.now()
+        self.respond(":Alice!a@example.org JOIN #falcon")
+        self.respond(":Shauna!s@example.org JOIN #falcon")
+        self.assertEqual(len(self.bot.newcomers), 0)
+        self.warm_up()
+        self.assertTrue(self.known_nicks.loaded)
+        self.assertEqual([i.nick for i in self.bot.newcomers], ['Shauna'])
+        self.assertTrue(self.bot.newcomers.get('Shauna').born - joined < 1)  # Still counts from the JOIN
+        self.assertEqual(self.bot.held_joins, {})
+
+    def test_part_and_nick_while_loading(self):
+        self.respond(":Shauna!s@example.org JOIN #falcon")
+        self.respond(":Roger!r@example.org JOIN #falcon")
+        self.respond(":Shauna!s@example.org PART #falcon")
+        self.respond(":Roger!r@example.org NICK :Roger2")
+        self.warm_up()
+        self.assertEqual([i.nick for i in self.bot.newcomers], ['Roger2'])
+
+    def test_nicks_added_while_loading_are_kept(self):
+        self.known_nicks.add('roger')
+        self.warm_up()
+        self.assertEqual(set(self.known_nicks), set(['alice', 'bob', 'roger']))
+
+    def test_stale_pending_file(self):
+        self.known_nicks.add('shauna')  # Welcomed after pending.json was last saved, before a crash
+        path = os.path.join(self.tmpdir, 'pending.json')
+        born = self.bot.now() - settings.wait_time - 10
+        with open(path, 'w') as pending_file:
+            json.dump({'irc.example.org #falcon': [['Shauna', born], ['Roger', born]]}, pending_file)
+        botcode.load_pending(path, self.networks)
+        self.respond(":irc.example.org 353 elaenor = #falcon :elaenor Shauna Roger")
+        self.respond(":irc.example.org 366 elaenor #falcon :End of /NAMES list.")
+        self.loop.run_once(0)  # Both due, but who's known can't be told yet
+        self.assertEqual(self.ircsock.sent_messages, [])
+        self.warm_up()
+        self.loop.run_once(0)
+        self.assertEqual([m.split('!')[0] for m in self.ircsock.sent_messages], ["PRIVMSG #falcon :Welcome Roger"])
+        self.assertEqual(len(self.bot.newcomers), 0)
+
+    def test_unreadable_nicks_stop_the_bot(self):
+        with open(self.path, 'w') as f:
+            f.write('["alice", "bo')  # Cut short
+        self.respond(":Shauna!s@example.org JOIN #falcon")
+        self.loop.call_later(5, self.loop.stop)  # In case it doesn't
+        started = time.time()
+        botcode.warm_up(self.loop, self.known_nicks, self.networks)
+        self.loop.run_forever()
+        self.assertLess(time.time() - started, 5)
+        self.assertFalse(self.known_nicks.loaded)
+
+    def tearDown(self):
+        self.loop.close()
+        self.known_nicks.close()
+        shutil.rmtree(self.tmpdir)
+
+class TestReconnect(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = fake_clock(time.time())
+        self.loop = eventloop.EventLoop(clock=self.clock)
+        self.network = botcode.Network(self.loop, 'irc.example.org', 'elaenor')
+        self.bot = botcode.Bot(botnick='elaenor', channel='#falcon', nick_store=nickstore.NickStore(), wait_time=60, loop=self.loop)
+        self.network.add_channel(self.bot)
+        self.servers = []
+        self.network.resolver = None
+        self.network.connector = self.accept
+
+    # Stands in for irc_start: hands the bot one end of a socketpair.
+    def accept(self, server, port):
+        ircsock, server_end = socket.socketpair()
+        self.servers.append(server_end)
+        return ircsock
+
+    def refuse(self, server, port):
+        raise socket.error('Connection refused')
+
+    def run_loop(self, seconds=0):
+        self.clock.now += seconds
+        self.loop.run_once(0)
+        self.loop.run_once(0)
+
+    def server_says(self, *lines):
+        self.servers[-1].sendall(''.join(line + '\r\n' for line in lines))
+        self.run_loop()
+
+    def server_heard(self):
+        self.run_loop()
+        self.servers[-1].setblocking(0)
+        try:
+            return self.servers[-1].recv(65536)
+        except socket.error:
+            return ''
+
+    def test_backoff(self):
+        self.network.connector = self.refuse
+        delays = []
+        for i in range(8):
+            self.network.connect()
+            delays.append(self.loop.next_timer())
+            self.loop.timers = []
+        for attempt, delay in enumerate(delays):
+            expected = min(300, 5 * 2 ** attempt)
+            self.assertTrue(expected / 2.0 <= delay <= expected, (attempt, delay))
+
+    def test_connect_never_blocks(self):
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        port = listener.getsockname()[1]
+        listener.close()  # Nobody listening there now
+        self.network.port = port
+        self.network.connector = botcode.irc_start
+        self.network.server = '127.0.0.1'
+        self.network.connect()  # Returns at once, refused or not
+        for i in range(3):
+            self.loop.run_once(0.1)
+        self.assertEqual(self.network.ircsock, None)
+        self.assertEqual(self.network.failures, 1)  # The next attempt is scheduled
+
+    def test_connect_timeout(self):
+        self.network.connect()
+        self.loop.remove_writer(self.network.connect_timer.args[0])  # The server never answers
+        self.run_loop(settings.connect_timeout)
+        self.assertEqual(self.network.ircsock, None)
+        self.assertEqual(self.network.failures, 1)
+
+    def test_lookup_on_a_thread(self):
+        looked_up = []
+        def resolver(server, port):
+            looked_up.append(threading.current_thread().name)
+            raise socket.gaierror(-2, 'Name or service not known')
+        self.network.resolver = resolver
+        self.network.connect()
+        self.loop.run_once(1)  # Woken by the lookup finishing
+        self.assertEqual(looked_up, ['resolver'])
+        self.assertEqual(self.network.failures, 1)
+
+    def test_registration_resets_backoff(self):
+        self.network.failures = 4
+        self.network.connect()
+        self.server_says(":irc.example.org 001 elaenor :Welcome")
+        self.assertEqual(self.network.failures, 0)
+
+    def test_reconnect_and_rejoin(self):
+        self.network.connect()
+        self.assertNotIn("JOIN #falcon", self.server_heard())  # Not until we're registered
+        self.server_says(":irc.example.org 001 elaenor :Welcome")
+        self.assertIn("JOIN #falcon", self.server_heard())
+        self.servers[-1].close()
+        self.run_loop()
+        self.assertEqual(self.network.ircsock, None)
+        self.assertEqual(len(self.servers), 1)
+        self.run_loop(5)
+        self.assertEqual(len(self.servers), 2)
+        self.server_says(":irc.example.org 001 elaenor :Welcome")
+        self.assertIn("JOIN #falcon", self.server_heard())
+
+    def test_newcomers_survive_reconnect(self):
+        self.network.connect()
+        self.server_says(":Shauna!s@example.org JOIN #falcon", ":Leaver!l@example.org JOIN #falcon")
+        shauna = self.bot.newcomers.get('Shauna')
+        self.servers[-1].close()
+        self.run_loop()
+        self.assertEqual(shauna.timer, None)  # Paused while disconnected
+        self.assertEqual(len(self.bot.newcomers), 2)
+
+        self.run_loop(61)  # Shauna's wait runs out while we're away
+        self.server_says(":irc.example.org 353 elaenor = #falcon :elaenor @kgriffs Shauna",
+                         ":irc.example.org 366 elaenor #falcon :End of /NAMES list.")
+        self.assertEqual([i.nick for i in self.bot.newcomers], [])  # Leaver left; Shauna welcomed
+        self.assertIn("PRIVMSG #falcon :Welcome Shauna!", self.server_heard())
+        self.assertIn('shauna', self.bot.known_nicks)
+        self.assertNotIn('leaver', self.bot.known_nicks)
+
+    def test_malformed_lines_skipped(self):
+        self.network.connect()
+        self.server_says(":irc.example.org 001 elaenor :Welcome")
+        self.server_heard()
+        self.server_says(":Shauna!s@example.org JOIN",  # No channel
+                         "JOIN #falcon",  # No one
+                         ":irc.example.org 353 elaenor",
+                         "PING :irc.example.org",
+                         ":Roger!r@example.org JOIN #falcon")
+        self.assertEqual(self.server_heard(), "PONG :irc.example.org\n")
+        self.assertEqual([i.nick for i in self.bot.newcomers], ['Roger'])
+
+    def test_failed_line_skipped(self):
+        dispatch = self.network.dispatch
+        def fail_on_erin(msg):
+            if msg.nick == 'Erin':
+                raise KeyError('erin')
+            dispatch(msg)
+        self.network.dispatch = fail_on_erin
+        self.network.connect()
+        self.server_says(":irc.example.org 001 elaenor :Welcome")
+        self.server_heard()
+        self.server_says(":Erin!e@example.org JOIN #falcon",
+                         ":Roger!r@example.org JOIN #falcon")
+        self.assertEqual([i.nick for i in self.bot.newcomers], ['Roger'])
+        self.assertIsNotNone(self.network.ircsock)  # Still connected
+
+    def test_queued_messages_survive_reconnect(self):
+        self.network.connect()
+        self.server_says(":irc.example.org 001 elaenor :Welcome")
+        for i in range(6):
+            self.network.send("PRIVMSG #falcon :Welcome user{}!\n".format(i))
+        heard = self.server_heard()  # The flood limit holds most of them back
+        self.servers[-1].close()
+        self.run_loop()
+        self.run_loop(5)
+        self.server_says(":irc.example.org 001 elaenor :Welcome")
+        self.run_loop(60)
+        rejoined = self.server_heard()
+        self.assertTrue(rejoined.index("JOIN #falcon") < rejoined.index("PRIVMSG"))
+        self.assertEqual([line for line in (heard + rejoined).splitlines() if line.startswith("PRIVMSG")],
+                         ["PRIVMSG #falcon :Welcome user{}!".format(i) for i in range(6)])
+
+    def test_ping_timeout(self):
+        self.network.connect()
+        self.server_heard()
+        self.run_loop(100)
+        self.assertEqual(self.server_heard(), '')
+        self.run_loop(20)
+        self.assertEqual(self.server_heard(), "PING :irc.example.org\n")
+        self.server_says("PONG :irc.example.org")
+        self.run_loop(120)
+        self.assertEqual(len(self.servers), 1)  # The PONG counted
+        self.run_loop(120)
+        self.assertEqual(self.network.ircsock, None)  # Silence: give up and reconnect
+
+    def test_ping_jumps_the_queue(self):
+        self.network.connect()
+        self.server_says(":irc.example.org 001 elaenor :Welcome")
+        for i in range(100):
+            self.network.send("PRIVMSG #falcon :Welcome user{}!\n".format(i))
+        self.server_heard()
+        self.run_loop(120)
+        self.assertIn("PING :irc.example.org\n", self.server_heard())
+
+    def test_pending_snapshot(self):
+        tmpdir = tempfile.mkdtemp()
+        path = os.path.join(tmpdir, 'pending.json')
+        self.bot.newcomers.add('Shauna', born=1000.5)
+        botcode.save_pending(path, [self.network])
+        self.bot.newcomers.remove('shauna')
+        botcode.load_pending(path, [self.network])
+        self.assertEqual([(i.nick, i.born) for i in self.bot.newcomers], [('Shauna', 1000.5)])
+        shutil.rmtree(tmpdir)
+
+    def tearDown(self):
+        for server in self.servers:
+            server.close()
+
+class TestWelcomeBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = fake_clock(time.time())
+        self.loop = eventloop.EventLoop(clock=self.clock)
+        self.network = botcode.make_networks(self.loop, nickstore.NickStore(), [
+            {'server': 'irc.example.org', 'botnick': 'elaenor', 'channels': {
+                '#falcon': {'welcome_batch_window': 5, 'welcome_batch_threshold': 3},
+            }},
+        ])[0]
+        self.bot = self.network.bots['#falcon']
+        self.ircsock = fake_irc_start()
+        self.network.sendq = self.ircsock
+
+    def respond(self, line):
+        self.network.dispatch(ircparse.parse(line))
+
+    def run_until(self, seconds):
+        self.clock.now += seconds
+        self.loop.run_once(0)
+
+    def join(self, *nicks):
+        for nick in nicks:
+            self.respond(":{0}!u@example.org JOIN #falcon".format(nick))
+            self.clock.now += 1
+
+    def test_digest(self):
+        self.bot.welcome_batch_window = 20
+        self.join(*['guest{}x'.format(i) for i in range(40)])
+        self.run_until(settings.wait_time - 40)  # The first comes due: the window opens
+        self.assertEqual(self.ircsock.sent_messages, [])
+        self.run_until(20)  # It closes, with the first 21 due
+        self.assertEqual(len(self.ircsock.sent_messages), 2)  # Too long for one line
+        self.assertTrue(self.ircsock.sent_messages[0].startswith("PRIVMSG #falcon :Welcome guest0x, guest1x, guest2x, "))
+        self.assertIn("guest19x, and guest20x! ", ''.join(self.ircsock.sent_messages))
+        self.assertTrue(all(len(line) <= 400 + len("PRIVMSG #falcon :\n") for line in self.ircsock.sent_messages))
+        self.assertIn('guest20x', self.bot.known_nicks)
+        self.assertEqual(len(self.bot.newcomers), 19)
+
+    def test_digest_charged_per_line(self):
+        self.network.sendq = ircio.SendQueue(self.ircsock, rate=0.5, burst=1, clock=self.clock)
+        self.bot.welcome_batch_window = 20
+        self.join(*['guest{}x'.format(i) for i in range(40)])
+        self.run_until(settings.wait_time - 40)
+        self.run_until(20)
+        self.assertEqual(self.network.sendq.flush(), 1)  # One token: one line
+        self.assertEqual(self.network.sendq.flush(), 0)
+        self.clock.now += 2
+        self.assertEqual(self.network.sendq.flush(), 1)
+        self.assertEqual(self.network.sendq.stats()['lines_sent'], 2)
+
+    def test_digest_message(self):
+        self.bot.welcome_digest_message = "Welcome {newcomers}, ask {greeter_string}"
+        self.join('Shauna', 'Roger', 'Erin')
+        self.run_until(settings.wait_time)
+        self.run_until(5)
+        self.assertEqual(self.ircsock.sent_messages, ["PRIVMSG #falcon :Welcome Shauna, Roger, and Erin, ask kgriffs and jvrbanac\n"])
+
+    def test_below_threshold(self):
+        self.join('Shauna', 'Roger')
+        self.run_until(settings.wait_time)
+        self.run_until(5)
+        self.assertEqual([m.split('!')[0] for m in self.ircsock.sent_messages],
+                         ["PRIVMSG #falcon :Welcome Shauna", "PRIVMSG #falcon :Welcome Roger"])
+
+    def test_someone_speaks(self):
+        self.join('Shauna', 'Roger', 'Erin')
+        self.run_until(settings.wait_time)
+        self.respond(":kgriffs!k@example.org PRIVMSG #falcon :hi all")
+        self.run_until(5)
+        self.assertEqual(self.ircsock.sent_messages, [])
+        self.assertEqual(len(self.bot.newcomers), 0)
+
+    def test_disconnect_cancels_window(self):
+        self.join('Shauna', 'Roger', 'Erin')
+        self.run_until(settings.wait_time)
+        botcode.pause_newcomers(self.bot)
+        self.run_until(5)
+        self.assertEqual(self.ircsock.sent_messages, [])
+        self.assertEqual(len(self.bot.newcomers), 3)
+
+    def test_split_message(self):
+        self.assertEqual(botcode.split_message('aa bb cc', 5), ['aa bb', 'cc'])
+        self.assertEqual(botcode.split_message('aaaaaaa bb', 5), ['aaaaa', 'aa bb'])
+        self.assertEqual(botcode.split_message('short', 5), ['short'])
+
+    def tearDown(self):
+        self.loop.close()
+
+class TestNetsplit(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = fake_clock(time.time())
+        self.loop = eventloop.EventLoop(clock=self.clock)
+        self.network = botcode.make_networks(self.loop, nickstore.NickStore(), [
+            {'server': 'irc.example.org', 'botnick': 'elaenor', 'channels': {'#falcon': {}, '#hawk': {}}},
+        ])[0]
+        self.bot = self.network.bots['#falcon']
+        self.other = self.network.bots['#hawk']
+        self.ircsock = fake_irc_start()
+        self.network.sendq = self.ircsock
+
+    def respond(self, line):
+        self.network.dispatch(ircparse.parse(line))
+
+    def test_netsplit_regex(self):
+        for reason in ['hub.example.net leaf.example.net', '*.net *.split', 'irc.a-b.org x.y']:
+            self.assertTrue(botcode.netsplit_regex.match(reason), reason)
+        for reason in ['Quit: bye', 'hub.example.net', 'Ping timeout: 240 seconds', 'see you at example.net ok.bye', '']:
+            self.assertFalse(botcode.netsplit_regex.match(reason), reason)
+
+    def test_pending_newcomer_keeps_their_place(self):
+        self.respond(":Shauna!s@example.org JOIN #falcon")
+        born = self.bot.newcomers.get('Shauna').born
+        self.clock.now += 10
+        self.respond(":Shauna!s@example.org QUIT :*.net *.split")
+        self.assertEqual(len(self.bot.newcomers), 0)
+        self.clock.now += 20
+        self.respond(":Shauna!s@example.org JOIN #falcon")
+        newcomer = self.bot.newcomers.get('Shauna')
+        self.assertEqual(newcomer.born, born)
+        self.assertEqual(newcomer.timer.when, born + settings.wait_time)
+        self.assertEqual(self.bot.split_newcomers, {})
+
+    def test_split_regulars_are_not_newcomers(self):
+        for nick in ['Roger', 'Erin', 'Dave']:
+            self.respond(":{}!u@example.org QUIT :hub.example.net leaf.example.net".format(nick))
+        self.assertEqual(sorted(self.bot.netsplits.reasons['hub.example.net leaf.example.net']), ['Dave', 'Erin', 'Roger'])
+        for nick in ['Roger', 'Erin']:
+            self.respond(":{}!u@example.org JOIN #falcon".format(nick))
+        self.assertEqual(len(self.bot.newcomers), 0)
+
+    def test_shared_by_channels(self):
+        count = metrics.registry.count('netsplits')
+        self.assertIs(self.bot.netsplits, self.other.netsplits)
+        self.respond(":Shauna!s@example.org JOIN #hawk")
+        self.respond(":Shauna!s@example.org QUIT :*.net *.split")
+        self.assertEqual(len(self.bot.netsplits), 1)
+        self.assertEqual(metrics.registry.count('netsplits'), count + 1)
+        self.assertEqual(list(self.other.split_newcomers), ['Shauna'])
+        self.respond(":Shauna!s@example.org JOIN #falcon")
+        self.respond(":Shauna!s@example.org JOIN #hawk")
+        self.assertEqual(len(self.bot.newcomers), 0)
+        self.assertEqual([i.nick for i in self.other.newcomers], ['Shauna'])
+
+    def test_ordinary_quit(self):
+        self.respond(":Roger!u@example.org QUIT :Quit: bye")
+        self.respond(":Roger!u@example.org JOIN #falcon")
+        self.assertEqual([i.nick for i in self.bot.newcomers], ['Roger'])
+
+    def test_split_forgotten(self):
+        self.respond(":Roger!u@example.org QUIT :*.net *.split")
+        self.clock.now += settings.netsplit_memory
+        self.loop.run_once(0)
+        self.assertEqual((self.bot.netsplits.reasons, self.bot.netsplits.nicks), ({}, {}))
+        self.respond(":Roger!u@example.org JOIN #falcon")
+        self.assertEqual([i.nick for i in self.bot.newcomers], ['Roger'])
+
+    def tearDown(self):
+        self.loop.close()
+
+class TestIRCv3(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = fake_clock(time.time())
+        self.loop = eventloop.EventLoop(clock=self.clock)
+        self.known_nicks = nickstore.NickStore()
+        self.known_nicks.add('rogerd')  # An account
+        self.network = botcode.make_networks(self.loop, self.known_nicks, [
+            {'server': 'irc.example.org', 'botnick': 'elaenor', 'channels': {'#falcon': {}, '#hawk': {}}},
+        ])[0]
+        self.bot = self.network.bots['#falcon']
+        self.ircsock = fake_irc_start()
+        self.network.sendq = self.ircsock
+
+    def respond(self, *lines):
+        for line in lines:
+            self.network.dispatch(ircparse.parse(line))
+
+    def test_extended_join_known_account(self):
+        self.respond(":Roger_away!r@example.org JOIN #falcon rogerd :Roger D",
+                     ":Shauna!s@example.org JOIN #falcon * :Shauna")
+        self.assertEqual([i.nick for i in self.bot.newcomers], ['Shauna'])
+        self.assertEqual(self.network.accounts, {'Roger_away': 'rogerd'})
+
+    def test_account_notify(self):
+        self.respond(":Roger_away!r@example.org JOIN #falcon",
+                     ":Shauna!s@example.org JOIN #falcon")
+        self.respond(":Roger_away!r@example.org ACCOUNT rogerd")  # Logs in: not new after all
+        self.assertEqual([i.nick for i in self.bot.newcomers], ['Shauna'])
+        self.respond(":Shauna!s@example.org ACCOUNT shauna_s",
+                     ":Shauna!s@example.org NICK :Shauna2")
+        self.assertEqual(self.network.accounts, {'Roger_away': 'rogerd', 'Shauna2': 'shauna_s'})
+        self.clock.now += settings.wait_time
+        self.loop.run_once(0)
+        self.assertIn('shauna_s', self.known_nicks)  # Known by account from now on
+        self.respond(":Roger_away!r@example.org ACCOUNT *")
+        self.assertEqual(list(self.network.accounts), ['Shauna2'])
+
+    def test_account_tag(self):
+        self.respond("@account=rogerd :Roger_away!r@example.org PRIVMSG #falcon :hi all")
+        self.assertEqual(self.network.accounts, {'Roger_away': 'rogerd'})
+        self.respond(":Roger_away!r@example.org QUIT :bye")
+        self.assertEqual(self.network.accounts, {})
+
+    def test_part_forgets_account(self):
+        self.respond(":Roger_away!r@example.org JOIN #falcon rogerd :Roger D",
+                     "@account=shauna_s :Shauna!s@example.org PRIVMSG #hawk :hi all",
+                     ":Roger_away!r@example.org PART #falcon")
+        self.assertEqual(self.network.accounts, {'Shauna': 'shauna_s'})
+
+    def test_netsplit_and_netjoin_batches(self):
+        count = metrics.registry.count('batches', 'netsplit')
+        self.respond(":Shauna!s@example.org JOIN #falcon")
+        born = self.bot.newcomers.get('Shauna').born
+        self.respond(":irc.example.org BATCH +1 netsplit hub.example.net leaf.example.net",
+                     "@batch=1 :Shauna!s@example.org QUIT :hub.example.net leaf.example.net",
+                     "@batch=1 :Dave!d@example.org QUIT :hub.example.net leaf.example.net")
+        self.assertEqual(len(self.bot.newcomers), 1)  # Nothing happens until the batch ends
+        self.respond(":irc.example.org BATCH -1")
+        self.assertEqual(metrics.registry.count('batches', 'netsplit'), count + 1)
+        self.assertEqual(len(self.bot.newcomers), 0)
+        self.assertEqual(sorted(self.network.netsplits.nicks), ['Dave', 'Shauna'])
+
+        self.respond(":irc.example.org BATCH +2 netjoin hub.example.net leaf.example.net",
+                     "@batch=2 :Shauna!s@example.org JOIN #falcon",
+                     "@batch=2 :Dave!d@example.org JOIN #falcon",
+                     "@batch=2 :Newt!n@example.org JOIN #hawk",  # Not seen leaving, but back all the same
+                     ":irc.example.org BATCH -2")
+        self.assertEqual([(i.nick, i.born) for i in self.bot.newcomers], [('Shauna', born)])
+        self.assertEqual(len(self.network.bots['#hawk'].newcomers), 0)
+
+    def test_unknown_batch_type(self):
+        self.respond(":irc.example.org BATCH +x chathistory #falcon",
+                     "@batch=x :Shauna!s@example.org JOIN #falcon")
+        self.assertEqual(len(self.bot.newcomers), 0)
+        self.respond(":irc.example.org BATCH -x")
+        self.assertEqual([i.nick for i in self.bot.newcomers], ['Shauna'])
+
+class TestRegistration(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = fake_clock(time.time())
+        self.loop = eventloop.EventLoop(clock=self.clock)
+        self.network = botcode.Network(self.loop, 'irc.example.org', 'elaenor')
+        self.network.add_channel(botcode.Bot(botnick='elaenor', channel='#falcon', nick_store=nickstore.NickStore(), loop=self.loop))
+        self.ircsock, self.server = socket.socketpair()
+        self.network.resolver = None
+        self.network.connector = lambda server, port: self.ircsock
+        self.tmpdir = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.tmpdir)
+        with open('password.txt', 'w') as password_file:
+            password_file.write('hunter2\n')
+        settings.registered = True
+
+    def server_says(self, *lines):
+        self.server.sendall(''.join(line + '\r\n' for line in lines))
+        self.loop.run_once(0)
+        self.loop.run_once(0)
+
+    def server_heard(self):
+        for i in range(3):
+            self.clock.now += 10  # Past the send queue's flood limit
+            self.loop.run_once(0)
+        self.server.setblocking(0)
+        try:
+            return self.server.recv(65536)
+        except socket.error:
+            return ''
+
+    def test_sasl(self):
+        self.network.connect()
+        self.assertTrue(self.server_heard().startswith("CAP LS 302\nUSER elaenor"))
+        self.server_says(":irc.example.org CAP * LS :sasl extended-join")
+        self.assertEqual(self.server_heard(), "CAP REQ :extended-join sasl\n")
+        self.server_says(":irc.example.org CAP * ACK :extended-join sasl", "AUTHENTICATE +")
+        self.assertEqual(self.server_heard(), "AUTHENTICATE PLAIN\nAUTHENTICATE ZWxhZW5vcgBlbGFlbm9yAGh1bnRlcjI=\n")
+        self.server_says(":irc.example.org 903 elaenor :SASL authentication successful",
+                         ":irc.example.org 001 elaenor :Welcome")
+        self.assertEqual(self.server_heard(), "CAP END\nJOIN #falcon \n")
+
+    def test_nickserv_without_cap(self):
+        self.network.connect()
+        self.server_heard()
+        self.server_says(":irc.example.org 421 elaenor CAP :Unknown command",
+                         ":irc.example.org 001 elaenor :Welcome")
+        self.assertEqual(self.server_heard(), "PRIVMSG NickServ :IDENTIFY elaenor hunter2\nJOIN #falcon \n")
+
+    def tearDown(self):
+        settings.registered = False
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+        self.network.disconnect()
+        self.server.close()
+        self.loop.close()
+
+class TestActivity(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.clock = fake_clock(time.time())
+        self.loop = eventloop.EventLoop(clock=self.clock)
+        self.history = activity.ActivityStore(os.path.join(self.tmpdir, 'activity.sqlite'), clock=self.clock)
+        self.history.open()
+        self.known_nicks = nickstore.NickStore()
+        self.known_nicks.update(['roger', 'erin'])
+        self.network = botcode.make_networks(self.loop, self.known_nicks, [
+            {'server': 'irc.example.org', 'botnick': 'elaenor',
+             'channels': {'#falcon': {'rewelcome_after': 100 * activity.DAY}, '#hawk': {'rewelcome_after': None}}},
+        ], activity=self.history)[0]
+        self.bot = self.network.bots['#falcon']
+        self.ircsock = fake_irc_start()
+        self.network.sendq = self.ircsock
+
+    def respond(self, *lines):
+        for line in lines:
+            self.network.dispatch(ircparse.parse(line))
+
+    def test_recorded(self):
+        start = self.clock.now
+        self.respond(":Shauna!s@example.org JOIN #falcon")
+        self.clock.now += settings.wait_time
+        self.loop.run_once(0)
+        self.respond(":Shauna!s@example.org PRIVMSG #falcon :thanks!",
+                     ":Shauna!s@example.org PRIVMSG elaenor :psst",  # Not seen in a channel
+                     ":Shauna!s@example.org PART #falcon",
+                     ":Shauna_!s@example.org JOIN #hawk")
+        self.clock.now += 5
+        self.respond(":Shauna_!s@example.org QUIT :bye")
+        seen = self.history.get('shauna')
+        self.assertEqual((seen.first_seen, seen.last_seen, seen.channel, seen.joins, seen.welcomed),
+                         (start, start + settings.wait_time + 5, '#hawk', 2, start + settings.wait_time))
+
+    def test_rewelcome_after_long_absence(self):
+        count = metrics.registry.count('rewelcomes')
+        self.history.record('roger', '#falcon')
+        self.history.record('erin', '#falcon')
+        self.clock.now += 101 * activity.DAY
+        self.history.record('erin', '#hawk')  # Erin has been around elsewhere
+        self.respond(":Roger!r@example.org JOIN #falcon",
+                     ":Erin!e@example.org JOIN #falcon",
+                     ":Dave!d@example.org JOIN #falcon")  # Known from before there was a history
+        self.known_nicks.add('dave')
+        self.assertEqual(sorted(i.nick for i in self.bot.newcomers), ['Dave', 'Roger'])
+        self.assertEqual(metrics.registry.count('rewelcomes'), count + 1)
+        self.respond(":Roger!r@example.org PART #falcon",
+                     ":Roger!r@example.org JOIN #falcon")  # Seen just now
+        self.assertEqual(sorted(i.nick for i in self.bot.newcomers), ['Dave'])
+
+    def test_never_rewelcome(self):
+        self.history.record('roger', '#hawk')
+        self.clock.now += 1000 * activity.DAY
+        self.respond(":Roger!r@example.org JOIN #hawk")
+        self.assertEqual(len(self.network.bots['#hawk'].newcomers), 0)
+
+    def test_seen(self):
+        self.respond(":Shauna!s@example.org JOIN #falcon")
+        self.clock.now += 3 * activity.DAY
+        self.respond(":Roger!r@example.org PRIVMSG #falcon :elaenor --seen Shauna_")
+        self.assertEqual(self.ircsock.sent_message(), "PRIVMSG #falcon :Shauna_ was last seen in #falcon "
+                         "3 days ago (first seen 3 days ago, joined 1 time).\n")
+        self.respond(":Erin!e@example.org PRIVMSG elaenor :elaenor --seen Dave")
+        self.assertEqual(self.ircsock.sent_message(), "PRIVMSG Erin :I haven't seen Dave.\n")
+
+    def test_stats(self):
+        self.history.record('erin', '#falcon')
+        self.clock.now += 2 * activity.DAY
+        self.respond(":Shauna!s@example.org JOIN #falcon",
+                     ":Roger!r@example.org PRIVMSG #falcon :elaenor --stats")
+        self.assertEqual(self.ircsock.sent_message(), "PRIVMSG #falcon :I've seen 3 people: 2 in the last day "
+                         "and 3 in the last week, 3 of them for the first time.\n")
+
+    def test_cooldown(self):
+        self.respond(":Roger!r@example.org PRIVMSG #falcon :elaenor --stats",
+                     ":Roger!r@example.org PRIVMSG #falcon :elaenor --stats",  # Same person
+                     ":Erin!e@example.org PRIVMSG #falcon :elaenor --stats",  # Same channel
+                     ":Roger!r@example.org PRIVMSG #falcon :elaenor --seen Shauna",
+                     ":Roger!r@example.org PRIVMSG #falcon :elaenor --seen Erin")
+        self.assertEqual(len(self.ircsock.sent_messages), 2)
+        self.assertEqual(self.ircsock.sent_message(), "PRIVMSG #falcon :I haven't seen Shauna.\n")
+
+    def tearDown(self):
+        self.loop.close()
+        self.history.close()
+        shutil.rmtree(self.tmpdir)
+
+class TestMain(unittest.TestCase):
+
+    # The whole bot, main() and all, against a fake IRC server.
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.server = fakeircd.FakeIRCd()
+        self.server.start()
+        self.old_settings = loadgen.configure_bot(self.server.port, self.workdir, wait_time=0.2)
+        self.old_burst, settings.send_burst = settings.send_burst, 20  # Don't wait on the flood limit after registering
+        self.thread, self.loop = loadgen.start_bot()
+        self.assertTrue(loadgen.wait_for(lambda: self.server.run(self.bot_joined)))
+
+    def bot_joined(self):
+        return 'elaenor' in [client.nick for client in self.server.members('#loadtest')]
+
+    def say(self, nick, *lines):
+        def run():
+            client = self.server.nicks.get(nick.lower()) or self.server.connect_virtual(nick)
+            for line in lines:
+                client.say(line)
+        self.server.run(run)
+
+    def test_welcome(self):
+        self.say('Shauna', 'JOIN #loadtest')
+        self.assertTrue(loadgen.wait_for(lambda: loadgen.bot_messages(self.server)))
+        self.assertTrue(loadgen.bot_messages(self.server)[0].startswith('Welcome Shauna!'))
+
+    def test_hello(self):
+        self.say('Alice', 'JOIN #loadtest', 'PRIVMSG #loadtest :hello elaenor')
+        self.assertTrue(loadgen.wait_for(lambda: any('Alice' in text for text in loadgen.bot_messages(self.server)
+                                                     if not text.startswith('Welcome'))))
+
+    def test_known_after_restart(self):
+        self.say('Shauna', 'JOIN #loadtest')
+        self.assertTrue(loadgen.wait_for(lambda: loadgen.bot_messages(self.server)))
+        loadgen.stop_bot(self.thread, self.loop)
+        self.say('Shauna', 'QUIT :bye')
+        self.thread, self.loop = loadgen.start_bot()
+        self.assertTrue(loadgen.wait_for(lambda: self.server.run(self.bot_joined)))
+        self.say('Shauna', 'JOIN #loadtest')
+        time.sleep(0.3)
+        self.assertEqual(len(loadgen.bot_messages(self.server)), 1)  # Saved and loaded again: no second welcome
+
+    def test_load(self):
+        load = loadgen.LoadGenerator(self.server, '#loadtest', clients=200, join_rate=400, chat_rate=0, leave_rate=0)
+        load.start()
+        self.assertTrue(loadgen.wait_for(lambda: self.server.run(lambda: len(self.server.members('#loadtest'))) == 201))
+        self.assertTrue(loadgen.wait_for(lambda: loadgen.bot_messages(self.server)))
+        self.server.run(load.stop)
+        self.assertEqual(self.server.flood_kills, [])  # 200 welcomes, but queued: the server never sees a flood
+
+    def tearDown(self):
+        loadgen.stop_bot(self.thread, self.loop)
+        loadgen.restore_settings(self.old_settings)
+        settings.send_burst = self.old_burst
+        self.server.stop()
+        shutil.rmtree(self.workdir)
 
 class TestGreeterString(unittest.TestCase):
 
     def setUp(self):
-        self.bot = botcode.Bot('test_nicks.csv')
+        self.nick_source = make_test_nicks()
+        self.bot = botcode.Bot(self.nick_source)
 
     def test_one_greeter(self):
        greeterstring = botcode.greeter_string(['shauna'])
@@ -225,6 +1277,9 @@ class TestGreeterString(unittest.TestCase):
        greeters = botcode.greeter_string(['shauna','sauna','megafauna'])
        self.assertEqual(greeters, "shauna, sauna, and megafauna")
 
+    def tearDown(self):
+        remove_test_nicks(self.nick_source)
+
 
 # Runs all the unit-tests
 if __name__ == '__main__':
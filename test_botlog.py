@@ -0,0 +1,56 @@
+# Tests for the bot's logging setup (botlog.py)
+
+import os
+import shutil
+import tempfile
+import unittest
+import botlog
+
+
+class TestSetup(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'bot.log')
+
+    def read_log(self):
+        with open(self.path) as log_file:
+            return log_file.read()
+
+    def test_levels(self):
+        handler = botlog.setup('info', self.path)
+        botlog.log.debug('<- %s', 'PING :irc.example.org')
+        botlog.log.info('Reconnecting to %s', 'irc.example.org')
+        handler.close()  # Waits for the writer to catch up
+        text = self.read_log()
+        self.assertIn('INFO Reconnecting to irc.example.org', text)
+        self.assertNotIn('PING', text)
+
+    def test_debug_logs_raw_lines(self):
+        handler = botlog.setup('debug', self.path)
+        botlog.log.debug('<- %s', 'PING :irc.example.org')
+        handler.close()
+        self.assertIn('<- PING :irc.example.org', self.read_log())
+
+    def test_off(self):
+        self.assertEqual(botlog.setup('off'), None)
+        self.assertFalse(botlog.log.isEnabledFor(botlog.LEVELS['error']))
+
+    def test_full_queue_drops(self):
+        handler = botlog.setup('info', self.path)
+        handler.queue.maxsize = 1
+        handler.target.acquire()  # Hold up the writer
+        for i in range(20):
+            botlog.log.info('line %d', i)
+        handler.target.release()
+        handler.close()
+        self.assertTrue(handler.dropped > 0)
+
+    def tearDown(self):
+        botlog.setup('off')
+        shutil.rmtree(self.tmpdir)
+
+
+# Runs all the unit-tests
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+# Tests for IRCv3 capability negotiation (caps.py)
+
+import base64
+import unittest
+import caps
+import ircparse
+
+
+class TestNegotiation(unittest.TestCase):
+
+    def setUp(self):
+        self.sent = []
+        self.negotiation = caps.Negotiation(self.sent.append, 'elaenor', 'hunter2')
+        self.negotiation.start()
+
+    def server(self, line):
+        return self.negotiation.handle(ircparse.parse(line))
+
+    def test_request_what_is_offered(self):
+        self.server(":irc.example.org CAP * LS * :multi-prefix extended-join sasl=PLAIN,EXTERNAL")
+        self.assertEqual(self.sent, ["CAP LS 302\n"])  # More to come
+        self.server(":irc.example.org CAP * LS :account-notify batch")
+        self.assertEqual(self.sent[-1], "CAP REQ :account-notify batch extended-join sasl\n")
+
+    def test_sasl_plain(self):
+        self.server(":irc.example.org CAP * LS :sasl batch")
+        self.server(":irc.example.org CAP * ACK :batch sasl")
+        self.assertEqual(self.negotiation.enabled, set(['batch', 'sasl']))
+        self.assertEqual(self.sent[-1], "AUTHENTICATE PLAIN\n")
+        self.server("AUTHENTICATE +")
+        self.assertEqual(self.sent[-1], "AUTHENTICATE {}\n".format(base64.b64encode('elaenor\0elaenor\0hunter2')))
+        self.server(":irc.example.org 903 elaenor :SASL authentication successful")
+        self.assertTrue(self.negotiation.authenticated)
+        self.assertEqual(self.sent[-1], "CAP END\n")
+
+    def test_sasl_failure_still_ends(self):
+        self.server(":irc.example.org CAP * LS :sasl")
+        self.server(":irc.example.org CAP * ACK :sasl")
+        self.server("AUTHENTICATE +")
+        self.server(":irc.example.org 904 elaenor :SASL authentication failed")
+        self.assertFalse(self.negotiation.authenticated)
+        self.assertEqual(self.sent[-1], "CAP END\n")
+        self.server(":irc.example.org 906 elaenor :Aborted")
+        self.assertEqual(self.sent.count("CAP END\n"), 1)
+
+    def test_long_credentials_chunked(self):
+        self.negotiation.password = 'x' * 600
+        self.negotiation.send_credentials()
+        pieces = [line.split()[1] for line in self.sent[1:]]
+        self.assertEqual([len(piece) for piece in pieces[:-1]], [400, 400])
+        self.assertEqual(base64.b64decode(''.join(pieces)), 'elaenor\0elaenor\0' + 'x' * 600)
+        del self.sent[1:]
+        self.negotiation.password = 'x' * 284  # 300 bytes, exactly 400 in base64
+        self.negotiation.send_credentials()
+        self.assertEqual(self.sent[-1], "AUTHENTICATE +\n")
+
+    def test_no_sasl_without_password_or_plain(self):
+        for password, offer in [(None, 'sasl'), ('hunter2', 'sasl=EXTERNAL')]:
+            del self.sent[:]
+            negotiation = caps.Negotiation(self.sent.append, 'elaenor', password)
+            negotiation.handle(ircparse.parse(":irc.example.org CAP * LS :batch " + offer))
+            self.assertEqual(self.sent, ["CAP REQ :batch\n"])
+            negotiation.handle(ircparse.parse(":irc.example.org CAP * ACK :batch"))
+            self.assertEqual(self.sent[-1], "CAP END\n")
+
+    def test_nothing_wanted(self):
+        self.server(":irc.example.org CAP * LS :multi-prefix")
+        self.server(":irc.example.org CAP * NAK :whatever")
+        self.assertEqual(self.sent, ["CAP LS 302\n", "CAP END\n"])
+
+    def test_other_messages(self):
+        self.assertFalse(self.server(":irc.example.org 001 elaenor :Welcome"))
+
+
+# Runs all the unit-tests
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+# Tests for the event loop (eventloop.py)
+
+import socket
+import threading
+import unittest
+import eventloop
+from fakeclock import fake_clock
+
+
+class TestTimers(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = fake_clock()
+        self.loop = eventloop.EventLoop(clock=self.clock)
+        self.fired = []
+
+    def test_call_later_order(self):
+        self.loop.call_later(2, self.fired.append, 'second')
+        self.loop.call_later(1, self.fired.append, 'first')
+        self.loop.call_later(5, self.fired.append, 'later')
+        self.assertEqual(self.loop.next_timer(), 1)
+        self.clock.now += 2
+        self.loop.run_once(0)
+        self.assertEqual(self.fired, ['first', 'second'])
+        self.assertEqual(self.loop.next_timer(), 3)
+
+    def test_cancel(self):
+        timer = self.loop.call_later(1, self.fired.append, 'cancelled')
+        self.loop.call_later(3, self.fired.append, 'kept')
+        timer.cancel()
+        self.assertEqual(self.loop.next_timer(), 3)
+        self.clock.now += 5
+        self.loop.run_once(0)
+        self.assertEqual(self.fired, ['kept'])
+        self.assertEqual(self.loop.next_timer(), None)
+
+    def test_call_soon_from_callback(self):
+        self.loop.call_soon(lambda: self.loop.call_soon(self.fired.append, 'nested'))
+        self.loop.run_once(0)
+        self.assertEqual(self.fired, ['nested'])
+
+    def test_callback_exceptions_logged(self):
+        ran = []
+        self.loop.call_later(1, lambda: {}['missing'])
+        self.loop.call_later(2, ran.append, 'after')
+        self.clock.now += 2
+        self.loop.run_once(0)  # Doesn't raise...
+        self.assertEqual(ran, ['after'])  # ...and the next callback still runs
+
+    def test_stop(self):
+        self.loop.call_soon(self.loop.stop)
+        self.loop.run_forever()
+        self.assertFalse(self.loop.running)
+
+
+class TestSockets(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = eventloop.EventLoop()
+        self.left, self.right = socket.socketpair()
+        self.events = []
+
+    def test_reader(self):
+        self.loop.add_reader(self.left, lambda: self.events.append(self.left.recv(100)))
+        self.loop.run_once(0)
+        self.assertEqual(self.events, [])
+        self.right.sendall('hello')
+        self.loop.run_once(1)
+        self.assertEqual(self.events, ['hello'])
+        self.assertTrue(self.loop.remove_reader(self.left))
+        self.assertFalse(self.loop.remove_reader(self.left))
+
+    def test_writer(self):
+        self.loop.add_writer(self.left, self.events.append, 'writable')
+        self.loop.run_once(1)
+        self.assertEqual(self.events, ['writable'])
+
+    def test_timer_wakes_select(self):
+        self.loop.add_reader(self.left, self.events.append, 'read')
+        self.loop.call_later(0.01, self.events.append, 'timer')
+        self.loop.run_once()
+        self.assertEqual(self.events, ['timer'])
+
+    def test_call_soon_threadsafe(self):
+        worker = threading.Thread(target=self.loop.call_soon_threadsafe, args=(self.events.append, 'from thread'))
+        worker.start()
+        self.loop.run_once(5)  # Would block the full five seconds without the waker
+        worker.join()
+        self.assertEqual(self.events, ['from thread'])
+
+    def tearDown(self):
+        self.loop.close()
+        self.left.close()
+        self.right.close()
+
+
+# Runs all the unit-tests
+if __name__ == '__main__':
+    unittest.main()
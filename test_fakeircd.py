@@ -0,0 +1,146 @@
+# Tests for the fake IRC server (fakeircd.py) and the load generator (loadgen.py)
+
+import socket
+import unittest
+import fakeircd
+import ircio
+import loadgen
+
+
+class TestFakeIRCd(unittest.TestCase):
+
+    def setUp(self):
+        self.server = fakeircd.FakeIRCd()
+        self.sockets = []
+
+    # A socket client, registered.  The server runs on this thread, a step at a time.
+    def connect(self, nick):
+        sock = socket.create_connection(('127.0.0.1', self.server.port))
+        sock.settimeout(1)
+        self.sockets.append(sock)
+        self.step()
+        self.send(sock, 'CAP LS 302', 'NICK ' + nick, 'USER {} 0 * :Test'.format(nick))
+        return sock
+
+    def step(self):
+        for i in range(3):
+            self.server.loop.run_once(0.01)
+
+    def send(self, sock, *lines):
+        sock.sendall(''.join(line + '\r\n' for line in lines))
+        self.step()
+
+    # Whatever the server has sent the client since last asked.
+    def heard(self, sock):
+        lines = []
+        reader = ircio.LineReader(sock)
+        sock.settimeout(0.05)  # Loopback isn't instant
+        try:
+            while True:
+                lines.extend(reader.read_lines())
+        except (socket.error, ircio.ConnectionClosed):
+            pass
+        sock.settimeout(1)
+        return lines
+
+    def test_registration(self):
+        sock = self.connect('elaenor')
+        heard = self.heard(sock)
+        self.assertEqual(heard[0], ':irc.fake.test CAP * LS :')
+        self.assertTrue(heard[1].startswith(':irc.fake.test 001 elaenor '))
+        self.send(sock, 'PING :irc.fake.test')
+        self.assertEqual(self.heard(sock), [':irc.fake.test PONG irc.fake.test :irc.fake.test'])
+
+    def test_not_registered(self):
+        sock = socket.create_connection(('127.0.0.1', self.server.port))
+        self.sockets.append(sock)
+        self.step()
+        self.send(sock, 'JOIN #falcon')
+        self.assertEqual(self.heard(sock), [':irc.fake.test 451 * :You have not registered'])
+
+    def test_channel_traffic(self):
+        bot = self.connect('elaenor')
+        self.send(bot, 'JOIN #falcon')
+        self.heard(bot)
+        shauna = self.server.connect_virtual('Shauna')
+        shauna.say('JOIN #falcon')
+        shauna.say('PRIVMSG #falcon :hello elaenor')
+        shauna.say('NICK Shauna_afk')
+        shauna.say('QUIT :bye')
+        self.step()
+        self.assertEqual(self.heard(bot), [
+            ':Shauna!Shauna@fake.test JOIN #falcon',
+            ':Shauna!Shauna@fake.test PRIVMSG #falcon :hello elaenor',
+            ':Shauna!Shauna@fake.test NICK :Shauna_afk',
+            ':Shauna_afk!Shauna@fake.test QUIT :Quit: bye',
+        ])
+        self.assertEqual(self.server.privmsgs, [('Shauna', '#falcon', 'hello elaenor')])
+        self.assertEqual([c.nick for c in self.server.members('#falcon')], ['elaenor'])
+
+    def test_names(self):
+        for nick in ['Alice', 'Bob']:
+            self.server.connect_virtual(nick).say('JOIN #falcon')
+        bot = self.connect('elaenor')
+        self.send(bot, 'JOIN #falcon')
+        self.assertEqual(self.heard(bot)[-3:], [
+            ':elaenor!elaenor@fake.test JOIN #falcon',
+            ':irc.fake.test 353 elaenor = #falcon :Alice Bob elaenor',
+            ':irc.fake.test 366 elaenor #falcon :End of /NAMES list.',
+        ])
+
+    def test_nick_in_use(self):
+        self.server.connect_virtual('elaenor')
+        sock = self.connect('elaenor')
+        self.assertEqual(self.heard(sock)[1], ':irc.fake.test 433 * elaenor :Nickname is already in use')
+
+    def test_flood_control(self):
+        sock = self.connect('elaenor')  # Three lines: six seconds of the ten allowed
+        self.send(sock, *['PRIVMSG #falcon :line {}'.format(i) for i in range(10)])
+        self.assertTrue(1 <= len(self.server.privmsgs) <= 3)  # The rest wait their turn
+        client = self.server.nicks['elaenor']
+        self.assertEqual(len(client.pending) + len(self.server.privmsgs), 10)
+        self.server.flood_cost = 0
+        client.penalty = 0
+        self.server.pump(client)
+        self.assertEqual(len(self.server.privmsgs), 10)
+
+    def test_excess_flood(self):
+        self.server.max_recvq = 5
+        sock = self.connect('elaenor')
+        self.send(sock, *['PRIVMSG #falcon :line {}'.format(i) for i in range(20)])
+        self.assertEqual(self.server.flood_kills, ['elaenor'])
+        self.assertIn('ERROR :Closing Link: (Excess Flood)', self.heard(sock))
+
+    def tearDown(self):
+        for sock in self.sockets:
+            sock.close()
+        self.server.stop()
+
+class TestLoadGenerator(unittest.TestCase):
+
+    def setUp(self):
+        self.server = fakeircd.FakeIRCd()
+        self.load = loadgen.LoadGenerator(self.server, clients=50, join_rate=100, chat_rate=20, leave_rate=10)
+
+    def test_load(self):
+        self.load.step()
+        self.assertEqual(self.load.joined, 10)
+        for i in range(10):
+            self.load.step()
+        self.assertEqual(self.load.joined, 50)
+        self.assertEqual(self.load.said, 22)
+        present = self.server.members(loadgen.CHANNEL)
+        self.assertEqual(len(present), len(self.load.present))
+        self.assertTrue(40 <= len(present) < 50)
+
+    def test_user_nick(self):
+        self.assertEqual([loadgen.user_nick(n) for n in [0, 25, 26, 676]], ['usera', 'userz', 'userba', 'userbaa'])
+
+    def tearDown(self):
+        self.load.stop()
+        self.server.stop()
+
+
+# Runs all the unit-tests
+if __name__ == '__main__':
+    unittest.main()
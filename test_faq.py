@@ -0,0 +1,108 @@
+# Tests for canned answers and cooldowns (faq.py)
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import faq
+from fakeclock import fake_clock
+
+
+class TestReply(unittest.TestCase):
+
+    def test_render(self):
+        reply = faq.Reply('Welcome {newcomer}! Ask {greeter_string}, {newcomer}.', 'newcomer', greeter_string='kgriffs')
+        self.assertEqual(reply.render('Shauna'), 'Welcome Shauna! Ask kgriffs, Shauna.')
+        self.assertEqual(reply.render('{greeter_string}'), 'Welcome {greeter_string}! Ask kgriffs, {greeter_string}.')
+
+
+class TestFAQ(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'faq.json')
+        self.write({
+            'install': {'keywords': ['install', 'pip'], 'answer': '{nick}: pip install falcon'},
+            'docs': {'answer': ['{nick}: see the docs', 'or ask {greeter_string} in {channel}']},
+        })
+        self.faq = faq.FAQ(self.path)
+
+    def write(self, config, mtime=None):
+        with open(self.path, 'w') as faq_file:
+            json.dump(config, faq_file)
+        if mtime is not None:
+            os.utime(self.path, (mtime, mtime))
+
+    def test_load(self):
+        self.assertTrue(self.faq.refresh())
+        self.assertEqual([(e.name, e.keywords) for e in self.faq.entries], [('docs', ['docs']), ('install', ['install', 'pip'])])
+        self.assertFalse(self.faq.refresh())  # Unchanged
+
+    def test_reply(self):
+        self.faq.refresh()
+        docs = self.faq.entries[0]
+        reply = docs.reply('#falcon', 'elaenor', 'kgriffs')
+        self.assertEqual([line.render('Shauna') for line in reply],
+                         ['PRIVMSG #falcon :Shauna: see the docs\n', 'PRIVMSG #falcon :or ask kgriffs in #falcon\n'])
+        self.assertTrue(docs.reply('#falcon', 'elaenor', 'kgriffs') is reply)  # Cached...
+        self.assertFalse(docs.reply('#falcon', 'elaenor', 'kgriffs and jvrbanac') is reply)  # ...per greeters
+
+    def test_reload(self):
+        self.faq.refresh()
+        self.write({'install': {'answer': 'pip install falcon'}}, mtime=1)
+        self.assertTrue(self.faq.refresh())
+        self.assertEqual([e.name for e in self.faq.entries], ['install'])
+
+    def test_bad_file_keeps_entries(self):
+        self.faq.refresh()
+        with open(self.path, 'w') as faq_file:
+            faq_file.write('{"install": ')
+        os.utime(self.path, (1, 1))
+        self.assertFalse(self.faq.refresh())
+        self.assertEqual(len(self.faq.entries), 2)
+        self.write({'install': {'answer': '{nickname}: pip install falcon'}}, mtime=2)
+        self.assertFalse(self.faq.refresh())  # Bad template
+        self.assertEqual(len(self.faq.entries), 2)
+
+    def test_missing_file(self):
+        os.remove(self.path)
+        self.assertFalse(self.faq.refresh())
+        self.assertEqual(self.faq.entries, [])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+
+class TestCooldowns(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = fake_clock()
+        self.cooldowns = faq.Cooldowns(per_user=300, per_channel=30, clock=self.clock)
+
+    def test_per_user(self):
+        self.assertTrue(self.cooldowns.ready('Shauna', 'help', '#falcon'))
+        self.clock.now += 60
+        self.assertFalse(self.cooldowns.ready('shauna', 'help', '#falcon'))
+        self.assertTrue(self.cooldowns.ready('Shauna', 'hello', '#falcon'))
+        self.clock.now += 300
+        self.assertTrue(self.cooldowns.ready('Shauna', 'help', '#falcon'))
+
+    def test_per_channel(self):
+        self.assertTrue(self.cooldowns.ready('Shauna', 'help', '#falcon'))
+        self.assertFalse(self.cooldowns.ready('Roger', 'help', '#falcon'))
+        self.assertTrue(self.cooldowns.ready('Roger', 'help', '#falcon-dev'))
+        self.clock.now += 30
+        self.assertTrue(self.cooldowns.ready('Erin', 'help', '#falcon'))
+
+    def test_prune(self):
+        self.cooldowns.ready('Shauna', 'help', '#falcon')
+        self.clock.now += 300
+        self.cooldowns.ready('Roger', 'help', '#falcon')
+        self.cooldowns.prune(self.clock.now)
+        self.assertEqual(list(self.cooldowns.users), [('roger', 'help')])
+
+
+# Runs all the unit-tests
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,184 @@
+# Tests for the socket helpers (ircio.py)
+
+import unittest
+import eventloop
+import ircio
+import metrics
+from fakeclock import fake_clock
+
+
+# Hands out pre-recorded chunks of server output, one per recv.
+class fake_server_sock(object):
+
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+        self.recv_sizes = []
+
+    def recv(self, bufsize):
+        self.recv_sizes.append(bufsize)
+        if self.chunks:
+            return self.chunks.pop(0)
+        return ''
+
+
+# Records what is written to it.
+class fake_client_sock(object):
+
+    def __init__(self):
+        self.writes = []
+
+    def sendall(self, data):
+        self.writes.append(data)
+
+
+class TestLineReader(unittest.TestCase):
+
+    def read_all(self, chunks):
+        reader = ircio.LineReader(fake_server_sock(chunks))
+        lines = []
+        for i in range(len(chunks)):
+            lines.extend(reader.read_lines())
+        return lines, reader
+
+    def test_coalesced_lines(self):
+        lines, reader = self.read_all([':a!a@h JOIN #chan\r\nPING :server\r\n'])
+        self.assertEqual(lines, [':a!a@h JOIN #chan', 'PING :server'])
+        self.assertEqual(reader.buffer, '')
+
+    def test_fragmented_line(self):
+        lines, reader = self.read_all(['PI', 'NG :ser', 'ver\r', '\n:b!b@h PART #c', 'han\r\n'])
+        self.assertEqual(lines, ['PING :server', ':b!b@h PART #chan'])
+
+    def test_partial_line_is_held(self):
+        lines, reader = self.read_all(['PING :one\r\nPING :tw'])
+        self.assertEqual(lines, ['PING :one'])
+        self.assertEqual(reader.buffer, 'PING :tw')
+
+    def test_bare_newlines_and_blank_lines(self):
+        lines, reader = self.read_all(['PING :one\n\r\n\nPING :two\n'])
+        self.assertEqual(lines, ['PING :one', 'PING :two'])
+
+    def test_large_reads(self):
+        sock = fake_server_sock(['PING :one\r\n'])
+        list(ircio.LineReader(sock).read_lines())
+        self.assertEqual(sock.recv_sizes, [65536])
+
+    def test_overlong_line_dropped(self):
+        reader = ircio.LineReader(fake_server_sock(['x' * 20, 'y\r\nPING :ok\r\n']), max_line=16)
+        self.assertEqual(list(reader.read_lines()), [])
+        self.assertEqual(list(reader.read_lines()), ['y', 'PING :ok'])
+
+    def test_connection_closed(self):
+        reader = ircio.LineReader(fake_server_sock([]))
+        self.assertRaises(ircio.ConnectionClosed, list, reader.read_lines())
+
+
+class TestSendQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.sock = fake_client_sock()
+        self.clock = fake_clock()
+        self.sendq = ircio.SendQueue(self.sock, rate=0.5, burst=3, clock=self.clock)
+
+    def test_nothing_queued(self):
+        self.assertEqual(self.sendq.next_flush(), None)
+        self.assertEqual(self.sendq.flush(), 0)
+        self.assertEqual(self.sock.writes, [])
+
+    def test_burst_coalesced(self):
+        for i in range(3):
+            self.sendq.send("PRIVMSG #chan :{}\n".format(i))
+        self.assertEqual(self.sendq.next_flush(), 0)
+        self.assertEqual(self.sendq.flush(), 3)
+        self.assertEqual(self.sock.writes, ["PRIVMSG #chan :0\nPRIVMSG #chan :1\nPRIVMSG #chan :2\n"])
+
+    def test_flood_limit(self):
+        for i in range(5):
+            self.sendq.send("PRIVMSG #chan :{}\n".format(i))
+        self.sendq.flush()
+        self.assertEqual(len(self.sendq), 2)
+        self.assertEqual(self.sendq.next_flush(), 2.0)
+        self.assertEqual(self.sendq.flush(), 0)
+        self.clock.now += 2
+        self.assertEqual(self.sendq.flush(), 1)
+        self.assertEqual(self.sock.writes[-1], "PRIVMSG #chan :3\n")
+
+    def test_pong_first(self):
+        for i in range(4):
+            self.sendq.send("PRIVMSG #chan :{}\n".format(i))
+        self.sendq.flush()
+        self.sendq.send("PONG :server\n")
+        self.assertEqual(self.sendq.next_flush(), 0)
+        self.assertEqual(self.sendq.flush(), 1)  # Tokens are spent, but the PONG still goes
+        self.assertEqual(self.sock.writes[-1], "PONG :server\n")
+        self.clock.now += 2
+        self.sendq.send("PONG :again\n")
+        self.sendq.flush()
+        self.assertEqual(self.sock.writes[-1], "PONG :again\nPRIVMSG #chan :3\n")
+
+    def test_stats(self):
+        self.sendq.send("PRIVMSG #chan :hi\n")
+        self.clock.now += 0.25
+        self.sendq.flush()
+        stats = self.sendq.stats()
+        self.assertEqual(stats['depth'], 0)
+        self.assertEqual(stats['max_depth'], 1)
+        self.assertEqual(stats['lines_sent'], 1)
+        self.assertEqual(stats['bytes_sent'], len("PRIVMSG #chan :hi\n"))
+        self.assertEqual(stats['latency_max'], 0.25)
+
+    def test_metrics(self):
+        self.sendq.name = 'irc.example.org'
+        latency = list(metrics.registry.timers.get('send_latency', [0, 0.0, 0.0]))
+        for i in range(5):
+            self.sendq.send("PRIVMSG #chan :{}\n".format(i))
+        self.assertEqual(metrics.registry.gauge('send_queue_depth', 'irc.example.org'), 5)
+        self.clock.now += 0.5
+        self.sendq.flush()
+        self.assertEqual(metrics.registry.gauge('send_queue_depth', 'irc.example.org'), 2)
+        timer = metrics.registry.timers['send_latency']
+        self.assertEqual(timer[0], latency[0] + 3)
+        self.assertAlmostEqual(timer[1], latency[1] + 1.5)
+        self.sendq.close()
+        self.assertEqual(metrics.registry.gauge('send_queue_depth', 'irc.example.org'), 0)
+
+
+class TestSendQueueOnLoop(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = fake_clock()
+        self.loop = eventloop.EventLoop(clock=self.clock)
+        self.sock = fake_client_sock()
+        self.sendq = ircio.SendQueue(self.sock, rate=0.5, burst=1, clock=self.clock, loop=self.loop)
+
+    def writable(self):
+        for callback, args in list(self.loop.writers.values()):
+            callback(*args)
+
+    def test_flush_when_writable(self):
+        self.sendq.send("PRIVMSG #chan :0\n")
+        self.sendq.send("PRIVMSG #chan :1\n")
+        self.assertIn(self.sock, self.loop.writers)
+        self.writable()
+        self.assertEqual(self.sock.writes, ["PRIVMSG #chan :0\n"])
+        self.assertNotIn(self.sock, self.loop.writers)  # Waiting on the bucket now
+        self.assertEqual(self.loop.next_timer(), 2.0)
+        self.clock.now += 2
+        self.loop.run_once(0)
+        self.writable()
+        self.assertEqual(self.sock.writes[-1], "PRIVMSG #chan :1\n")
+        self.assertEqual(self.loop.next_timer(), None)
+
+    def test_pong_interrupts_wait(self):
+        self.sendq.send("PRIVMSG #chan :0\n")
+        self.writable()
+        self.sendq.send("PRIVMSG #chan :1\n")
+        self.sendq.send("PONG :server\n")
+        self.assertIn(self.sock, self.loop.writers)
+        self.writable()
+        self.assertEqual(self.sock.writes[-1], "PONG :server\n")
+
+
+# Runs all the unit-tests
+if __name__ == '__main__':
+    unittest.main()
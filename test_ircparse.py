@@ -0,0 +1,56 @@
+# Tests for the IRC message parser (ircparse.py)
+
+import unittest
+import ircparse
+
+
+class TestParse(unittest.TestCase):
+
+    def test_good_string(self):
+        msg = ircparse.parse(":vader!darth@darkside.org PRIVMSG #deathstar : I find your lack of faith disturbing")
+        self.assertEqual(msg.prefix, 'vader!darth@darkside.org')
+        self.assertEqual(msg.nick, 'vader')
+        self.assertEqual(msg.command, 'PRIVMSG')
+        self.assertEqual(msg.params, ['#deathstar', ' I find your lack of faith disturbing'])
+        self.assertEqual(msg.target, '#deathstar')
+        self.assertEqual(msg.text, ' I find your lack of faith disturbing')
+        self.assertEqual(msg.tags, {})
+
+    def test_bad_string(self):
+        self.assertEqual(ircparse.parse(""), None)
+        self.assertEqual(ircparse.parse(":vader!darth@darkside.org"), None)
+        self.assertEqual(ircparse.parse("@time=now"), None)
+
+    def test_no_prefix(self):
+        msg = ircparse.parse("PING :irc.example.org")
+        self.assertEqual((msg.prefix, msg.nick), (None, None))
+        self.assertEqual(msg.command, 'PING')
+        self.assertEqual(msg.text, 'irc.example.org')
+
+    def test_middle_params_only(self):
+        msg = ircparse.parse(":nick!u@h join   #chan")
+        self.assertEqual(msg.command, 'JOIN')
+        self.assertEqual(msg.params, ['#chan'])
+        self.assertEqual(msg.trailing, None)
+
+    def test_empty_trailing(self):
+        msg = ircparse.parse(":nick!u@h PART #chan :")
+        self.assertEqual(msg.params, ['#chan', ''])
+        self.assertEqual(msg.trailing, '')
+
+    def test_numeric_from_server(self):
+        msg = ircparse.parse(":irc.example.org 353 bot = #chan :alice @bob +carol")
+        self.assertEqual(msg.nick, 'irc.example.org')
+        self.assertEqual(msg.command, '353')
+        self.assertEqual(msg.params, ['bot', '=', '#chan', 'alice @bob +carol'])
+
+    def test_tags(self):
+        msg = ircparse.parse(r"@account=vader;time=2016-01-01T00:00:00Z;msg=a\sb\:c\\d;flag :vader!d@h JOIN #deathstar")
+        self.assertEqual(msg.tags, {'account': 'vader', 'time': '2016-01-01T00:00:00Z', 'msg': 'a b;c\\d', 'flag': ''})
+        self.assertEqual(msg.nick, 'vader')
+        self.assertEqual(msg.command, 'JOIN')
+
+
+# Runs all the unit-tests
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+# Tests for the metrics registry and its endpoint (metrics.py)
+
+import os
+import shutil
+import tempfile
+import unittest
+import urllib2
+import metrics
+
+
+class TestRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = metrics.Registry()
+
+    def test_counters(self):
+        self.registry.incr('lines_parsed', 'JOIN')
+        self.registry.incr('lines_parsed', 'JOIN')
+        self.registry.incr('bytes_sent', n=120)
+        self.assertEqual(self.registry.count('lines_parsed', 'JOIN'), 2)
+        self.assertEqual(self.registry.count('lines_parsed', 'PART'), 0)
+        self.assertEqual(self.registry.count('bytes_sent'), 120)
+
+    def test_render(self):
+        self.registry.incr('lines_parsed', 'PRIVMSG', n=3)
+        self.registry.incr('lines_parsed', 'a"b')
+        self.registry.incr('newcomers_welcomed')
+        self.registry.observe('message_response', 0.5)
+        self.registry.observe('message_response', 0.25)
+        text = self.registry.render().splitlines()
+        self.assertIn('# TYPE welcomebot_lines_parsed_total counter', text)
+        self.assertIn('welcomebot_lines_parsed_total{command="PRIVMSG"} 3', text)
+        self.assertIn('welcomebot_lines_parsed_total{command="a\\"b"} 1', text)
+        self.assertIn('welcomebot_newcomers_welcomed_total 1', text)
+        self.assertIn('welcomebot_message_response_seconds_count 2', text)
+        self.assertIn('welcomebot_message_response_seconds_sum 0.750000', text)
+        self.assertIn('welcomebot_message_response_seconds_max 0.500000', text)
+
+    def test_gauges(self):
+        self.registry.set('send_queue_depth', 4, 'irc.example.org')
+        self.registry.set('send_queue_depth', 2, 'irc.example.org')
+        self.assertEqual(self.registry.gauge('send_queue_depth', 'irc.example.org'), 2)
+        text = self.registry.render().splitlines()
+        self.assertIn('# TYPE welcomebot_send_queue_depth gauge', text)
+        self.assertIn('welcomebot_send_queue_depth{server="irc.example.org"} 2', text)
+
+    def test_serve(self):
+        self.registry.incr('writes')
+        server = metrics.serve(0, registry=self.registry)
+        try:
+            url = 'http://127.0.0.1:{}/metrics'.format(server.server_address[1])
+            self.assertIn('welcomebot_writes_total 1', urllib2.urlopen(url).read())
+            self.assertRaises(urllib2.HTTPError, urllib2.urlopen, url + '/nothing')
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_dump(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'welcomebot.prom')
+            self.registry.incr('writes')
+            metrics.dump(path, self.registry)
+            with open(path) as dump_file:
+                self.assertEqual(dump_file.read(), self.registry.render())
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+# Runs all the unit-tests
+if __name__ == '__main__':
+    unittest.main()
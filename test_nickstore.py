@@ -0,0 +1,346 @@
+# Tests for the nick store (nickstore.py)
+
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import unittest
+import eventloop
+import metrics
+import nickstore
+
+
+class TestJournalNickStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'nicks.json')
+        with open(self.path, 'w') as nick_file:
+            json.dump({'nicks': ['alice', 'bob']}, nick_file, indent=4)
+        self.store = nickstore.JournalNickStore(self.path, compact_every=3)
+        self.store.load()
+
+    def test_load_snapshot(self):
+        self.assertEqual(set(self.store), set(['alice', 'bob']))
+        self.assertIn('alice', self.store)
+        self.assertNotIn('roger', self.store)
+
+    def test_add_appends_to_journal(self):
+        self.assertTrue(self.store.add('roger'))
+        self.assertFalse(self.store.add('roger'))
+        self.assertEqual(nickstore.read_nick_file(self.path), ['alice', 'bob'])
+        self.assertEqual(list(nickstore.read_journal(self.store.journal_path)), ['roger'])
+
+    def test_load_replays_journal(self):
+        self.store.add('roger')
+        self.store.close()
+        store = nickstore.JournalNickStore(self.path)
+        store.load()
+        self.assertEqual(set(store), set(['alice', 'bob', 'roger']))
+        self.assertEqual(store.journal_size, 1)
+
+    def test_compaction(self):
+        saves = metrics.registry.timers.get('save_nicks', [0])[0]
+        for nick in ['carol', 'dave', 'erin']:
+            self.store.add(nick)
+        self.assertEqual(nickstore.read_nick_file(self.path),
+                         ['alice', 'bob', 'carol', 'dave', 'erin'])
+        self.assertEqual(list(nickstore.read_journal(self.store.journal_path)), [])
+        self.assertEqual(self.store.journal_size, 0)
+        self.assertEqual(metrics.registry.timers['save_nicks'][0], saves + 1)  # Timed
+
+    def test_torn_journal_line(self):
+        self.store.add('roger')
+        self.store.close()
+        with open(self.store.journal_path, 'a') as journal:
+            journal.write('"hal')  # The bot died mid-write
+        store = nickstore.JournalNickStore(self.path)
+        store.load()
+        self.assertEqual(set(store), set(['alice', 'bob', 'roger']))
+
+    def test_missing_files(self):
+        store = nickstore.JournalNickStore(os.path.join(self.tmpdir, 'new.json'))
+        store.load()
+        self.assertEqual(len(store), 0)
+
+    def test_import_json_nicks(self):
+        legacy = os.path.join(self.tmpdir, 'legacy.json')
+        with open(legacy, 'w') as nick_file:
+            json.dump({'nicks': ['bob', 'zed']}, nick_file, indent=4)
+        self.assertEqual(nickstore.import_json_nicks(legacy, self.store), 2)
+        self.assertEqual(nickstore.read_nick_file(self.path), ['alice', 'bob', 'zed'])
+
+    def test_iter_nick_file(self):
+        nicks = ['alice', 'b\\ob', 'qu"ote', u'zo\xeb', 'x' * 50]
+        with open(self.path, 'w') as nick_file:
+            json.dump({'nicks': nicks}, nick_file, indent=4)
+        for chunk_size in [1, 3, 7, 65536]:
+            self.assertEqual(list(nickstore.iter_nick_file(self.path, chunk_size)), nicks)
+
+    def test_non_ascii_nicks(self):
+        self.store.add(u'zo\xeb')  # From the journal or snapshot, nicks come back as unicode...
+        self.store.close()
+        store = nickstore.JournalNickStore(self.path, compact_every=3)
+        store.load()
+        self.assertIn('zo\xc3\xab', store)  # ...and from the socket, as UTF-8
+        self.assertFalse(store.add('zo\xc3\xab'))
+        self.assertTrue(store.add('j\xc3\xbcrgen'))
+        store.add('roger')  # Compacts
+        self.assertEqual(nickstore.read_nick_file(self.path), ['alice', 'bob', u'j\xfcrgen', 'roger', u'zo\xeb'])
+        store.close()
+
+    def test_background_load(self):
+        store = nickstore.JournalNickStore(self.path)
+        self.assertFalse(store.loaded)
+        store.add('roger')  # Joined while the snapshot is being read
+        snapshot = store.read_snapshot()
+        self.assertNotIn('roger', snapshot)
+        store.finish_load(snapshot)
+        self.assertTrue(store.loaded)
+        self.assertEqual(set(store), set(['alice', 'bob', 'roger']))
+        store.close()
+
+    def test_no_compaction_before_load(self):
+        store = nickstore.JournalNickStore(self.path, compact_every=1)
+        store.add('roger')
+        self.assertEqual(nickstore.read_nick_file(self.path), ['alice', 'bob'])  # Not clobbered
+        store.finish_load(store.read_snapshot())
+        self.assertEqual(set(store), set(['alice', 'bob', 'roger']))
+        store.close()
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.tmpdir)
+
+
+class TestCompactNickStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'nicks.db')
+        self.store = nickstore.CompactNickStore(self.path, compact_every=3)
+        self.store.load()
+        self.store.update([u'bob', u'alice', u'zo\xeb'])
+
+    def reopen(self):
+        self.store.close()
+        self.store = nickstore.CompactNickStore(self.path, compact_every=3)
+        self.store.load()
+
+    def test_membership(self):
+        self.reopen()
+        for nick in [u'alice', 'alice', u'bob', u'zo\xeb']:
+            self.assertIn(nick, self.store)
+        for nick in ['', 'al', 'alicea', 'carol', 'zz']:
+            self.assertNotIn(nick, self.store)
+        self.assertEqual(len(self.store), 3)
+
+    def test_sorted_on_disk(self):
+        self.reopen()
+        self.assertEqual(list(self.store), ['alice', 'bob', 'zo\xc3\xab'])  # Encoded, as every store keeps them
+
+    def test_add_journaled_then_compacted(self):
+        self.assertTrue(self.store.add('carol'))
+        self.assertFalse(self.store.add('carol'))
+        self.assertFalse(self.store.add('alice'))
+        self.assertEqual(self.store.count, 3)  # Not merged yet...
+        self.reopen()
+        self.assertIn('carol', self.store)  # ...but replayed from the journal
+        self.store.add('dave')
+        self.store.add('erin')
+        self.assertEqual(self.store.count, 6)  # Merged
+        self.assertEqual(len(self.store.nicks), 0)
+        self.assertEqual(list(nickstore.read_journal(self.store.journal_path)), [])
+        self.assertEqual(list(self.store), ['alice', 'bob', 'carol', 'dave', 'erin', 'zo\xc3\xab'])
+
+    def test_compaction_waits_for_growth(self):
+        self.store.update('nick{}'.format(i) for i in range(500))
+        self.store.GROWTH = 0.01  # Compact every 5 nicks, not every 3
+        for nick in ['carol', 'dave', 'erin', 'fran']:
+            self.store.add(nick)
+        self.assertEqual(self.store.count, 503)
+        self.store.add('gail')
+        self.assertEqual(self.store.count, 508)
+
+    def test_background_compaction(self):
+        loop = eventloop.EventLoop()
+        self.store.loop = loop
+        for nick in ['carol', 'dave', 'erin']:
+            self.store.add(nick)
+        self.assertIsNotNone(self.store.merger)
+        self.store.add('fran')  # Journaled afresh while the merge runs
+        self.assertEqual(len(self.store), 7)
+        self.assertIn('dave', self.store)
+        self.assertEqual(list(nickstore.read_journal(self.store.merging_path)), ['carol', 'dave', 'erin'])
+        while self.store.merger is not None:
+            loop.run_once(1)
+        self.assertEqual(self.store.count, 6)
+        self.assertEqual(len(self.store), 7)
+        self.assertFalse(os.path.exists(self.store.merging_path))
+        self.assertIn('save_nicks', metrics.registry.timers)
+        self.reopen()
+        self.assertEqual(list(self.store), ['alice', 'bob', 'carol', 'dave', 'erin', 'zo\xc3\xab', 'fran'])
+        loop.close()
+
+    def test_failed_compaction_retried(self):
+        loop = eventloop.EventLoop()
+        self.store.loop = loop
+        self.store._merge = lambda added: 1 / 0
+        for nick in ['carol', 'dave', 'erin']:
+            self.store.add(nick)
+        self.store.wait()
+        self.assertEqual((self.store.count, len(self.store)), (3, 6))
+        self.assertIn('carol', self.store)
+        self.store.add('fran')
+        self.reopen()  # Replays the unfinished merge and the new journal
+        self.assertEqual(len(self.store.nicks), 4)
+        self.store.save()
+        self.assertEqual(self.store.count, 7)
+        self.assertFalse(os.path.exists(self.store.merging_path))
+        loop.close()
+
+    def test_save_after_failed_compaction(self):
+        loop = eventloop.EventLoop()
+        self.store.loop = loop
+        merge, self.store._merge = self.store._merge, lambda added: 1 / 0
+        for nick in ['carol', 'dave', 'erin']:
+            self.store.add(nick)
+        self.store.wait()
+        self.store._merge = merge
+        self.store.save()  # Nothing journaled since
+        self.assertEqual(self.store.count, 6)
+        self.assertFalse(os.path.exists(self.store.merging_path))
+        loop.close()
+
+    def test_unfinished_merge_without_journal(self):
+        self.store.close()
+        with open(self.store.merging_path, 'w') as merging:
+            merging.write('"carol"\n')  # Set aside for a merge, then the bot went down
+        self.reopen()
+        self.assertFalse(os.path.exists(self.store.journal_path))
+        self.store.save()
+        self.assertEqual(self.store.count, 4)
+        self.assertFalse(os.path.exists(self.store.merging_path))
+
+    def test_non_ascii_nicks(self):
+        self.assertFalse(self.store.add('zo\xc3\xab'))
+        self.assertTrue(self.store.add('j\xc3\xbcrgen'))
+        self.reopen()
+        self.assertFalse(self.store.add(u'j\xfcrgen'))
+        self.assertIn('j\xc3\xbcrgen', self.store)
+
+    def test_bloom_filter_rejects_unknown_nicks(self):
+        nicks = ['nick{}'.format(i) for i in range(2000)]
+        self.store.update(nicks)
+        searches = []
+        nick_at = self.store._nick_at
+        self.store._nick_at = lambda i: searches.append(i) or nick_at(i)
+        misses = sum(1 for i in range(1000) if 'guest{}'.format(i) in self.store)
+        self.assertEqual(misses, 0)
+        self.assertTrue(len(searches) < 500, len(searches))  # Without the filter: ~11 per miss
+        self.assertTrue(all('nick{}'.format(i) in self.store for i in range(0, 2000, 7)))
+
+    def test_empty_store(self):
+        store = nickstore.CompactNickStore(os.path.join(self.tmpdir, 'new.db'))
+        store.load()
+        self.assertNotIn('alice', store)
+        self.assertEqual(len(store), 0)
+        store.add('alice')
+        self.assertIn('alice', store)
+
+    def test_not_a_nick_file(self):
+        with open(os.path.join(self.tmpdir, 'nicks.json'), 'w') as nick_file:
+            json.dump({'nicks': ['alice'] * 10}, nick_file)
+        store = nickstore.CompactNickStore(os.path.join(self.tmpdir, 'nicks.json'))
+        self.assertRaises(ValueError, store.load)
+
+    def test_import_json_nicks(self):
+        legacy = os.path.join(self.tmpdir, 'legacy.json')
+        with open(legacy, 'w') as nick_file:
+            json.dump({'nicks': ['bob', 'zed']}, nick_file, indent=4)
+        nickstore.import_json_nicks(legacy, self.store)
+        self.reopen()
+        self.assertEqual(list(self.store), ['alice', 'bob', 'zed', 'zo\xc3\xab'])
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.tmpdir)
+
+
+# Adds nicks to a shared store from another process.
+def add_nicks(path, nicks):
+    store = nickstore.SQLiteNickStore(path, flush_every=7)
+    store.load()
+    for nick in nicks:
+        store.add(nick)
+    store.close()
+
+class TestSQLiteNickStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'nicks.sqlite')
+        self.store = self.open()
+
+    def open(self):
+        store = nickstore.SQLiteNickStore(self.path, flush_every=3)
+        store.load()
+        return store
+
+    def test_batched_writes(self):
+        other = self.open()  # Another process, as far as the database is concerned
+        self.assertTrue(self.store.add('alice'))
+        self.assertFalse(self.store.add('alice'))
+        self.store.add('bob')
+        self.assertNotIn('alice', other)  # Still buffered
+        self.store.add('carol')
+        self.assertIn('alice', other)  # Three: written together
+        self.assertEqual(self.store.pending, set())
+        self.store.add('dave')
+        self.store.flush()
+        self.assertEqual(sorted(other), ['alice', 'bob', 'carol', 'dave'])
+        other.close()
+
+    def test_shared(self):
+        other = self.open()
+        other.update(['alice', u'zo\xeb'])
+        self.assertIn('alice', self.store)
+        self.assertIn(u'zo\xeb', self.store)
+        self.assertFalse(self.store.add('alice'))
+        self.assertNotIn('bob', self.store)
+        self.assertEqual(len(self.store), 2)
+        other.close()
+
+    def test_close_flushes(self):
+        self.store.add('alice')
+        self.store.close()
+        self.store = self.open()
+        self.assertIn('alice', self.store)
+
+    def test_adds_before_load(self):
+        store = nickstore.SQLiteNickStore(self.path, flush_every=1)
+        store.add('alice')
+        self.assertIn('alice', store)
+        store.load()
+        store.flush()
+        self.assertIn('alice', self.store)
+        store.close()
+
+    def test_concurrent_processes(self):
+        workers = [multiprocessing.Process(target=add_nicks, args=(self.path, ['nick{}_{}'.format(w, i) for i in range(200)] + ['shared']))
+                   for w in range(4)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.assertEqual([worker.exitcode for worker in workers], [0] * 4)
+        self.assertEqual(len(self.store), 801)  # No lost updates
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.tmpdir)
+
+# Runs all the unit-tests
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+# Tests for running the bot as several worker processes (shard.py)
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import bot_settings as settings
+import fakeircd
+import loadgen
+import nickstore
+import shard
+
+
+NETWORKS = [
+    {'server': 'irc.one.test', 'botnick': 'elaenor', 'channels': {'#a': {}, '#b': {'wait_time': 5}, '#c': {}}},
+    {'server': 'irc.two.test', 'channels': {'#d': {}}},
+]
+
+class TestAssignChannels(unittest.TestCase):
+
+    def test_even_split(self):
+        shares = shard.assign_channels(NETWORKS, 2)
+        self.assertEqual([shard.describe(share) for share in shares],
+                         ['#a,#c on irc.one.test', '#b on irc.one.test, #d on irc.two.test'])
+        self.assertEqual(shares[1][0]['channels'], {'#b': {'wait_time': 5}})
+        self.assertEqual([config['botnick'] for config in shares[0] + shares[1]], ['elaenor', 'elaenor1', 'elaenor1'])
+        self.assertEqual(shares[1][1]['botnick'], shard.shard_nick(settings.botnick, 1))
+        self.assertNotIn('botnick', NETWORKS[1])  # Left as it was
+
+    def test_more_workers_than_channels(self):
+        shares = shard.assign_channels(NETWORKS, 10)
+        self.assertEqual(len(shares), 4)
+        self.assertEqual(sorted(len(share) for share in shares), [1, 1, 1, 1])
+
+    def test_one_worker(self):
+        shares = shard.assign_channels(NETWORKS, 1)
+        self.assertEqual([sorted(config['channels']) for config in shares[0]], [['#a', '#b', '#c'], ['#d']])
+        self.assertEqual(shares[0][0]['botnick'], 'elaenor')
+
+class TestConfigureWorker(unittest.TestCase):
+
+    NAMES = ['networks', 'nick_backend', 'pending_source', 'metrics_port', 'metrics_dump_path']
+
+    def setUp(self):
+        self.old = dict((name, getattr(settings, name)) for name in self.NAMES)
+
+    def test_worker_files(self):
+        settings.pending_source = 'pending.json'
+        settings.metrics_port = 9100
+        settings.metrics_dump_path = None
+        shard.configure_worker(2, NETWORKS[1:])
+        self.assertEqual(settings.networks, NETWORKS[1:])
+        self.assertEqual(settings.nick_backend, 'sqlite')
+        self.assertEqual(settings.pending_source, 'pending.json.2')
+        self.assertEqual(settings.metrics_port, 9102)
+        self.assertEqual(settings.metrics_dump_path, None)
+
+    def tearDown(self):
+        loadgen.restore_settings(self.old)
+
+# Two worker processes against the fake server, sharing their known nicks
+class TestSupervisor(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.server = fakeircd.FakeIRCd()
+        self.server.start()
+        self.old = loadgen.configure_bot(self.server.port, self.workdir)
+        network = dict(settings.networks[0], channels=dict((channel, {'wait_time': 0.2})
+                                                           for channel in ['#a', '#b', '#c', '#d']))
+        self.old['sqlite_nick_source'] = settings.sqlite_nick_source
+        self.old['nick_flush_every'] = settings.nick_flush_every
+        settings.sqlite_nick_source = os.path.join(self.workdir, 'nicks.sqlite')
+        settings.nick_flush_every = 1
+        self.supervisor = shard.Supervisor(2, [network], restart_delay=0.1)
+        self.thread = threading.Thread(target=self.supervisor.run, kwargs={'interval': 0.05})
+        self.thread.start()
+
+    def joined(self, nick, channel):
+        return self.server.run(lambda: nick in [c.nick for c in self.server.members(channel)])
+
+    def test_workers(self):
+        for nick, channels in [('elaenor', ['#a', '#c']), ('elaenor1', ['#b', '#d'])]:
+            for channel in channels:
+                self.assertTrue(loadgen.wait_for(lambda: self.joined(nick, channel)))
+        shauna = self.server.run(self.server.connect_virtual, 'Shauna')
+        self.server.run(shauna.say, 'JOIN #a')
+        self.assertTrue(loadgen.wait_for(lambda: loadgen.bot_messages(self.server, '#a')))
+        store = nickstore.SQLiteNickStore(settings.sqlite_nick_source)
+        store.load()
+        self.assertTrue(loadgen.wait_for(lambda: 'shauna' in store))
+        store.close()
+        self.server.run(shauna.say, 'JOIN #b')  # Known to the other worker too
+        time.sleep(0.5)
+        self.assertEqual(self.server.run(lambda: [target for nick, target, text in self.server.privmsgs
+                                                  if nick == 'elaenor1']), [])
+
+        process = self.supervisor.processes[1][0]
+        process.terminate()
+        process.join()
+        self.assertTrue(loadgen.wait_for(lambda: self.supervisor.processes[1] is not None and
+                                         self.supervisor.processes[1][0] is not process))
+        self.assertTrue(loadgen.wait_for(lambda: self.joined('elaenor1', '#b')))
+
+    def tearDown(self):
+        self.supervisor.stop()
+        self.thread.join()
+        loadgen.restore_settings(self.old)
+        self.server.stop()
+        shutil.rmtree(self.workdir)
+
+
+# Runs all the unit-tests
+if __name__ == '__main__':
+    unittest.main()
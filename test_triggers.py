@@ -0,0 +1,48 @@
+# Tests for the keyword trigger matcher (triggers.py)
+
+import unittest
+import triggers
+
+
+class TestTriggerMatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.matcher = triggers.TriggerMatcher('elaenor', [
+            (['hello', 'hi', 'hey'], 'greet'),
+            (['help', 'info', 'hi'], 'explain'),
+        ])
+
+    def test_match(self):
+        self.assertEqual(self.matcher.match('hello elaenor'), ('hello', 'greet'))
+        self.assertEqual(self.matcher.match('oh, HI, Elaenor!'), ('hi', 'greet'))  # Earlier triggers win
+        self.assertEqual(self.matcher.match('can you help: elaenor'), ('help', 'explain'))
+
+    def test_no_match(self):
+        for text in ['hello everyone', 'this elaenor', 'hi elaenorbot', 'elaenor hello', 'hi   -- elaenor', '']:
+            self.assertEqual(self.matcher.match(text), None, text)
+
+    def test_leftmost_trigger(self):
+        self.assertEqual(self.matcher.match('info elaenor, and hello elaenor'), ('info', 'explain'))
+
+    def test_keywords_escaped(self):
+        matcher = triggers.TriggerMatcher('bot[1]', [(['c++', 'what.is'], 'faq')])
+        self.assertEqual(matcher.match('c++ bot[1]'), ('c++', 'faq'))
+        self.assertEqual(matcher.match('whatXis bot[1]'), None)
+        self.assertEqual(matcher.match('c++ bot1'), None)
+
+    def test_longest_keyword_first(self):
+        matcher = triggers.TriggerMatcher('elaenor', [(['faq'], 'short'), (['faq install'], 'long')])
+        self.assertEqual(matcher.match('faq install elaenor'), ('faq install', 'long'))
+        self.assertEqual(matcher.match('faq elaenor'), ('faq', 'short'))
+
+    def test_add_and_remove(self):
+        self.matcher.add(['wsgi'], 'faq')
+        self.assertEqual(self.matcher.match('wsgi elaenor'), ('wsgi', 'faq'))
+        self.matcher.remove(['wsgi', 'hello', 'hi', 'hey', 'help', 'info'])
+        self.assertEqual(len(self.matcher), 0)
+        self.assertEqual(self.matcher.match('hello elaenor'), None)
+
+
+# Runs all the unit-tests
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+# Keyword triggers for WelcomeBot.  See bot.py for the bot itself.
+#
+# A trigger is a keyword followed by the bot's nick: "hello elaenor",
+# "help, elaenor".  Every keyword the bot knows is compiled into a single
+# regex -- an escaped alternation -- so a message is scanned once however
+# many keywords there are, and the keyword that matched leads straight to
+# its response.  Messages that don't mention the bot at all are turned away
+# by a plain substring test before the regex runs.
+
+import re
+
+SEPARATOR = r'[\s,:;.!~-]{1,3}'  # Between keyword and nick: "hi elaenor", "hi, elaenor"
+
+
+#########################
+### Class Definitions ###
+#########################
+
+class TriggerMatcher(object):
+
+    def __init__(self, botnick, triggers=()):
+        self.botnick = botnick
+        self.needle = botnick.lower()  # For the substring test
+        self.responses = {}  # Lower-cased keyword -> response
+        self.regex = None
+        for keywords, response in triggers:
+            self.add(keywords, response, compile=False)
+        self.compile()
+
+    # Makes each of `keywords` trigger `response`.  A keyword that already has
+    # a response keeps it, so earlier triggers take precedence.
+    def add(self, keywords, response, compile=True):
+        for keyword in keywords:
+            self.responses.setdefault(keyword.lower(), response)
+        if compile:
+            self.compile()
+
+    # Stops `keywords` triggering anything -- or, given a response, stops them
+    # triggering that response (leaving any other in place).
+    def remove(self, keywords, response=None, compile=True):
+        for keyword in keywords:
+            keyword = keyword.lower()
+            if response is None or self.responses.get(keyword) is response:
+                self.responses.pop(keyword, None)
+        if compile:
+            self.compile()
+
+    def compile(self):
+        if not self.responses:
+            self.regex = None
+            return
+        keywords = sorted(self.responses, key=lambda keyword: (-len(keyword), keyword))  # Longest first
+        self.regex = re.compile(r'(?<!\w)({0}){1}{2}(?!\w)'.format(
+            '|'.join(re.escape(keyword) for keyword in keywords), SEPARATOR, re.escape(self.botnick)), re.I)
+
+    # Returns (keyword, response) for the first trigger in `text`, or None.
+    def match(self, text):
+        if self.regex is None or self.needle not in text.lower():
+            return None
+        found = self.regex.search(text)
+        if found is None:
+            return None
+        keyword = found.group(1).lower()
+        return keyword, self.responses[keyword]
+
+    def __len__(self):
+        return len(self.responses)